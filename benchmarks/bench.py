@@ -0,0 +1,413 @@
+"""
+Gateway benchmarks
+------------------
+
+Starts the Sanic application in a child process, together with in-process
+fake RPC services and a local S3 stand-in, then drives it with concurrent
+HTTP clients.
+
+  $> python -m benchmarks.bench run [--clients 20] [--requests 200]
+  $> python -m benchmarks.bench run --save main
+  $> python -m benchmarks.bench compare main [--threshold 10]
+  $> python -m benchmarks.bench signing [--size 8] [--repeat 5]
+
+Baselines are stored as JSON in `benchmarks/baselines/`.
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import typing as t
+from base64 import b64encode
+from datetime import datetime, timezone
+from pathlib import Path
+import aiohttp
+from minicli import cli, run as run_cli
+
+
+HOST = '127.0.0.1'
+HTTP_PORT = 8765
+S3_PORT = 9765
+RPC = {
+    'courrier': 'tcp://127.0.0.1:6100',
+    'jwt': 'tcp://127.0.0.1:6200',
+    'accounts': 'tcp://127.0.0.1:6300',
+    'pki': 'tcp://127.0.0.1:6400',
+    'websockets': 'tcp://127.0.0.1:6500',
+}
+BASELINES = Path(__file__).parent / 'baselines'
+PAYLOAD = os.urandom(64 * 1024)
+PAYLOAD_CHECKSUM = b64encode(hashlib.sha256(PAYLOAD).digest()).decode()
+
+
+class UnexpectedResponse(Exception):
+    pass
+
+
+def serve_gateway(port: int, s3_port: int, latency: float):
+    from microfarm import app
+    from .fakes import serve_fakes
+    from .s3 import serve_s3
+
+    app.config.RPC = RPC
+    app.config.MINIO = {
+        **app.config.MINIO, 'endpoint': f'{HOST}:{s3_port}'
+    }
+    # Measure the gateway itself, not the admission control.
+    app.config.LIMITS = {**app.config.LIMITS, 'enabled': False}
+
+    @app.before_server_start
+    async def start_standins(app):
+        app.ctx.fakes, app.ctx.fake_servers = await serve_fakes(
+            RPC, Path('identities/jwt.key'), latency)
+        app.ctx.s3, app.ctx.s3_runner = await serve_s3(HOST, s3_port)
+
+    app.run(
+        host=HOST, port=port, single_process=True,
+        access_log=False, motd=False
+    )
+
+
+def serve_backends(s3_port: int, latency: float):
+    from .fakes import serve_fakes
+    from .s3 import serve_s3
+
+    async def main():
+        # The servers stay referenced by the loop until it is stopped.
+        await serve_fakes(RPC, Path('identities/jwt.key'), latency)
+        await serve_s3(HOST, s3_port)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+async def wait_for(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url):
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(.2)
+    raise TimeoutError(f'{url} did not answer within {timeout}s.')
+
+
+def percentile(values: t.List[float], q: float) -> float:
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+async def measure(clients: int, requests: int,
+                  make_request: t.Callable[[int], t.Awaitable]) -> dict:
+    latencies, errors = [], []
+    indexes = iter(range(requests))
+
+    async def worker():
+        for index in indexes:
+            start = time.perf_counter()
+            try:
+                await make_request(index)
+            except (aiohttp.ClientError, UnexpectedResponse) as exc:
+                errors.append(exc)
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'first_error': str(errors[0]) if errors else None,
+        'rps': round(requests / elapsed, 2),
+        'p50': round(percentile(latencies, .50) * 1000, 3),
+        'p95': round(percentile(latencies, .95) * 1000, 3),
+        'p99': round(percentile(latencies, .99) * 1000, 3),
+    }
+
+
+async def expect(response, *statuses: int):
+    body = await response.read()
+    if response.status not in statuses:
+        raise UnexpectedResponse(f'{response.status}: {body[:200]!r}')
+    return body
+
+
+async def scenarios(base: str, clients: int, requests: int) -> dict:
+    results = {}
+    tokens = {}
+    folders = []
+    connector = aiohttp.TCPConnector(limit=clients)
+    async with aiohttp.ClientSession(base, connector=connector) as session:
+
+        def auth(index: int) -> dict:
+            return {'Authorization': f'Bearer {tokens[index % clients]}'}
+
+        async def login(index):
+            user = index % clients
+            async with session.post('/login', json={
+                    'email': f'user{user}@bench.example.org',
+                    'password': 'password'}) as resp:
+                tokens[user] = (await expect(resp, 200)).decode()
+
+        async def create_folder(index):
+            async with session.post('/folders/new', headers=auth(index),
+                                    json={'name': f'folder {index}'}) as resp:
+                folders.append(
+                    (index, (await expect(resp, 200)).decode()))
+
+        async def upload(index):
+            user, folder = folders[index]
+            async with session.put(
+                    f'/folders/upload/{folder}', data=PAYLOAD, headers={
+                        **auth(user),
+                        'Content-Type': 'application/octet-stream',
+                        'X-Original-Name': f'file{index}.bin',
+                        'X-Checksum-SHA256': PAYLOAD_CHECKSUM}) as resp:
+                await expect(resp, 200)
+
+        async def view(index):
+            user, folder = folders[index]
+            async with session.get(f'/folders/view/{folder}',
+                                   headers=auth(user)) as resp:
+                await expect(resp, 200)
+
+        async def lock(index):
+            user, folder = folders[index]
+            async with session.get(f'/folders/lock/{folder}',
+                                   headers=auth(user)) as resp:
+                job = json.loads(await expect(resp, 202))
+            await completion(user, job['request'])
+
+        async def completion(user: int, job_id: str):
+            """Timed requests last until their job is done.
+            """
+            while True:
+                async with session.get(f'/folders/jobs/{job_id}',
+                                       headers=auth(user)) as resp:
+                    job = json.loads(await expect(resp, 200))
+                if job['status'] == 'done':
+                    return
+                if job['status'] == 'failed':
+                    raise UnexpectedResponse(f"Job failed: {job['error']}")
+                await asyncio.sleep(.01)
+
+        async def sign(index):
+            user, folder = folders[index]
+            async with session.post(
+                    f'/folders/sign/{folder}', headers=auth(user),
+                    json={'certificate': 'bench', 'secret': 'bench'}) as resp:
+                job = json.loads(await expect(resp, 202))
+            await completion(user, job['request'])
+
+        async def new_certificate(index):
+            async with session.post(
+                    '/certificates/new', headers=auth(index),
+                    json={'common_name': f'Bench {index}'}) as resp:
+                await expect(resp, 200, 201, 202)
+
+        async def certificates(index):
+            async with session.post('/certificates', headers=auth(index),
+                                    json={}) as resp:
+                await expect(resp, 200)
+
+        results['login'] = await measure(
+            clients, max(requests, clients), login)
+        results['folder_create'] = await measure(
+            clients, requests, create_folder)
+        for name, scenario in (
+                ('upload', upload),
+                ('view', view),
+                ('lock', lock),
+                ('sign', sign)):
+            results[name] = await measure(clients, len(folders), scenario)
+        results['certificate_new'] = await measure(
+            clients, requests, new_certificate)
+        results['certificate_list'] = await measure(
+            clients, requests, certificates)
+    return results
+
+
+def current_commit() -> t.Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(clients: int, requests: int, latency: float) -> dict:
+    process = multiprocessing.Process(
+        target=serve_gateway, args=(HTTP_PORT, S3_PORT, latency),
+        daemon=True
+    )
+    process.start()
+    try:
+        base = f'http://{HOST}:{HTTP_PORT}'
+        await wait_for(f'{base}/metrics')
+        results = await scenarios(base, clients, requests)
+    finally:
+        process.terminate()
+        process.join()
+    return {
+        'commit': current_commit(),
+        'created': datetime.now(tz=timezone.utc).isoformat(),
+        'parameters': {
+            'clients': clients,
+            'requests': requests,
+            'latency': latency
+        },
+        'results': results
+    }
+
+
+async def signing_memory(size: int, repeat: int) -> dict:
+    """Peak memory allocated by the gateway to sign a manifest of `size`
+    bytes, with the manifest sent inline and by reference.
+    """
+    import tracemalloc
+    from miniopy_async.error import S3Error
+    from microfarm.layout import make_layout
+    from microfarm.rpc import rpcservice
+    from microfarm.storage import (
+        FolderSignature, minio_client, sha256hash, sign)
+
+    process = multiprocessing.Process(
+        target=serve_backends, args=(S3_PORT, 0.), daemon=True)
+    process.start()
+    try:
+        storage = minio_client({
+            'endpoint': f'{HOST}:{S3_PORT}', 'secure': False,
+            'access_key': 'bench', 'secret_key': 'bench'
+        })
+        layout = make_layout(storage, {})
+        pki = rpcservice('pki', RPC['pki'])
+        body = FolderSignature(certificate='bench', secret=b'bench')
+        manifest = os.urandom(size)
+        for _ in range(150):
+            try:
+                await layout.ensure('signing')
+                break
+            except (aiohttp.ClientError, S3Error):
+                await asyncio.sleep(.2)
+        bucket, key = layout.key('signing', 'folder/manifest')
+        checksum = sha256hash(manifest).decode()
+        await storage.put_object(
+            bucket, key, io.BytesIO(manifest), size,
+            metadata={'x-amz-meta-checksum': checksum})
+        del manifest
+
+        async def progress(*args):
+            pass
+
+        results = {}
+        for mode, reference in (
+                ('inline', None),
+                ('reference', {'threshold': 0})):
+            peaks, durations = [], []
+            for _ in range(repeat):
+                tracemalloc.start()
+                start = time.perf_counter()
+                await sign(storage, layout, pki, 'signing', 'folder',
+                           body, progress, reference=reference)
+                durations.append(time.perf_counter() - start)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            results[mode] = {
+                'peak': max(peaks),
+                'p50': round(percentile(durations, .50) * 1000, 3),
+            }
+        return results
+    finally:
+        process.terminate()
+        process.join()
+
+
+def report(current: dict, baseline: t.Optional[dict] = None,
+           threshold: float = 10.) -> bool:
+    regressed = False
+    print(f"{'scenario':<18}{'rps':>10}{'p50 ms':>10}"
+          f"{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, result in current['results'].items():
+        print(f"{name:<18}{result['rps']:>10}{result['p50']:>10}"
+              f"{result['p95']:>10}{result['p99']:>10}{result['errors']:>8}")
+        if result['first_error']:
+            print(f"{'':<18}first error: {result['first_error']}")
+        if baseline is None or name not in baseline['results']:
+            continue
+        reference = baseline['results'][name]
+        deltas = []
+        for key in ('rps', 'p50', 'p95', 'p99'):
+            if not reference[key]:
+                continue
+            delta = (result[key] - reference[key]) / reference[key] * 100
+            worse = -delta if key == 'rps' else delta
+            if worse > threshold:
+                regressed = True
+            flag = ' !' if worse > threshold else ''
+            deltas.append(f"{key} {delta:+.1f}%{flag}")
+        print(f"{'':<18}{', '.join(deltas)}")
+    return regressed
+
+
+@cli
+async def run(clients: int = 20, requests: int = 200,
+              latency: float = 0., save: str = ''):
+    """Run the benchmark suite.
+
+    :clients: number of concurrent HTTP clients.
+    :requests: number of requests per scenario.
+    :latency: simulated backend latency, in seconds.
+    :save: store the results as a named baseline.
+    """
+    results = await benchmark(clients, requests, latency)
+    report(results)
+    if save:
+        BASELINES.mkdir(exist_ok=True)
+        path = BASELINES / f'{save}.json'
+        path.write_text(json.dumps(results, indent=2))
+        print(f'Baseline written to {path}')
+
+
+@cli
+async def compare(baseline: str, threshold: float = 10.):
+    """Run the benchmark suite and compare it against a stored baseline.
+
+    :baseline: name of the baseline to compare with.
+    :threshold: tolerated degradation, in percent.
+    """
+    reference = json.loads((BASELINES / f'{baseline}.json').read_text())
+    parameters = reference['parameters']
+    results = await benchmark(
+        parameters['clients'], parameters['requests'], parameters['latency'])
+    print(f"Baseline {baseline} ({reference['commit']}) "
+          f"vs {results['commit']}")
+    if report(results, reference, threshold):
+        sys.exit(1)
+
+
+@cli
+async def signing(size: int = 8, repeat: int = 5):
+    """Measure the gateway memory used to sign a manifest.
+
+    :size: manifest size, in MiB.
+    :repeat: number of signatures per mode.
+    """
+    results = await signing_memory(size * 1024 * 1024, repeat)
+    print(f"{'mode':<18}{'peak MiB':>10}{'p50 ms':>10}")
+    for mode, result in results.items():
+        print(f"{mode:<18}{result['peak'] / 1024 ** 2:>10.2f}"
+              f"{result['p50']:>10}")
+
+
+if __name__ == '__main__':
+    run_cli()
@@ -0,0 +1,66 @@
+"""
+Local trace collector stand-in.
+
+Receives the span batches posted by the gateway tracer and prints each
+trace as a tree once its root span has arrived.
+
+  $> python -m benchmarks.collector serve [--port 4318]
+"""
+
+import typing as t
+from aiohttp import web
+from minicli import cli, run
+
+
+class Collector:
+
+    def __init__(self, echo: bool = True):
+        self.echo = echo
+        self.spans: t.Dict[str, t.List[dict]] = {}
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/spans', self.receive)
+        return app
+
+    async def receive(self, request):
+        batch = await request.json()
+        for span in batch['spans']:
+            self.spans.setdefault(span['trace_id'], []).append(span)
+            if span['parent_id'] is None and self.echo:
+                print(self.render(span['trace_id']))
+        return web.Response(status=202)
+
+    def render(self, trace_id: str) -> str:
+        spans = self.spans.get(trace_id, [])
+        children = {}
+        for span in spans:
+            children.setdefault(span['parent_id'], []).append(span)
+
+        lines = [f'trace {trace_id}']
+
+        def walk(parent_id, depth):
+            for span in sorted(children.get(parent_id, ()),
+                               key=lambda s: s['start']):
+                lines.append(
+                    f"{'  ' * depth}{span['name']} "
+                    f"{span['duration'] / 1e6:.2f}ms [{span['status']}]"
+                )
+                walk(span['span_id'], depth + 1)
+
+        walk(None, 1)
+        return '\n'.join(lines)
+
+
+@cli
+def serve(host: str = '127.0.0.1', port: int = 4318):
+    """Receive spans and print trace trees.
+
+    :host: interface to listen on.
+    :port: port to listen on.
+    """
+    web.run_app(Collector().application(), host=host, port=port)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,199 @@
+"""
+In-process stand-ins for the Microfarm RPC services.
+
+They answer with the same envelopes (`{"code": ..., "body": ...}`) as
+the real services, without databases, mailers or key generation.
+An optional `latency` (in seconds) simulates backend processing time.
+"""
+
+import asyncio
+import hashlib
+import uuid
+import aiohttp
+import jwt
+import typing as t
+from base64 import b64encode
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from aiozmq import rpc
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+
+class FakeService(rpc.AttrHandler):
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+
+    async def pause(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeCourrier(FakeService):
+
+    @rpc.method
+    async def send_email(self, mailer: str, recipients: list,
+                         subject: str, body: str):
+        await self.pause()
+        return {'code': 200}
+
+
+class FakeWebsockets(FakeService):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = []
+
+    @rpc.method
+    async def send_message(self, channel: str, message: str):
+        self.messages.append((channel, message))
+        return {'code': 200}
+
+
+class FakeJWT(FakeService):
+
+    def __init__(self, private_key: Path, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.private_key = load_pem_private_key(
+            private_key.read_bytes(), password=None)
+
+    @rpc.method
+    async def get_token(self, data: dict, delta: int = 60):
+        await self.pause()
+        payload = {
+            **data,
+            'exp': datetime.now(tz=timezone.utc) + timedelta(minutes=delta)
+        }
+        token = jwt.encode(payload, self.private_key, algorithm="RS256")
+        return {'code': 200, 'body': token}
+
+    @rpc.method
+    async def verify_token(self, token: str):
+        return {'code': 200}
+
+
+class FakeAccounts(FakeService):
+
+    password = 'password'
+
+    def account(self, email: str):
+        return {
+            'id': uuid.uuid5(uuid.NAMESPACE_URL, email).hex,
+            'email': email,
+            'name': email.split('@', 1)[0],
+            'status': 'active'
+        }
+
+    @rpc.method
+    async def create_account(self, data: dict):
+        await self.pause()
+        return {'code': 201, 'body': '123456'}
+
+    @rpc.method
+    async def verify_account(self, email: str, token: str):
+        return {'code': 202, 'body': self.account(email)}
+
+    @rpc.method
+    async def request_account_token(self, email: str):
+        return {'code': 200, 'body': '123456'}
+
+    @rpc.method
+    async def verify_credentials(self, email: str, password: str):
+        await self.pause()
+        if password != self.password:
+            return {'code': 402, 'description': 'Credentials did not match.'}
+        return {'code': 202, 'body': self.account(email)}
+
+
+class FakePKI(FakeService):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.certificates: t.Dict[str, t.List[dict]] = {}
+
+    @rpc.method
+    async def generate_certificate(self, user: str, identity: str):
+        await self.pause()
+        serial = str(uuid.uuid4().int)
+        certificate = {
+            'serial_number': serial,
+            'identity': identity,
+            'creation_date': datetime.now(tz=timezone.utc).isoformat()
+        }
+        self.certificates.setdefault(user, []).append(certificate)
+        return {'code': 201, 'body': certificate}
+
+    def listing(self, user: str, offset: int = 0, limit: int = 0, **kwargs):
+        items = self.certificates.get(user, [])
+        if offset:
+            items = items[offset:]
+        if limit:
+            items = items[:limit]
+        return {
+            'code': 200,
+            'body': {
+                'metadata': {
+                    'total': len(self.certificates.get(user, [])),
+                    'offset': offset,
+                    'page_size': limit or None
+                },
+                'items': items
+            }
+        }
+
+    @rpc.method
+    async def list_certificates(self, user: str, offset: int = 0,
+                                limit: int = 0, sort_by: list = ()):
+        await self.pause()
+        return self.listing(user, offset, limit)
+
+    @rpc.method
+    async def list_valid_certificates(self, user: str, offset: int = 0,
+                                      limit: int = 0, sort_by: list = ()):
+        await self.pause()
+        return self.listing(user, offset, limit)
+
+    @rpc.method
+    async def get_certificate(self, user: str, serial_number: str):
+        for certificate in self.certificates.get(user, []):
+            if certificate['serial_number'] == serial_number:
+                return {'code': 200, 'body': certificate}
+        return {'code': 404}
+
+    @rpc.method
+    async def sign(self, user: str, data: bytes, certificate: str,
+                   secret: bytes):
+        await self.pause()
+        digest = hashlib.sha256(data).digest()
+        return {'code': 200, 'body': b'FAKE-P7S' + digest * 64}
+
+    @rpc.method
+    async def sign_reference(self, user: str, url: str, checksum: str,
+                             certificate: str, secret: bytes):
+        await self.pause()
+        hasher = hashlib.sha256()
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as resp:
+                if resp.status != 200:
+                    return {'code': 400}
+                async for chunk in resp.content.iter_chunked(65536):
+                    hasher.update(chunk)
+        digest = hasher.digest()
+        if checksum and b64encode(digest).decode() != checksum:
+            return {'code': 400}
+        return {'code': 200, 'body': b'FAKE-P7S' + digest * 64}
+
+
+async def serve_fakes(binds: t.Dict[str, str], private_key: Path,
+                      latency: float = 0):
+    handlers = {
+        'courrier': FakeCourrier(latency),
+        'jwt': FakeJWT(private_key, latency),
+        'accounts': FakeAccounts(latency),
+        'pki': FakePKI(latency),
+        'websockets': FakeWebsockets(latency),
+    }
+    servers = []
+    for name, handler in handlers.items():
+        servers.append(await rpc.serve_rpc(handler, bind=binds[name]))
+    return handlers, servers
@@ -0,0 +1,394 @@
+"""
+Local S3 stand-in.
+
+Implements the subset of the S3 (and MinIO) HTTP API the gateway uses,
+in memory. Requests are not authenticated.
+"""
+
+import asyncio
+import fnmatch
+import hashlib
+import json
+import uuid
+import typing as t
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from urllib.parse import quote_plus, unquote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from aiohttp import web
+
+
+NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+@dataclass
+class StoredObject:
+    data: bytes
+    content_type: str
+    metadata: t.Dict[str, str]
+    checksum: t.Optional[str] = None
+    modified: datetime = field(
+        default_factory=lambda: datetime.now(tz=timezone.utc))
+
+    @property
+    def etag(self) -> str:
+        return hashlib.md5(self.data).hexdigest()
+
+    def headers(self) -> t.Dict[str, str]:
+        headers = {
+            'ETag': f'"{self.etag}"',
+            'Content-Type': self.content_type,
+            'Last-Modified': format_datetime(self.modified, usegmt=True),
+            **self.metadata
+        }
+        if self.checksum:
+            headers['x-amz-checksum-sha256'] = self.checksum
+        return headers
+
+
+def xml(body: str, status: int = 200) -> web.Response:
+    return web.Response(
+        status=status,
+        body=('<?xml version="1.0" encoding="UTF-8"?>' + body).encode(),
+        content_type='application/xml'
+    )
+
+
+def error(code: str, status: int, resource: str = '') -> web.Response:
+    return xml(
+        f'<Error><Code>{code}</Code><Message>{code}</Message>'
+        f'<Resource>{escape(resource)}</Resource>'
+        f'<RequestId>{uuid.uuid4().hex}</RequestId></Error>',
+        status=status
+    )
+
+
+class S3StandIn:
+
+    def __init__(self):
+        self.buckets: t.Dict[str, t.Dict[str, StoredObject]] = {}
+        self.uploads: t.Dict[str, t.Tuple[str, str, dict]] = {}
+        self.parts: t.Dict[str, t.Dict[int, bytes]] = {}
+        self.listeners: t.List[t.Tuple[str, dict, asyncio.Queue]] = []
+        self.keepalive = 5.
+
+    def application(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_route('GET', '/', self.list_buckets)
+        app.router.add_route('*', '/{bucket}', self.bucket)
+        app.router.add_route('*', '/{bucket}/', self.bucket)
+        app.router.add_route('*', '/{bucket}/{key:.+}', self.object)
+        return app
+
+    async def list_buckets(self, request):
+        entries = ''.join(
+            f'<Bucket><Name>{name}</Name>'
+            f'<CreationDate>2020-01-01T00:00:00.000Z</CreationDate></Bucket>'
+            for name in self.buckets
+        )
+        return xml(
+            f'<ListAllMyBucketsResult xmlns="{NS}"><Buckets>{entries}'
+            '</Buckets></ListAllMyBucketsResult>'
+        )
+
+    async def bucket(self, request):
+        name = request.match_info['bucket']
+        query = request.query
+        if 'location' in query:
+            return xml(f'<LocationConstraint xmlns="{NS}"/>')
+
+        if request.method == 'PUT':
+            if 'lifecycle' in query:
+                return web.Response(status=200)
+            if name in self.buckets:
+                return error('BucketAlreadyOwnedByYou', 409, name)
+            self.buckets[name] = {}
+            return web.Response(status=200)
+
+        if name not in self.buckets:
+            return error('NoSuchBucket', 404, name)
+
+        if request.method == 'HEAD':
+            return web.Response(status=200)
+        if request.method == 'GET' and 'events' in query:
+            return await self.listen(request, name)
+        if request.method == 'GET':
+            return self.list_objects(name, query)
+        if request.method == 'POST' and 'delete' in query:
+            return await self.delete_objects(request, name)
+        if request.method == 'DELETE':
+            if self.buckets[name]:
+                return error('BucketNotEmpty', 409, name)
+            del self.buckets[name]
+            return web.Response(status=204)
+        return error('NotImplemented', 501, name)
+
+    async def delete_objects(self, request, name: str) -> web.Response:
+        document = ElementTree.fromstring(await request.read())
+        quiet = False
+        keys = []
+        for element in document:
+            tag = element.tag.rpartition('}')[2]
+            if tag == 'Quiet':
+                quiet = element.text == 'true'
+            elif tag == 'Object':
+                for child in element:
+                    if child.tag.rpartition('}')[2] == 'Key':
+                        keys.append(child.text)
+        if len(keys) > 1000:
+            return error('MalformedXML', 400, name)
+        bucket = self.buckets[name]
+        for key in keys:
+            if bucket.pop(key, None) is not None:
+                self.notify(name, key, 's3:ObjectRemoved:Delete')
+        deleted = '' if quiet else ''.join(
+            f'<Deleted><Key>{escape(key)}</Key></Deleted>' for key in keys)
+        return xml(f'<DeleteResult xmlns="{NS}">{deleted}</DeleteResult>')
+
+    def notify(self, name: str, key: str, event: str):
+        record = {
+            'eventName': event,
+            's3': {
+                'bucket': {'name': name},
+                'object': {'key': quote_plus(key)},
+            },
+        }
+        for bucket, query, queue in self.listeners:
+            if bucket != name \
+               or not key.startswith(query.get('prefix', '')) \
+               or not key.endswith(query.get('suffix', '')):
+                continue
+            if any(fnmatch.fnmatch(event, pattern)
+                   for pattern in query.getall('events')):
+                queue.put_nowait(record)
+
+    async def listen(self, request, name: str) -> web.StreamResponse:
+        """MinIO's ListenBucketNotification: JSON lines of records, with
+        blank keep-alives.
+        """
+        queue = asyncio.Queue()
+        listener = (name, request.query, queue)
+        self.listeners.append(listener)
+        response = web.StreamResponse()
+        await response.prepare(request)
+        try:
+            while True:
+                try:
+                    record = await asyncio.wait_for(
+                        queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    await response.write(b' ')
+                    continue
+                await response.write(json.dumps({
+                    'EventName': record['eventName'],
+                    'Key': f"{name}/{unquote(record['s3']['object']['key'])}",
+                    'Records': [record],
+                }).encode() + b'\n')
+        finally:
+            self.listeners.remove(listener)
+
+    def list_objects(self, name: str, query) -> web.Response:
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter', '')
+        start_after = query.get(
+            'continuation-token', query.get('start-after', ''))
+        max_keys = int(query.get('max-keys', 1000))
+        with_metadata = query.get('metadata') == 'true'
+
+        contents, prefixes, last = [], [], None
+        truncated = False
+        for key in sorted(self.buckets[name]):
+            if not key.startswith(prefix) or key <= start_after:
+                continue
+            if delimiter:
+                rest = key[len(prefix):]
+                if delimiter in rest:
+                    common = prefix + rest.split(delimiter, 1)[0] + delimiter
+                    if common not in prefixes:
+                        if len(contents) + len(prefixes) >= max_keys:
+                            truncated = True
+                            break
+                        prefixes.append(common)
+                        last = key
+                    continue
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+            contents.append((key, self.buckets[name][key]))
+            last = key
+
+        entries = []
+        for key, obj in contents:
+            meta = ''
+            if with_metadata:
+                meta = '<UserMetadata>' + ''.join(
+                    f'<{k.title()}>{escape(v)}</{k.title()}>'
+                    for k, v in obj.metadata.items()
+                ) + f'<content-type>{escape(obj.content_type)}</content-type>'
+                meta += '</UserMetadata>'
+            entries.append(
+                f'<Contents><Key>{escape(key)}</Key>'
+                f'<LastModified>'
+                f'{obj.modified.strftime("%Y-%m-%dT%H:%M:%S.000Z")}'
+                f'</LastModified><ETag>"{obj.etag}"</ETag>'
+                f'<Size>{len(obj.data)}</Size>'
+                f'<StorageClass>STANDARD</StorageClass>{meta}</Contents>'
+            )
+        entries.extend(
+            f'<CommonPrefixes><Prefix>{escape(p)}</Prefix></CommonPrefixes>'
+            for p in prefixes
+        )
+        token = ''
+        if truncated and last is not None:
+            token = (
+                f'<NextContinuationToken>{escape(last)}'
+                '</NextContinuationToken>'
+            )
+        return xml(
+            f'<ListBucketResult xmlns="{NS}"><Name>{name}</Name>'
+            f'<Prefix>{escape(prefix)}</Prefix>'
+            f'<KeyCount>{len(entries)}</KeyCount>'
+            f'<MaxKeys>{max_keys}</MaxKeys>'
+            f'<Delimiter>{escape(delimiter)}</Delimiter>'
+            f'<IsTruncated>{str(truncated).lower()}</IsTruncated>'
+            f'{"".join(entries)}{token}</ListBucketResult>'
+        )
+
+    async def object(self, request):
+        name = request.match_info['bucket']
+        key = request.match_info['key']
+        query = request.query
+        if name not in self.buckets:
+            return error('NoSuchBucket', 404, name)
+        bucket = self.buckets[name]
+
+        if request.method == 'POST' and 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = (name, key, self.object_info(request))
+            self.parts[upload_id] = {}
+            return xml(
+                f'<InitiateMultipartUploadResult xmlns="{NS}">'
+                f'<Bucket>{name}</Bucket><Key>{escape(key)}</Key>'
+                f'<UploadId>{upload_id}</UploadId>'
+                '</InitiateMultipartUploadResult>'
+            )
+
+        if 'uploadId' in query:
+            return await self.multipart(request, name, key, query['uploadId'])
+
+        if request.method == 'PUT' and 'x-amz-copy-source' in request.headers:
+            source = unquote(request.headers['x-amz-copy-source'])
+            source_name, _, source_key = source.lstrip('/').partition('/')
+            original = self.buckets.get(source_name, {}).get(source_key)
+            if original is None:
+                return error('NoSuchKey', 404, source)
+            info = {}
+            if request.headers.get('x-amz-metadata-directive') == 'REPLACE':
+                info = self.object_info(request)
+            bucket[key] = replace(
+                original, modified=datetime.now(tz=timezone.utc), **info)
+            self.notify(name, key, 's3:ObjectCreated:Copy')
+            return xml(
+                f'<CopyObjectResult><ETag>"{bucket[key].etag}"</ETag>'
+                f'<LastModified>'
+                f'{bucket[key].modified.strftime("%Y-%m-%dT%H:%M:%S.000Z")}'
+                f'</LastModified></CopyObjectResult>'
+            )
+
+        if request.method == 'PUT':
+            data = await request.read()
+            info = self.object_info(request)
+            bucket[key] = StoredObject(data, **info)
+            self.notify(name, key, 's3:ObjectCreated:Put')
+            return web.Response(
+                status=200, headers={'ETag': f'"{bucket[key].etag}"'})
+
+        obj = bucket.get(key)
+        if request.method == 'DELETE':
+            if bucket.pop(key, None) is not None:
+                self.notify(name, key, 's3:ObjectRemoved:Delete')
+            return web.Response(status=204)
+
+        if obj is None:
+            return error('NoSuchKey', 404, key)
+
+        if request.method == 'HEAD':
+            return web.Response(
+                status=200, headers={
+                    **obj.headers(), 'Content-Length': str(len(obj.data))
+                }
+            )
+        if request.method == 'GET':
+            return web.Response(
+                status=200, body=obj.data, headers=obj.headers())
+        return error('NotImplemented', 501, key)
+
+    def object_info(self, request) -> dict:
+        metadata = {
+            k.lower(): v for k, v in request.headers.items()
+            if k.lower().startswith('x-amz-meta-')
+        }
+        return {
+            'content_type': request.headers.get(
+                'Content-Type', 'application/octet-stream'),
+            'metadata': metadata,
+            'checksum': request.headers.get('x-amz-checksum-sha256'),
+        }
+
+    async def multipart(self, request, name: str, key: str, upload_id: str):
+        if upload_id not in self.uploads:
+            return error('NoSuchUpload', 404, key)
+
+        if request.method == 'PUT':
+            data = await request.read()
+            number = int(request.query['partNumber'])
+            self.parts[upload_id][number] = data
+            return web.Response(
+                status=200,
+                headers={'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+            )
+
+        if request.method == 'GET':
+            parts = ''.join(
+                f'<Part><PartNumber>{number}</PartNumber>'
+                f'<ETag>"{hashlib.md5(data).hexdigest()}"</ETag>'
+                f'<Size>{len(data)}</Size>'
+                '<LastModified>2020-01-01T00:00:00.000Z</LastModified></Part>'
+                for number, data in sorted(self.parts[upload_id].items())
+            )
+            return xml(
+                f'<ListPartsResult xmlns="{NS}"><Bucket>{name}</Bucket>'
+                f'<Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId>'
+                f'<IsTruncated>false</IsTruncated>{parts}</ListPartsResult>'
+            )
+
+        if request.method == 'DELETE':
+            self.uploads.pop(upload_id)
+            self.parts.pop(upload_id)
+            return web.Response(status=204)
+
+        if request.method == 'POST':
+            _, _, info = self.uploads.pop(upload_id)
+            parts = self.parts.pop(upload_id)
+            data = b''.join(data for _, data in sorted(parts.items()))
+            obj = self.buckets[name][key] = StoredObject(data, **info)
+            self.notify(
+                name, key, 's3:ObjectCreated:CompleteMultipartUpload')
+            return xml(
+                f'<CompleteMultipartUploadResult xmlns="{NS}">'
+                f'<Bucket>{name}</Bucket><Key>{escape(key)}</Key>'
+                f'<ETag>"{obj.etag}"</ETag></CompleteMultipartUploadResult>'
+            )
+
+        return error('NotImplemented', 501, key)
+
+
+async def serve_s3(host: str, port: int) -> t.Tuple[S3StandIn, web.AppRunner]:
+    standin = S3StandIn()
+    runner = web.AppRunner(standin.application(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return standin, runner
@@ -1,11 +1,22 @@
 import orjson
-from minio import Minio
 from sanic import Sanic, Blueprint
 from sanic_ext import Extend
 from .rpc import rpcservices
+from .refresh import refresh
+from .events import events
+from .cache import caches
+from .compression import compression, compress_response
+from .jobs import jobs
 from .storage import storage
+from .uploads import uploads
+from .export import exports
+from .deletion import deletion
+from .notifications import notifications
 from .listeners import listeners
 from .middlewares import jwt_auth
+from .limits import limits, admit, release
+from .metrics import metrics, request_started, request_finished
+from .tracing import tracing, trace_request, end_request_trace
 from .register import routes as register_routes
 from .session import routes as session_routes
 from .certificate import routes as certificate_routes
@@ -14,10 +25,15 @@ from .certificate import routes as certificate_routes
 public_routes = Blueprint.group(
     register_routes
 )
+public_routes.middleware(admit, priority=98)
+public_routes.middleware(release, "response")
+
 secured_routes = Blueprint.group(
-    session_routes, certificate_routes, storage
+    session_routes, certificate_routes, storage, uploads, exports, deletion
 )
 secured_routes.middleware(jwt_auth, priority=99)
+secured_routes.middleware(admit, priority=98)
+secured_routes.middleware(release, "response")
 
 
 app = Sanic("Microfarm", dumps=orjson.dumps)
@@ -31,12 +47,144 @@ app.config.MINIO = {
     "access_key": "certifarm",
     "secret_key": "mN}Y*tx95AYN?cj"
 }
+app.config.STORAGE = {
+    "layout": "buckets",  # "buckets" (one per user) or "shared"
+    "bucket": "microfarm",  # shared layout bucket, or bucket prefix
+    "shards": 0,  # shared layout: number of hashed buckets, 0 for one
+    "expire_uploads": 0,  # days, over UPLOADS["ttl"]; 0 keeps them
+    "dedup": None,  # None, "user" or "global"
+    "blobs_bucket": "microfarm-blobs"
+}
+app.config.UPLOADS = {
+    "chunk_size": 8 * 1024 * 1024,
+    "max_size": 5 * 1024 ** 3,
+    "ttl": 86400,
+    "janitor_interval": 3600,
+    "janitor_lock": "./var/uploads-janitor.lock"  # one janitor per node
+}
+app.config.DELETION = {
+    "concurrency": 4,  # batches of 1000 keys deleted at once
+    "max_folders": 100
+}
+app.config.EXPORT = {
+    "read_ahead": 2,
+    "buffered": 4,
+    "chunk_size": 1024 * 1024
+}
+app.config.CACHE = {
+    "backend": "local",  # "local" (per worker) or "shared" (per node)
+    "socket": "./var/cache.sock",
+    "max_entries": 10000,
+    "max_bytes": 64 * 1024 * 1024,  # shared backend only
+    "near_entries": 1024,  # shared backend: copies kept by each worker
+    "default_ttl": 300,
+    "ttls": {
+        "token": 60,
+        "bucket": 3600,
+        "summary": 60,
+        "certificate": 86400
+    }
+}
+app.config.COMPRESSION = {
+    "enabled": True,
+    "min_size": 1024,
+    "encodings": ["zstd", "br", "gzip"],  # by preference, when installed
+    "levels": {"zstd": 3, "br": 5, "gzip": 6},
+    "workers": 2,
+    "artifacts": True  # store precompressed manifests and summaries
+}
+app.config.NOTIFICATIONS = {
+    "enabled": False,  # shared storage layout only
+    "retry": 5,
+    "idle_timeout": 60,
+    "lock": "./var/notifications.lock"  # shared cache: one listener per node
+}
+app.config.SIGNING = {
+    "by_reference": False,  # the PKI service fetches large manifests
+    "threshold": 256 * 1024,
+    "url_expiry": 300
+}
+app.config.JWT = {
+    "public_key": "./identities/jwt.pub",
+    "keys_directory": "./identities/jwt.keys",
+    "reload_interval": 30,
+    "retirement_grace": 3600
+}
+app.config.REFRESH = {
+    "local": False,  # mint refreshed tokens with the delegated key
+    "private_key": "./identities/refresh.key",
+    "kid": "refresh",  # its public key: <keys_directory>/<kid>.pub
+    "delta": 20,
+    "reuse_window": 10,
+    "min_interval": 60,
+    "max_entries": 100000  # tokens refreshed within min_interval, per worker
+}
+app.config.RPC = {
+    "courrier": "tcp://127.0.0.1:5100",
+    "jwt": "tcp://127.0.0.1:5200",
+    "accounts": "tcp://127.0.0.1:5300",
+    "pki": "tcp://127.0.0.1:5400",
+    "websockets": "tcp://127.0.0.1:5500"
+}
+app.config.EVENTS = {
+    "enabled": True,
+    "debounce": 0.5,
+    "max_delay": 2.0
+}
+app.config.JOBS = {
+    "database": "./var/jobs.sqlite",
+    "workers": 4,
+    "max_pending": 1000,
+    "heartbeat": 10,  # seconds; silent workers' jobs fail after 3 beats
+    "timeout": 3600  # seconds a job may run
+}
+app.config.METRICS = {
+    "enabled": True
+}
+app.config.TRACING = {
+    "enabled": False,
+    "sample_rate": 0.1,
+    "endpoint": "http://127.0.0.1:4318/spans",
+    "propagate": False
+}
+app.config.LIMITS = {
+    "enabled": True,
+    "user": {"rate": 20, "burst": 50},
+    "routes": {
+        "register.login": {"rate": 0.5, "burst": 5},
+        "storage.sign_folder": {"rate": 1, "burst": 5},
+        "certificate.new_certificate": {"rate": 0.2, "burst": 2},
+    },
+    # Signatures and certificates run as jobs, bounded by JOBS["workers"].
+    "concurrency": {
+        "storage.upload_to_folder": 32,
+        "uploads.upload_chunk": 32,
+    },
+    "adaptive": {
+        "min_limit": 1,
+        "target_latency": 2.0
+    }
+}
 Extend(app)
 
+app.register_middleware(request_started, "request", priority=100)
+app.register_middleware(request_finished, "response", priority=100)
+app.register_middleware(trace_request, "request", priority=100)
+app.register_middleware(end_request_trace, "response", priority=100)
+app.register_middleware(compress_response, "response")
 app.blueprint(listeners)
+app.blueprint(metrics)
+app.blueprint(tracing)
+app.blueprint(limits)
+app.blueprint(caches)
+app.blueprint(compression)
 app.blueprint(rpcservices)
+app.blueprint(refresh)
+app.blueprint(events)
+app.blueprint(jobs)
 app.blueprint(public_routes)
 app.blueprint(secured_routes)
+app.blueprint(notifications)
 
 app.ext.openapi.add_security_scheme(
     "token",
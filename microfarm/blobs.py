@@ -0,0 +1,173 @@
+"""
+Content-addressed blobs
+-----------------------
+
+In deduplicating mode, uploaded files are stored once per SHA-256 hash,
+either in each user's storage (`user` mode) or in a bucket shared by all
+users (`global` mode). Folder entries become empty objects referencing
+their blob through the `x-amz-meta-blob` metadata.
+
+Every entry referencing a blob is recorded as an empty object
+`refs/<hash>/<userid>/<entry>`, so the blob can be deleted with its last
+reference without any counter to keep consistent. A reference is
+checked against its blob once recorded, and a blob is set aside under
+`tombstones/` before its deletion and restored if an entry linked it
+meanwhile: a concurrent link and unlink cannot leave a dangling entry.
+
+A client may skip sending a file when the hash is known to it: in
+`global` mode, only to users holding a reference to the blob, so a hash
+alone never gives access to another user's file.
+"""
+
+import io
+import uuid
+import typing as t
+
+
+class BlobStore:
+
+    def __init__(self, storage, layout, mode: str,
+                 bucket: str = 'microfarm-blobs'):
+        if mode not in ('user', 'global'):
+            raise ValueError(f'Unknown deduplication mode {mode!r}.')
+        self.storage = storage
+        self.layout = layout
+        self.mode = mode
+        self.bucket = bucket
+        self.bucket_ready = False
+
+    def location(self, userid: str) -> t.Tuple[str, str]:
+        """Bucket and key prefix of the blob store of a user.
+        """
+        if self.mode == 'global':
+            return self.bucket, ''
+        return self.layout.key(userid, '.blobs/')
+
+    async def ensure_bucket(self):
+        if self.mode == 'global' and not self.bucket_ready:
+            if not await self.storage.bucket_exists(self.bucket):
+                await self.storage.make_bucket(self.bucket)
+            self.bucket_ready = True
+
+    def blob(self, userid: str, digest: str) -> t.Tuple[str, str]:
+        bucket, prefix = self.location(userid)
+        return bucket, f'{prefix}{digest}'
+
+    def ref(self, userid: str, digest: str,
+            entry: str = '') -> t.Tuple[str, str]:
+        bucket, prefix = self.location(userid)
+        return bucket, f'{prefix}refs/{digest}/{userid}/{entry}'
+
+    async def stat(self, userid: str, digest: str) -> t.Optional[t.Any]:
+        from miniopy_async.error import S3Error
+
+        await self.ensure_bucket()
+        try:
+            return await self.storage.stat_object(*self.blob(userid, digest))
+        except S3Error as exc:
+            if exc.code != 'NoSuchKey':
+                raise
+            return None
+
+    async def known(self, userid: str, digest: str) -> t.Optional[t.Any]:
+        """Stats of the blob, if the user may reference it without
+        uploading it.
+        """
+        if self.mode == 'global':
+            await self.ensure_bucket()
+            refs = await self.storage.list_objects(
+                *self.ref(userid, digest), recursive=True)
+            if not refs:
+                return None
+        return await self.stat(userid, digest)
+
+    async def store(self, userid: str, digest: str, checksum: str, stream,
+                    content_type: str) -> bool:
+        """Stores a blob from a hashing stream. The upload is staged and
+        only copied under its hash once the content is verified, so a
+        wrong checksum can never poison a shared blob.
+        Returns whether the content matched the digest.
+        """
+        await self.ensure_bucket()
+        bucket, prefix = self.location(userid)
+        staging = f'{prefix}staging/{uuid.uuid4().hex}'
+        await self.storage.put_object(
+            bucket, staging,
+            stream, -1, part_size=5242880,
+            content_type=content_type,
+            metadata={"x-amz-checksum-sha256": checksum}
+        )
+        if stream.hexdigest() != digest:
+            await self.storage.remove_object(bucket, staging)
+            return False
+        await self.adopt(userid, digest, bucket, staging)
+        return True
+
+    async def adopt(self, userid: str, digest: str, bucket: str, key: str):
+        """Moves a verified object under its hash.
+        """
+        from miniopy_async.commonconfig import CopySource
+
+        await self.ensure_bucket()
+        try:
+            await self.storage.copy_object(
+                *self.blob(userid, digest), CopySource(bucket, key))
+        finally:
+            await self.storage.remove_object(bucket, key)
+
+    async def link(self, userid: str, digest: str, entry: str) -> bool:
+        """Records a reference to the blob. Returns False, the reference
+        dropped, if the blob was deleted meanwhile.
+        """
+        await self.ensure_bucket()
+        await self.storage.put_object(
+            *self.ref(userid, digest, entry), io.BytesIO(b''), 0)
+        if await self.stat(userid, digest) is not None:
+            return True
+        await self.storage.remove_object(*self.ref(userid, digest, entry))
+        return False
+
+    async def references(self, userid: str, digest: str) -> int:
+        """Number of entries referencing the blob, for all users sharing
+        it.
+        """
+        bucket, prefix = self.location(userid)
+        refs = await self.storage.list_objects(
+            bucket, prefix=f'{prefix}refs/{digest}/', recursive=True)
+        return len(refs)
+
+    async def unlink(self, userid: str, digest: str, entry: str) -> bool:
+        """Drops a reference, and the blob along with its last one.
+        Returns whether the blob was deleted.
+        """
+        await self.storage.remove_object(*self.ref(userid, digest, entry))
+        if await self.references(userid, digest):
+            return False
+        return await self.collect(userid, digest)
+
+    async def collect(self, userid: str, digest: str) -> bool:
+        """Deletes a blob found without references. Returns False if it
+        was restored, an entry having linked it meanwhile.
+        """
+        from miniopy_async.commonconfig import CopySource
+        from miniopy_async.error import S3Error
+
+        bucket, key = self.blob(userid, digest)
+        _, prefix = self.location(userid)
+        tombstone = f'{prefix}tombstones/{digest}/{uuid.uuid4().hex}'
+        try:
+            await self.storage.copy_object(
+                bucket, tombstone, CopySource(bucket, key))
+        except S3Error as exc:
+            if exc.code != 'NoSuchKey':
+                raise
+            return True
+        try:
+            await self.storage.remove_object(bucket, key)
+            if not await self.references(userid, digest):
+                return True
+            await self.storage.copy_object(
+                bucket, key, CopySource(bucket, tombstone))
+            return False
+        finally:
+            await self.storage.remove_object(bucket, tombstone)
@@ -0,0 +1,449 @@
+"""
+Cache
+-----
+
+A cache of decoded tokens, bucket existence, folder summaries and
+certificates, with two backends:
+
+- `local`: an LRU in each worker process;
+- `shared`: one LRU per node, served by the main process over a unix
+  socket to all its workers, so an entry is computed and kept once
+  whatever the number of workers. Workers keep a small near cache of
+  what they read; writes and deletions are broadcast by the server so
+  that the other workers drop their copy.
+
+Keys are namespaced (`<namespace>:<key>`), each namespace with its own
+time to live. Values are Python objects, pickled by the shared backend:
+they must not be mutated once read or stored. The cache is best-effort:
+if the server cannot be reached, reads miss and writes are dropped.
+"""
+
+import asyncio
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import typing as t
+from collections import OrderedDict, deque
+from pathlib import Path
+from sanic import Blueprint
+from .metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+# Requests: operation, key length, value length, time to live.
+REQUEST = struct.Struct('!BHId')
+# Replies and broadcasts: kind, payload length, expiry timestamp.
+REPLY = struct.Struct('!BId')
+GET, SET, DELETE, CLEAR = 1, 2, 3, 4
+VALUE, NONE, OK, INVALIDATE, CLEARED = 1, 2, 3, 4, 5
+
+cache_requests = registry.counter(
+    'microfarm_cache_requests_total',
+    'Cache lookups, by namespace.',
+    labels=('namespace', 'outcome')
+)
+tiers: t.Dict[str, 'LRU'] = {}
+registry.gauge(
+    'microfarm_cache_entries',
+    'Entries held by the caches of this process.',
+    labels=('tier',),
+    collect=lambda: {tier: len(lru) for tier, lru in tiers.items()}
+)
+
+
+class LRU:
+    """Least recently used entries, bounded in number and size.
+    """
+
+    def __init__(self, max_entries: int = 10000,
+                 max_bytes: t.Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> t.Tuple[t.Any, float]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISSING, 0
+        expires, value, _ = entry
+        if expires <= time.time():
+            self.pop(key)
+            return MISSING, 0
+        self.entries.move_to_end(key)
+        return value, expires
+
+    def set(self, key: str, value: t.Any, expires: float, size: int = 0):
+        self.pop(key)
+        self.entries[key] = (expires, value, size)
+        self.size += size
+        while self.entries and (
+                len(self.entries) > self.max_entries or
+                (self.max_bytes is not None and self.size > self.max_bytes)):
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def pop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class Cache:
+
+    def __init__(self, ttls: t.Optional[t.Dict[str, float]] = None,
+                 default_ttl: float = 300):
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+
+    def ttl(self, key: str) -> float:
+        return self.ttls.get(key.split(':', 1)[0], self.default_ttl)
+
+    async def get(self, key: str, default: t.Any = None) -> t.Any:
+        value = await self.lookup(key)
+        namespace = key.split(':', 1)[0]
+        if value is MISSING:
+            cache_requests.inc(namespace, 'miss')
+            return default
+        cache_requests.inc(namespace, 'hit')
+        return value
+
+    async def set(self, key: str, value: t.Any,
+                  ttl: t.Optional[float] = None):
+        ttl = self.ttl(key) if ttl is None else min(ttl, self.ttl(key))
+        if ttl > 0:
+            await self.store(key, value, ttl)
+
+    async def delete(self, *keys: str):
+        await asyncio.gather(*(self.remove(key) for key in keys))
+
+    async def clear(self):
+        raise NotImplementedError()
+
+    async def lookup(self, key: str) -> t.Any:
+        raise NotImplementedError()
+
+    async def store(self, key: str, value: t.Any, ttl: float):
+        raise NotImplementedError()
+
+    async def remove(self, key: str):
+        raise NotImplementedError()
+
+    async def close(self):
+        pass
+
+
+class LocalCache(Cache):
+
+    def __init__(self, max_entries: int = 10000, **kwargs):
+        super().__init__(**kwargs)
+        self.lru = tiers['local'] = LRU(max_entries)
+
+    async def lookup(self, key: str) -> t.Any:
+        return self.lru.get(key)[0]
+
+    async def store(self, key: str, value: t.Any, ttl: float):
+        self.lru.set(key, value, time.time() + ttl)
+
+    async def remove(self, key: str):
+        self.lru.pop(key)
+
+    async def clear(self):
+        self.lru.clear()
+
+
+class CacheServer:
+    """Node-wide store, run by the main process in a thread of its own.
+    """
+
+    def __init__(self, path: Path, max_entries: int = 100000,
+                 max_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.lru = LRU(max_entries, max_bytes)
+        self.clients: t.Dict[asyncio.StreamWriter, asyncio.Task] = {}
+        self.ready = threading.Event()
+        self.thread: t.Optional[threading.Thread] = None
+        self.loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self.stopping: t.Optional[asyncio.Event] = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=asyncio.run, args=(self.serve(),),
+            name='cache-server', daemon=True
+        )
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            self.thread.join()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(self.handle, self.path)
+        os.chmod(self.path, 0o600)
+        self.ready.set()
+        async with server:
+            await self.stopping.wait()
+        handlers = list(self.clients.values())
+        for writer in list(self.clients):
+            writer.close()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        self.path.unlink(missing_ok=True)
+
+    def broadcast(self, key: bytes, sender: asyncio.StreamWriter,
+                  kind: int = INVALIDATE):
+        frame = REPLY.pack(kind, len(key), 0) + key
+        for writer in self.clients:
+            if writer is not sender:
+                writer.write(frame)
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter):
+        self.clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                header = await reader.readexactly(REQUEST.size)
+                op, key_length, value_length, ttl = REQUEST.unpack(header)
+                key = await reader.readexactly(key_length)
+                value = await reader.readexactly(value_length)
+                name = key.decode('utf-8')
+                if op == GET:
+                    data, expires = self.lru.get(name)
+                    if data is MISSING:
+                        writer.write(REPLY.pack(NONE, 0, 0))
+                    else:
+                        writer.write(
+                            REPLY.pack(VALUE, len(data), expires) + data)
+                elif op == SET:
+                    self.lru.set(name, value, time.time() + ttl, len(value))
+                    self.broadcast(key, writer)
+                    writer.write(REPLY.pack(OK, 0, 0))
+                elif op == DELETE:
+                    self.lru.pop(name)
+                    self.broadcast(key, writer)
+                    writer.write(REPLY.pack(OK, 0, 0))
+                elif op == CLEAR:
+                    self.lru.clear()
+                    self.broadcast(b'', writer, CLEARED)
+                    writer.write(REPLY.pack(OK, 0, 0))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.clients[writer]
+            writer.close()
+
+
+class SharedCache(Cache):
+
+    def __init__(self, path: Path, near_entries: int = 1024,
+                 retry: float = 1., **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.retry = retry
+        self.near = tiers['near'] = LRU(near_entries)
+        # Keys being fetched: [lookups in flight, invalidations since].
+        self.fetching: t.Dict[str, t.List[int]] = {}
+        # Counts the clearings of the near cache.
+        self.epoch = 0
+        self.reader: t.Optional[asyncio.StreamReader] = None
+        self.writer: t.Optional[asyncio.StreamWriter] = None
+        self.replies: t.Deque[asyncio.Future] = deque()
+        self.listener: t.Optional[asyncio.Task] = None
+        self.connecting = asyncio.Lock()
+        self.failed = 0.
+
+    async def connect(self) -> bool:
+        if self.writer is not None:
+            return True
+        async with self.connecting:
+            if self.writer is not None:
+                return True
+            if time.monotonic() - self.failed < self.retry:
+                return False
+            try:
+                self.reader, self.writer = \
+                    await asyncio.open_unix_connection(self.path)
+            except OSError as exc:
+                self.failed = time.monotonic()
+                logger.warning('Cache server is unreachable: %s', exc)
+                return False
+            self.listener = asyncio.create_task(self.listen())
+            return True
+
+    def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        self.failed = time.monotonic()
+        # Invalidations may have been missed.
+        self.forget_all()
+        while self.replies:
+            future = self.replies.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError('Cache server is gone.'))
+
+    async def listen(self):
+        reader = self.reader
+        try:
+            while True:
+                header = await reader.readexactly(REPLY.size)
+                kind, length, expires = REPLY.unpack(header)
+                payload = await reader.readexactly(length)
+                if kind == INVALIDATE:
+                    self.forget(payload.decode('utf-8'))
+                    continue
+                if kind == CLEARED:
+                    self.forget_all()
+                    continue
+                future = self.replies.popleft()
+                if not future.done():
+                    future.set_result((kind, payload, expires))
+        except (asyncio.IncompleteReadError, ConnectionError) as exc:
+            logger.warning('Lost the cache server: %s', exc)
+        if reader is self.reader:
+            self.disconnect()
+
+    def forget(self, key: str):
+        """Drops the near copy of a key, and any value of it being
+        fetched, which may predate the change.
+        """
+        self.near.pop(key)
+        fetch = self.fetching.get(key)
+        if fetch is not None:
+            fetch[1] += 1
+
+    def forget_all(self):
+        self.near.clear()
+        self.epoch += 1
+
+    async def request(self, op: int, key: str, value: bytes = b'',
+                      ttl: float = 0) -> t.Optional[tuple]:
+        if not await self.connect():
+            return None
+        name = key.encode('utf-8')
+        future = asyncio.get_running_loop().create_future()
+        self.replies.append(future)
+        try:
+            self.writer.write(
+                REQUEST.pack(op, len(name), len(value), ttl) + name + value)
+            await self.writer.drain()
+            return await future
+        except ConnectionError:
+            return None
+
+    async def lookup(self, key: str) -> t.Any:
+        value, _ = self.near.get(key)
+        if value is not MISSING:
+            return value
+        fetch = self.fetching.setdefault(key, [0, 0])
+        fetch[0] += 1
+        invalidations, epoch = fetch[1], self.epoch
+        try:
+            reply = await self.request(GET, key)
+        finally:
+            fetch[0] -= 1
+            if not fetch[0]:
+                del self.fetching[key]
+        if reply is None or reply[0] != VALUE:
+            return MISSING
+        _, data, expires = reply
+        value = pickle.loads(data)
+        # Invalidations are handled before the lookup resumes: a value
+        # changed meanwhile is returned, but not kept.
+        if fetch[1] == invalidations and self.epoch == epoch:
+            self.near.set(key, value, expires)
+        return value
+
+    async def store(self, key: str, value: t.Any, ttl: float):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.forget(key)
+        self.near.set(key, value, time.time() + ttl)
+        await self.request(SET, key, data, ttl)
+
+    async def remove(self, key: str):
+        self.forget(key)
+        await self.request(DELETE, key)
+
+    async def clear(self):
+        self.forget_all()
+        await self.request(CLEAR, '')
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        self.disconnect()
+
+
+caches = Blueprint('cache')
+
+
+def cache_server(config: dict) -> CacheServer:
+    return CacheServer(
+        Path(config['socket']),
+        max_entries=config.get('max_entries', 100000),
+        max_bytes=config.get('max_bytes', 64 * 1024 * 1024)
+    )
+
+
+@caches.listener("main_process_start")
+async def start_cache_server(app):
+    if app.config.CACHE.get('backend') == 'shared':
+        app.ctx.cache_server = cache_server(app.config.CACHE)
+        app.ctx.cache_server.start()
+
+
+@caches.listener("main_process_stop")
+async def stop_cache_server(app):
+    if getattr(app.ctx, 'cache_server', None) is not None:
+        app.ctx.cache_server.stop()
+
+
+@caches.listener("before_server_start")
+async def setup_cache(app):
+    config = app.config.CACHE
+    backend = config.get('backend', 'local')
+    options = {
+        'ttls': config.get('ttls'),
+        'default_ttl': config.get('default_ttl', 300),
+    }
+    if backend == 'local':
+        app.ctx.cache = LocalCache(
+            max_entries=config.get('max_entries', 10000), **options)
+    elif backend == 'shared':
+        if not os.environ.get('SANIC_WORKER_NAME'):
+            # Single process: there is no main process to serve it.
+            app.ctx.cache_server = cache_server(config)
+            app.ctx.cache_server.start()
+        app.ctx.cache = SharedCache(
+            Path(config['socket']),
+            near_entries=config.get('near_entries', 1024),
+            **options
+        )
+    else:
+        raise ValueError(f'Unknown cache backend {backend!r}.')
+
+
+@caches.listener("after_server_stop")
+async def close_cache(app):
+    await app.ctx.cache.close()
+    if getattr(app.ctx, 'cache_server', None) is not None:
+        app.ctx.cache_server.stop()
@@ -1,24 +1,28 @@
 import uuid
+import asyncio
 import pydantic
 import typing as t
 from sanic.response import json, raw, empty
-from sanic_ext import validate, openapi
+from sanic_ext import validate, openapi, cors
 from sanic import Blueprint
-from cryptography import x509
-from cryptography.x509 import ocsp, load_pem_x509_certificates
-from functools import cached_property
-from cryptography.hazmat.primitives import hashes, serialization
+from functools import cached_property, lru_cache
 from .rpc import RPCUnavailableError
-from .validation import validate_json, validation_errors_definition
+from .jobs import job_status
+from .validation import (
+    validate_json, validation_errors_definition, lazy_schema)
 
 
 routes = Blueprint('certificate')
 
 
-reverse_oid_lookup = {
-    v: k for k, v in vars(x509.oid.NameOID).items()
-    if not k.startswith('_')
-}
+@lru_cache(maxsize=None)
+def reverse_oid_lookup():
+    from cryptography import x509
+
+    return {
+        v: k for k, v in vars(x509.oid.NameOID).items()
+        if not k.startswith('_')
+    }
 
 
 class FieldOrdering(pydantic.BaseModel):
@@ -33,7 +37,14 @@ class CertificatesListing(pydantic.BaseModel):
 
 
 class RevocationRequest(pydantic.BaseModel):
-    reason: x509.ReasonFlags
+    # Values of `cryptography.x509.ReasonFlags`, spelled out to avoid
+    # importing `cryptography.x509` with this module.
+    reason: t.Literal[
+        'unspecified', 'keyCompromise', 'cACompromise',
+        'affiliationChanged', 'superseded', 'cessationOfOperation',
+        'certificateHold', 'privilegeWithdrawn', 'aACompromise',
+        'removeFromCRL'
+    ]
 
 
 class CertificateRequestResponse(pydantic.BaseModel):
@@ -76,7 +87,9 @@ class Identity(pydantic.BaseModel):
     x500_unique_identifier : t.Optional[str] = None
 
     @cached_property
-    def x509_name(self) -> x509.Name:
+    def x509_name(self) -> 'x509.Name':
+        from cryptography import x509
+
         return x509.Name([
             x509.NameAttribute(
                 getattr(x509.oid.NameOID, name.upper()),
@@ -92,45 +105,100 @@ class Identity(pydantic.BaseModel):
 
     @classmethod
     def from_rfc4514_string(cls, value: str):
+        from cryptography import x509
+
+        lookup = reverse_oid_lookup()
         name = x509.Name.from_rfc4514_string(value)
         values = {
-            reverse_oid_lookup[attr.oid].lower(): attr.value
+            lookup[attr.oid].lower(): attr.value
             for attr in name
-            if attr.oid in reverse_oid_lookup
+            if attr.oid in lookup
         }
         return cls(**values)
 
 
+async def certificate_pem_data(app, userid: str,
+                               serial_number: str) -> t.Optional[bytes]:
+    """PEM chain of a certificate of the user, None if unknown.
+    Certificates never change once issued: they are cached.
+    """
+    key = f'certificate:{userid}:{serial_number}'
+    pem = await app.ctx.cache.get(key)
+    if pem is None:
+        async with app.ctx.pki() as service:
+            data = await service.get_certificate_pem(userid, serial_number)
+        if data['code'] == 404:
+            return None
+        if data['code'] != 200:
+            raise NotImplementedError(f'Unknown response type: {data}')
+        pem = data['body']
+        await app.ctx.cache.set(key, pem)
+    return pem
+
+
 @routes.post("/certificates/new")
 @openapi.definition(
     secured="token",
-    body={'application/json': Identity.schema()},
+    body={'application/json': lazy_schema(Identity)},
     response=[
         openapi.definitions.Response(
-            {"application/json" : CertificateRequestResponse.schema()},
-            status=200
+            {"application/json" : lazy_schema(CertificateRequestResponse)},
+            status=202
         ),
         openapi.definitions.Response(
             {"application/json" : validation_errors_definition},
             status=422
         ),
         openapi.definitions.Response(
-            {"application/json" : RPCUnavailableError.schema()},
+            {"application/json" : lazy_schema(RPCUnavailableError)},
             status=503
         )
     ]
 )
+@cors(allow_headers=['Authorization', 'Content-Type', 'Idempotency-Key'])
 @validate_json(Identity)
 async def new_certificate(request, body: Identity):
-    async with request.app.ctx.pki() as service:
-        data = await service.generate_certificate(
-            request.ctx.user.id,
-            body.rfc4514_string
+    user = request.ctx.user
+    app = request.app
+
+    async def generate(job: dict, progress):
+        async with app.ctx.pki() as service:
+            data = await service.generate_certificate(
+                user.id,
+                body.rfc4514_string
+            )
+        if data['code'] == 201:
+            app.ctx.events.publish(
+                user.email, 'certificate.created', job['id'])
+            return data['body']
+
+        raise NotImplementedError(f'Unknown response type: {data}')
+
+    idempotency_key = request.headers.get('idempotency-key')
+    try:
+        job, _ = await app.ctx.jobs.enqueue(
+            'certificate', user.id, generate,
+            dedup=(
+                f'certificate:{user.id}:{idempotency_key}'
+                if idempotency_key else None
+            )
         )
-    if data['code'] == 201:
-        return json(status=201, body=data['body'])
+    except asyncio.QueueFull:
+        return empty(status=503)
 
-    raise NotImplementedError(f'Unknown response type: {data}')
+    return json(status=202, body={'request': job['id']})
+
+
+@routes.get("/certificates/requests/<request_id:uuid>")
+@openapi.definition(
+    secured="token",
+)
+async def certificate_request_status(request, request_id: uuid.UUID):
+    job = await request.app.ctx.jobs.store.get(str(request_id))
+    if job is None or job['kind'] != 'certificate' \
+       or job['owner'] != request.ctx.user.id:
+        return empty(status=404)
+    return json(body=job_status(job))
 
 
 @routes.post("/certificates")
@@ -196,19 +264,12 @@ async def view_certificate(request, serial_number: str):
     secured="token",
 )
 async def certificate_pem(request, serial_number: str):
-    async with request.app.ctx.pki() as service:
-        data = await service.get_certificate_pem(
-            request.ctx.user.id, serial_number)
-
-    if data['code'] == 404:
+    pem = await certificate_pem_data(
+        request.app, request.ctx.user.id, serial_number)
+    if pem is None:
         return empty(status=403)
 
-    elif data['code'] == 200:
-        return raw(
-            data['body'],
-            headers={'Content-Type': 'application/x-pem-file'})
-
-    raise NotImplementedError(f'Unknown response type: {data}')
+    return raw(pem, headers={'Content-Type': 'application/x-pem-file'})
 
 
 @routes.get("/certificates/<serial_number:str>/status")
@@ -216,11 +277,15 @@ async def certificate_pem(request, serial_number: str):
     secured="token",
 )
 async def certificate_status(request, serial_number: str):
-    async with request.app.ctx.pki() as service:
-        data = await service.get_certificate_pem(
-            request.ctx.user.id, serial_number)
+    from cryptography.x509 import ocsp, load_pem_x509_certificates
+    from cryptography.hazmat.primitives import hashes, serialization
+
+    pem = await certificate_pem_data(
+        request.app, request.ctx.user.id, serial_number)
+    if pem is None:
+        return empty(status=403)
 
-    certs = load_pem_x509_certificates(data['body'])
+    certs = load_pem_x509_certificates(pem)
     builder = ocsp.OCSPRequestBuilder()
     builder = builder.add_certificate(certs[0], certs[1], hashes.SHA256())
     req = builder.build()
@@ -0,0 +1,158 @@
+"""
+Response compression
+--------------------
+
+Responses of compressible types above `min_size` bytes are compressed
+with the encoding the client prefers among those available: gzip, and
+zstd or brotli when `zstandard` or `brotli` are installed. Compression
+runs in a small thread pool, off the event loop.
+
+Immutable payloads (manifests, summaries of signed folders) are
+compressed once, when they are written, and stored as artifacts that
+handlers serve as they are.
+"""
+
+import asyncio
+import gzip
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from sanic import Blueprint
+from .metrics import registry
+
+
+EXTENSIONS = {'zstd': 'zst', 'br': 'br', 'gzip': 'gz'}
+COMPRESSIBLE = {
+    'application/json',
+    'application/msgpack',
+    'application/toml',
+    'application/xml',
+    'application/x-pem-file',
+}
+
+compressed_bytes = registry.counter(
+    'microfarm_compression_bytes_total',
+    'Bytes of responses before and after compression.',
+    labels=('encoding', 'stage')
+)
+
+
+@lru_cache(maxsize=None)
+def available_codecs() -> t.Dict[str, t.Callable[[bytes, int], bytes]]:
+    codecs = {}
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        codecs['zstd'] = lambda data, level: \
+            zstandard.ZstdCompressor(level=level).compress(data)
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        codecs['br'] = lambda data, level: \
+            brotli.compress(data, quality=level)
+    codecs['gzip'] = lambda data, level: \
+        gzip.compress(data, compresslevel=level, mtime=0)
+    return codecs
+
+
+def accepted(header: t.Optional[str]) -> t.Dict[str, float]:
+    """Quality values of an Accept-Encoding header.
+    """
+    qualities = {}
+    for item in (header or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if not coding:
+            continue
+        quality = 1.
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        qualities[coding.strip().lower()] = quality
+    return qualities
+
+
+class Compressor:
+
+    def __init__(self, encodings: t.Sequence[str] = ('zstd', 'br', 'gzip'),
+                 levels: t.Optional[t.Dict[str, int]] = None,
+                 min_size: int = 1024, workers: int = 2):
+        codecs = available_codecs()
+        self.encodings = [name for name in encodings if name in codecs]
+        self.levels = {'zstd': 3, 'br': 5, 'gzip': 6, **(levels or {})}
+        self.min_size = min_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='compression')
+
+    def negotiate(self, header: t.Optional[str]) -> t.Optional[str]:
+        """Preferred available encoding, None for the identity.
+        """
+        qualities = accepted(header)
+        best, best_quality = None, 0.
+        for name in self.encodings:
+            quality = qualities.get(name, qualities.get('*', 0.))
+            if quality > best_quality:
+                best, best_quality = name, quality
+        return best
+
+    async def compress(self, data: bytes, encoding: str) -> bytes:
+        codec = available_codecs()[encoding]
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, codec, data, self.levels[encoding])
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def compressible(content_type: t.Optional[str]) -> bool:
+    media_type = (content_type or '').split(';', 1)[0].strip().lower()
+    return media_type.startswith('text/') or media_type in COMPRESSIBLE
+
+
+async def compress_response(request, response):
+    compressor = getattr(request.app.ctx, 'compressor', None)
+    if compressor is None or response.status != 200:
+        return
+    body = response.body
+    if not body or len(body) < compressor.min_size:
+        return
+    if 'content-encoding' in response.headers or \
+       not compressible(response.content_type):
+        return
+    response.headers.add('Vary', 'Accept-Encoding')
+    encoding = compressor.negotiate(request.headers.get('accept-encoding'))
+    if encoding is None:
+        return
+    response.body = await compressor.compress(body, encoding)
+    response.headers['Content-Encoding'] = encoding
+    compressed_bytes.inc(encoding, 'in', amount=len(body))
+    compressed_bytes.inc(encoding, 'out', amount=len(response.body))
+
+
+compression = Blueprint('compression')
+
+
+@compression.listener("before_server_start")
+async def setup_compression(app):
+    config = app.config.COMPRESSION
+    app.ctx.compressor = None
+    if config.get('enabled', True):
+        app.ctx.compressor = Compressor(
+            encodings=config.get('encodings', ('zstd', 'br', 'gzip')),
+            levels=config.get('levels'),
+            min_size=config.get('min_size', 1024),
+            workers=config.get('workers', 2)
+        )
+
+
+@compression.listener("after_server_stop")
+async def close_compression(app):
+    if app.ctx.compressor is not None:
+        app.ctx.compressor.close()
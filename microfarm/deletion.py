@@ -0,0 +1,295 @@
+"""
+Deletion
+--------
+
+  DELETE /folders/delete/<folder_id>/<file_id>   deletes one file
+  DELETE /folders/delete/<folder_id>             deletes a folder (job)
+  POST   /folders/delete                         deletes several (jobs)
+
+Locked and signed folders are immutable: they, and their files, cannot
+be deleted (409). Each folder is deleted by a job of its own, exclusive
+with the lock and sign jobs of the folder (409 while one is running);
+files cannot be deleted while any of these jobs is pending or running.
+
+Folders are deleted with the S3 multi-object delete API, in batches of
+`BATCH_SIZE` keys, `concurrency` batches at a time. Files come first,
+then stored artifacts, and the folder marker last: a folder that could
+not be entirely deleted is still listed, and can be deleted again.
+The references of deduplicated files are dropped along, and the blobs
+with their last reference, unless linked again meanwhile.
+"""
+
+import asyncio
+import typing as t
+import pydantic
+from sanic import Blueprint
+from sanic.response import json, empty
+from sanic_ext import openapi
+from .jobs import JobError
+from .metrics import registry
+from .storage import (
+    enqueue_folder_job, folder_changed, folder_job, folder_job_key,
+    folder_state, list_entries, stat_entry)
+from .validation import validate_json
+
+
+BATCH_SIZE = 1000
+
+deletion = Blueprint('deletion')
+
+deleted_objects = registry.counter(
+    'microfarm_deleted_objects_total',
+    'Objects removed by deletion requests, by outcome.',
+    labels=('outcome',)
+)
+
+
+class FoldersDeletion(pydantic.BaseModel):
+    folders: t.List[str]
+
+
+async def remove_keys(
+        storage, bucket: str, keys: t.Sequence[str],
+        semaphore: asyncio.Semaphore,
+        progress: t.Optional[t.Callable[[int], t.Awaitable]] = None
+) -> t.List[t.Any]:
+    """Deletes keys in batches, returns the errors.
+    """
+    from miniopy_async.deleteobjects import DeleteObject
+
+    async def remove(batch: t.Sequence[str]):
+        # The client sends a single request for any number of keys, but
+        # only deletes the first 1000 of them: batches are split here.
+        async with semaphore:
+            errors = await storage.remove_objects(
+                bucket, [DeleteObject(key) for key in batch])
+        errors = list(errors)
+        deleted_objects.inc('deleted', amount=len(batch) - len(errors))
+        if errors:
+            deleted_objects.inc('failed', amount=len(errors))
+        if progress is not None:
+            await progress(len(batch))
+        return errors
+
+    results = await asyncio.gather(*(
+        remove(keys[start:start + BATCH_SIZE])
+        for start in range(0, len(keys), BATCH_SIZE)
+    ))
+    return [error for errors in results for error in errors]
+
+
+async def release_blobs(storage, blobs, userid: str,
+                        links: t.Sequence[t.Tuple[str, str]],
+                        semaphore: asyncio.Semaphore) -> t.List[t.Any]:
+    """Drops the references of deleted entries, given as (digest, entry)
+    pairs, and the blobs along with their last one.
+    """
+    from miniopy_async.error import S3Error
+
+    refs: t.Dict[str, t.List[str]] = {}
+    for digest, entry in links:
+        bucket, key = blobs.ref(userid, digest, entry)
+        refs.setdefault(bucket, []).append(key)
+    errors = []
+    for bucket, keys in refs.items():
+        errors.extend(await remove_keys(storage, bucket, keys, semaphore))
+
+    async def collect(digest: str):
+        # Blobs are deleted one by one, to be restored if linked meanwhile.
+        async with semaphore:
+            if await blobs.references(userid, digest):
+                return
+            try:
+                if await blobs.collect(userid, digest):
+                    deleted_objects.inc('deleted')
+            except S3Error as exc:
+                deleted_objects.inc('failed')
+                errors.append(exc)
+
+    await asyncio.gather(*(collect(digest) for digest in {
+        digest for digest, _ in links}))
+    return errors
+
+
+async def remove_folder(storage, layout, blobs, userid: str,
+                        folder_id: str, semaphore: asyncio.Semaphore,
+                        progress=None) -> int:
+    """Deletes every object of a folder, returns their number.
+    """
+    bucket, root = layout.location(userid)
+    marker = f'{folder_id}/'
+    entries = [
+        entry for entry in await list_entries(
+            storage, layout, userid, prefix=marker, recursive=True)
+        if entry.name != marker
+    ]
+    artifacts = await storage.list_objects(
+        bucket, prefix=f'{root}.artifacts/{folder_id}/', recursive=True)
+    keys = [root + entry.name for entry in entries]
+    keys.extend(obj.object_name for obj in artifacts)
+    total = len(keys) + 1
+    done = 0
+
+    async def advance(count: int):
+        nonlocal done
+        done += count
+        if progress is not None:
+            await progress(done / total)
+
+    errors = await remove_keys(storage, bucket, keys, semaphore, advance)
+    links = [
+        (entry.metadata['x-amz-meta-blob'], entry.name) for entry in entries
+        if 'x-amz-meta-blob' in entry.metadata
+    ]
+    if links and blobs is not None:
+        errors.extend(await release_blobs(
+            storage, blobs, userid, links, semaphore))
+    if errors:
+        raise JobError(f'{len(errors)} objects could not be deleted.')
+    errors = await remove_keys(
+        storage, bucket, [root + marker], semaphore, advance)
+    if errors:
+        raise JobError('The folder could not be deleted.')
+    return total
+
+
+async def check_folders(request, folder_ids: t.List[str]):
+    """Response refusing the deletion of the folders, if any.
+    """
+    user = request.ctx.user
+    storage = request.app.ctx.minio
+    layout = request.app.ctx.layout
+
+    if not await layout.exists(user.id):
+        return empty(status=404)
+    states = await asyncio.gather(*(
+        folder_state(storage, layout, user.id, folder_id)
+        for folder_id in folder_ids
+    ))
+    missing = [
+        folder_id for folder_id, state in zip(folder_ids, states)
+        if state is None
+    ]
+    if missing:
+        return json(status=404, body={'missing': missing})
+    locked = [
+        folder_id for folder_id, state in zip(folder_ids, states) if state
+    ]
+    if locked:
+        return json(status=409, body={'locked': locked})
+    return None
+
+
+def deletion_job(request, folder_id: str, semaphore: asyncio.Semaphore):
+    user = request.ctx.user
+    app = request.app
+    storage = app.ctx.minio
+    layout = app.ctx.layout
+
+    async def run(job: dict, progress):
+        # The folder may have been locked since the request.
+        if await folder_state(storage, layout, user.id, folder_id):
+            raise JobError(f'The folder {folder_id} is locked.')
+        deleted = await remove_folder(
+            storage, layout, app.ctx.blobs, user.id, folder_id,
+            semaphore, progress=progress
+        )
+        await folder_changed(app, user, folder_id, 'folder.deleted')
+        return {'deleted': deleted}
+
+    return run
+
+
+def deletion_semaphore(request) -> asyncio.Semaphore:
+    return asyncio.Semaphore(
+        request.app.config.DELETION.get('concurrency', 4))
+
+
+@deletion.delete("/folders/delete/<folder_id:str>")
+@openapi.definition(
+    secured="token",
+)
+async def delete_folder(request, folder_id: str):
+    refused = await check_folders(request, [folder_id])
+    if refused is not None:
+        return refused
+    return await folder_job(
+        request, 'folder.delete', folder_id,
+        deletion_job(request, folder_id, deletion_semaphore(request))
+    )
+
+
+@deletion.post("/folders/delete")
+@openapi.definition(
+    secured="token",
+)
+@validate_json(FoldersDeletion)
+async def delete_folders(request, body: FoldersDeletion):
+    folder_ids = sorted(set(body.folders))
+    if not folder_ids:
+        return empty(status=400)
+    if len(folder_ids) > request.app.config.DELETION.get('max_folders', 100):
+        return empty(status=413)
+    refused = await check_folders(request, folder_ids)
+    if refused is not None:
+        return refused
+
+    # One job per folder, exclusive with the other jobs on it.
+    semaphore = deletion_semaphore(request)
+    requests = {}
+    busy = []
+    for folder_id in folder_ids:
+        try:
+            job = await enqueue_folder_job(
+                request, 'folder.delete', folder_id,
+                deletion_job(request, folder_id, semaphore)
+            )
+        except asyncio.QueueFull:
+            return json(status=503, body={'requests': requests})
+        if job is None:
+            busy.append(folder_id)
+        else:
+            requests[folder_id] = job['id']
+    if not requests:
+        return json(status=409, body={'busy': busy})
+    return json(status=202, body={'requests': requests, 'busy': busy})
+
+
+@deletion.delete("/folders/delete/<folder_id:str>/<file_id:str>")
+@openapi.definition(
+    secured="token",
+)
+async def delete_file(request, folder_id: str, file_id: str):
+    from miniopy_async.error import S3Error
+
+    user = request.ctx.user
+    app = request.app
+    storage = app.ctx.minio
+    layout = app.ctx.layout
+
+    if not await layout.exists(user.id):
+        return empty(status=404)
+    state = await folder_state(storage, layout, user.id, folder_id)
+    if state is None:
+        return empty(status=404)
+    if state:
+        return empty(status=409)
+    # Locked, signed or deleted meanwhile: wait for the job to end.
+    if await app.ctx.jobs.store.active(
+            folder_job_key(user.id, folder_id)) is not None:
+        return empty(status=409)
+
+    name = f'{folder_id}/{file_id}'
+    try:
+        entry = await stat_entry(storage, layout, user.id, name)
+    except S3Error as exc:
+        if exc.code != 'NoSuchKey':
+            raise
+        return empty(status=404)
+    await storage.remove_object(*layout.key(user.id, name))
+    deleted_objects.inc('deleted')
+    digest = entry.metadata.get('x-amz-meta-blob')
+    if digest is not None and app.ctx.blobs is not None:
+        await app.ctx.blobs.unlink(user.id, digest, name)
+    await folder_changed(app, user, folder_id)
+    return empty(status=204)
@@ -0,0 +1,134 @@
+"""
+Change events
+-------------
+
+Mutating handlers publish compact change events to the user's channel
+of the websockets service, so clients do not have to poll. Events are
+coalesced per channel: events of the same type about the same object
+merge into one (with a `count`), and a batch is delivered once the
+channel has been quiet for `debounce` seconds, or at the latest
+`max_delay` seconds after its first event.
+
+Messages are JSON: {"events": [{"type": "folder.updated",
+"folder": "<id>", "count": 3}, ...]}
+"""
+
+import asyncio
+import logging
+import orjson
+import typing as t
+from sanic import Blueprint
+from .metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+events_published = registry.counter(
+    'microfarm_events_published_total',
+    'Change events published by handlers.',
+    labels=('type',)
+)
+events_delivered = registry.counter(
+    'microfarm_events_messages_total',
+    'Coalesced event messages sent to the websockets service.',
+    labels=('outcome',)
+)
+
+
+class Batch:
+    __slots__ = ('events', 'first', 'last')
+
+    def __init__(self, now: float):
+        self.events: t.Dict[tuple, dict] = {}
+        self.first = self.last = now
+
+
+class Notifier:
+
+    def __init__(self, service, debounce: float = .5, max_delay: float = 2.,
+                 enabled: bool = True):
+        self.service = service
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.enabled = enabled
+        self.pending: t.Dict[str, Batch] = {}
+        self.tasks: t.Set[asyncio.Task] = set()
+
+    def publish(self, channel: str, kind: str, subject: t.Optional[str] = None,
+                **data):
+        if not self.enabled:
+            return
+        events_published.inc(kind)
+        loop = asyncio.get_running_loop()
+        batch = self.pending.get(channel)
+        if batch is None:
+            batch = self.pending[channel] = Batch(loop.time())
+            task = loop.create_task(self.deliver(channel))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        batch.last = loop.time()
+
+        event = batch.events.get((kind, subject))
+        if event is None:
+            event = batch.events[(kind, subject)] = {'type': kind, 'count': 0}
+            if subject is not None:
+                event[kind.split('.', 1)[0]] = subject
+        event.update(data)
+        event['count'] += 1
+
+    async def deliver(self, channel: str):
+        loop = asyncio.get_running_loop()
+        batch = self.pending[channel]
+        while True:
+            now = loop.time()
+            wait = min(
+                batch.last + self.debounce, batch.first + self.max_delay
+            ) - now
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+
+        del self.pending[channel]
+        await self.send(channel, list(batch.events.values()))
+
+    async def send(self, channel: str, events: t.List[dict]):
+        message = orjson.dumps({'events': events}).decode('utf-8')
+        try:
+            async with self.service() as service:
+                await service.send_message(channel, message)
+        except Exception as exc:
+            # Pushing is best-effort: clients catch up on their next read.
+            events_delivered.inc('failed')
+            logger.warning('Could not push events to %s: %s', channel, exc)
+        else:
+            events_delivered.inc('sent')
+
+    async def close(self):
+        """Delivers the pending batches right away.
+        """
+        for task in list(self.tasks):
+            task.cancel()
+        pending, self.pending = self.pending, {}
+        await asyncio.gather(*(
+            self.send(channel, list(batch.events.values()))
+            for channel, batch in pending.items()
+        ))
+
+
+events = Blueprint('events')
+
+
+@events.listener("before_server_start")
+async def setup_events(app):
+    config = app.config.EVENTS
+    app.ctx.events = Notifier(
+        app.ctx.websockets,
+        debounce=config.get('debounce', .5),
+        max_delay=config.get('max_delay', 2.),
+        enabled=config.get('enabled', True)
+    )
+
+
+@events.listener("before_server_stop")
+async def flush_events(app):
+    await app.ctx.events.close()
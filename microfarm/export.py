@@ -0,0 +1,181 @@
+"""
+Folder export
+-------------
+
+`GET /folders/export/<folder_id>` streams a ZIP archive of every file of
+a folder, manifest and signature included. Members are either stored
+(`?compression=store`, the default) or deflated (`?compression=deflate`).
+
+The archive is written straight to the response: zipfile writes to an
+unseekable buffer that is flushed after each chunk. Files are fetched
+from MinIO `read_ahead` at a time, each keeping at most `buffered`
+chunks in memory while it waits for its turn.
+"""
+
+import asyncio
+import io
+import zipfile
+import typing as t
+from collections import deque
+from pathlib import PurePosixPath
+from sanic import Blueprint
+from sanic.response import empty, raw
+from sanic_ext import openapi
+from .metrics import registry
+from .storage import EOF, list_entries
+
+
+exports = Blueprint('export')
+
+COMPRESSIONS = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+}
+
+exported_bytes = registry.counter(
+    'microfarm_export_bytes_total',
+    'Bytes of ZIP archives streamed to clients.',
+)
+
+
+class ZipBuffer(io.RawIOBase):
+    """Unseekable file collecting what zipfile writes, until drained.
+    """
+
+    def __init__(self):
+        self.chunks: t.List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def member_names(entries) -> t.List[str]:
+    """Archive names of the entries: their file names, made unique.
+    """
+    names, seen = [], set()
+    for entry in entries:
+        name = entry.metadata.get('x-amz-meta-filename') or entry.name
+        path = PurePosixPath(name.replace('\\', '/')).name
+        if path in ('', '..'):
+            path = 'file'
+        candidate, index = path, 1
+        while candidate in seen:
+            index += 1
+            stem, suffix = PurePosixPath(path).stem, PurePosixPath(path).suffix
+            candidate = f'{stem} ({index}){suffix}'
+        seen.add(candidate)
+        names.append(candidate)
+    return names
+
+
+async def fetch(storage, session, bucket: str, key: str,
+                queue: asyncio.Queue, chunk_size: int):
+    try:
+        resp = await storage.get_object(bucket, key, session=session)
+        async for chunk in resp.content.iter_chunked(chunk_size):
+            await queue.put(chunk)
+        await queue.put(EOF)
+    except Exception as exc:
+        await queue.put(exc)
+
+
+@exports.get("/folders/export/<folder_id:str>")
+@openapi.definition(
+    secured="token",
+)
+async def export_folder(request, folder_id: str):
+    import aiohttp
+
+    userid = request.ctx.user.id
+    app = request.app
+    storage = app.ctx.minio
+    layout = app.ctx.layout
+    config = app.config.EXPORT
+
+    compression = COMPRESSIONS.get(request.args.get('compression', 'store'))
+    if compression is None:
+        return raw(status=400, body="Unknown compression.")
+    if not await layout.exists(userid):
+        return empty(status=404)
+
+    marker = f'{folder_id}/'
+    entries = await list_entries(storage, layout, userid, prefix=marker)
+    if not entries or entries[0].name != marker:
+        return empty(status=404)
+    entries = entries[1:]
+
+    response = await request.respond(
+        content_type='application/zip',
+        headers={
+            'Content-Disposition': f'attachment; filename="{folder_id}.zip"'
+        }
+    )
+    buffer = ZipBuffer()
+    pending = deque()
+    fetching = set()
+    members = iter(zip(member_names(entries), entries))
+
+    async with aiohttp.ClientSession() as session:
+
+        def prefetch():
+            while len(pending) < config['read_ahead']:
+                member = next(members, None)
+                if member is None:
+                    return
+                queue = asyncio.Queue(maxsize=config['buffered'])
+                bucket, key = member[1].location(
+                    layout, userid, app.ctx.blobs)
+                task = asyncio.create_task(fetch(
+                    storage, session, bucket, key,
+                    queue, config['chunk_size']
+                ))
+                fetching.add(task)
+                task.add_done_callback(fetching.discard)
+                pending.append((member, queue, task))
+
+        async def send():
+            data = buffer.drain()
+            if data:
+                exported_bytes.inc(amount=len(data))
+                await response.send(data)
+
+        try:
+            with zipfile.ZipFile(buffer, 'w', compression=compression) as archive:
+                prefetch()
+                while pending:
+                    (name, entry), queue, _ = pending.popleft()
+                    prefetch()
+                    info = zipfile.ZipInfo(
+                        name, date_time=entry.modified.timetuple()[:6])
+                    info.compress_type = compression
+                    info.file_size = entry.content_size
+                    with archive.open(
+                            info, 'w',
+                            force_zip64=info.file_size > zipfile.ZIP64_LIMIT // 2
+                    ) as member:
+                        while (chunk := await queue.get()) is not EOF:
+                            if isinstance(chunk, Exception):
+                                raise chunk
+                            if compression == zipfile.ZIP_DEFLATED:
+                                await asyncio.to_thread(member.write, chunk)
+                            else:
+                                member.write(chunk)
+                            await send()
+                    await send()
+            await send()
+        finally:
+            # Including the fetch of the member being written.
+            for task in fetching:
+                task.cancel()
+            await asyncio.gather(*fetching, return_exceptions=True)
+
+    await response.eof()
@@ -0,0 +1,125 @@
+"""
+Wire formats
+------------
+
+HTTP dates are read and written in the IMF-fixdate format only
+(`Sun, 06 Nov 1994 08:49:37 GMT`), the one S3 servers send, by slicing
+instead of a general-purpose parser. The obsolete RFC 850 and asctime
+formats fall back to `email.utils`. Objects of a folder mostly share a
+handful of timestamps: both directions are memoized.
+
+Folder summaries are rendered as TOML (the original format), JSON or
+MessagePack, as negotiated through the `Accept` header. TOML is sent
+when no format is acceptable, unless it is explicitly refused.
+"""
+
+import orjson
+import typing as t
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+
+DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+MONTH_NUMBERS = {name: number for number, name in enumerate(MONTHS, 1)}
+
+
+def parse_http_date(value: str) -> datetime:
+    """Aware datetime of an HTTP date. Raises ValueError if invalid.
+    """
+    if len(value) == 29 and value.endswith(' GMT'):
+        try:
+            return datetime(
+                int(value[12:16]), MONTH_NUMBERS[value[8:11]],
+                int(value[5:7]), int(value[17:19]), int(value[20:22]),
+                int(value[23:25]), tzinfo=timezone.utc
+            )
+        except (KeyError, ValueError):
+            pass
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, IndexError) as exc:
+        raise ValueError(f'Invalid HTTP date {value!r}.') from exc
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def format_http_date(value: datetime) -> str:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    elif value.utcoffset():
+        value = value.astimezone(timezone.utc)
+    return (
+        f'{DAYS[value.weekday()]}, {value.day:02d} '
+        f'{MONTHS[value.month - 1]} {value.year:04d} '
+        f'{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT'
+    )
+
+
+# Datetimes are immutable: memoized values can be shared.
+http_date = lru_cache(maxsize=4096)(parse_http_date)
+http_date_string = lru_cache(maxsize=4096)(format_http_date)
+
+
+def dump_toml(data: dict) -> bytes:
+    import toml
+    return toml.dumps(data).encode('utf-8')
+
+
+def dump_msgpack(data: dict) -> bytes:
+    import msgpack
+
+    def default(value):
+        if isinstance(value, datetime):
+            # As strings, like in JSON: no extension type to decode.
+            return value.isoformat()
+        raise TypeError(f'Cannot serialize {type(value).__name__}.')
+
+    return msgpack.packb(data, default=default)
+
+
+SUMMARY_FORMATS: t.Dict[str, t.Callable[[dict], bytes]] = {
+    'application/toml': dump_toml,
+    'application/json': orjson.dumps,
+    'application/msgpack': dump_msgpack,
+}
+ALIASES = {
+    'application/x-msgpack': 'application/msgpack',
+    'application/vnd.msgpack': 'application/msgpack',
+}
+
+
+def negotiate_format(header: t.Optional[str],
+                     formats: t.Sequence[str]) -> t.Optional[str]:
+    """Preferred media type among `formats`, the first one being the
+    default: it is also returned when none is acceptable, unless it is
+    refused (q=0). None then.
+    """
+    if not header:
+        return formats[0]
+    qualities = {}
+    for item in header.split(','):
+        media_type, _, params = item.strip().partition(';')
+        media_type = media_type.strip().lower()
+        quality = 1.
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        qualities[ALIASES.get(media_type, media_type)] = quality
+    wildcard = qualities.get('application/*', qualities.get('*/*'))
+    best, best_quality = None, 0.
+    for media_type in formats:
+        quality = qualities.get(media_type, wildcard or 0.)
+        if quality > best_quality:
+            best, best_quality = media_type, quality
+    if best is None and qualities.get(formats[0], wildcard) != 0:
+        # e.g. `text/*`: better the default than a 406.
+        return formats[0]
+    return best
@@ -0,0 +1,371 @@
+"""
+Background jobs
+---------------
+
+Long or CPU-bound backend work runs outside of the HTTP request: the
+handler records a job, hands it to a bounded pool of worker tasks and
+answers right away with the job id. Job records live in a local SQLite
+database shared by the workers of a node, so any worker can answer a
+status request.
+
+A job can carry a deduplication key: submitting a job whose key is
+already used by a reusable job returns that job instead. Running jobs
+report their progress (a fraction and the current step).
+
+Each job store draws a random worker id, recorded with its jobs, and
+beats every `heartbeat` seconds. Unfinished jobs of workers that stopped
+beating (stopped, crashed or restarted processes, whatever their process
+ids) are marked as failed, at startup and periodically. Jobs running
+longer than `timeout` seconds are cancelled and fail.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+import orjson
+import typing as t
+from pathlib import Path
+from sanic import Blueprint
+from .metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+jobs_total = registry.counter(
+    'microfarm_jobs_total',
+    'Background jobs, by kind and final status.',
+    labels=('kind', 'status')
+)
+
+SCHEMA = ("""
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    dedup TEXT UNIQUE,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    step TEXT,
+    result BLOB,
+    error TEXT,
+    worker TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+)
+""", """
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    seen REAL NOT NULL
+)
+""")
+
+
+class JobError(Exception):
+    """Raised by a job to fail with a message meant for the client.
+    """
+
+
+class JobStore:
+
+    def __init__(self, path: Path, heartbeat: float = 10.):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.worker = uuid.uuid4().hex
+        self.heartbeat = heartbeat
+        self._beat()
+
+    @staticmethod
+    def as_dict(row: t.Optional[sqlite3.Row]) -> t.Optional[dict]:
+        if row is None:
+            return None
+        job = dict(row)
+        if job['result'] is not None:
+            job['result'] = orjson.loads(job['result'])
+        return job
+
+    def _create(self, kind: str, owner: str, dedup: t.Optional[str],
+                reuse: t.Sequence[str]) -> t.Tuple[dict, bool]:
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                if dedup is not None:
+                    row = self.db.execute(
+                        'SELECT * FROM jobs WHERE dedup = ?', (dedup,)
+                    ).fetchone()
+                    if row is not None:
+                        if row['status'] in reuse:
+                            self.db.execute('COMMIT')
+                            return self.as_dict(row), False
+                        # Finished job: the key can be used again.
+                        self.db.execute(
+                            'UPDATE jobs SET dedup = NULL WHERE id = ?',
+                            (row['id'],))
+                job_id = str(uuid.uuid4())
+                self.db.execute(
+                    'INSERT INTO jobs (id, kind, owner, dedup, status, '
+                    'worker, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, kind, owner, dedup, PENDING, self.worker,
+                     now, now)
+                )
+                row = self.db.execute(
+                    'SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return self.as_dict(row), True
+
+    def _get(self, job_id: str) -> t.Optional[dict]:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self.as_dict(row)
+
+    def _active(self, dedup: str) -> t.Optional[dict]:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT * FROM jobs WHERE dedup = ? AND status IN (?, ?)',
+                (dedup, PENDING, RUNNING)
+            ).fetchone()
+        return self.as_dict(row)
+
+    def _update(self, job_id: str, **fields):
+        if 'result' in fields:
+            fields['result'] = orjson.dumps(fields['result'])
+        fields['updated'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with self.lock:
+            self.db.execute(
+                f'UPDATE jobs SET {assignments} WHERE id = ?',
+                (*fields.values(), job_id)
+            )
+
+    def _beat(self):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO workers (id, seen) VALUES (?, ?)',
+                (self.worker, time.time())
+            )
+
+    def _recover(self) -> int:
+        """Fails the unfinished jobs of workers that stopped beating.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute(
+                    'DELETE FROM workers WHERE seen < ?',
+                    (now - 3 * self.heartbeat,))
+                lost = self.db.execute(
+                    'UPDATE jobs SET status = ?, error = ?, dedup = NULL, '
+                    'updated = ? WHERE status IN (?, ?) AND (worker IS NULL '
+                    'OR worker NOT IN (SELECT id FROM workers))',
+                    (FAILED, 'Interrupted.', now, PENDING, RUNNING)
+                ).rowcount
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return lost
+
+    def _retire(self):
+        """Forgets the worker: its unfinished jobs will never run.
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM workers WHERE id = ?', (self.worker,))
+        self._recover()
+
+    async def create(self, kind: str, owner: str,
+                     dedup: t.Optional[str] = None,
+                     reuse: t.Sequence[str] = (PENDING, RUNNING, DONE)
+                     ) -> t.Tuple[dict, bool]:
+        return await asyncio.to_thread(
+            self._create, kind, owner, dedup, reuse)
+
+    async def get(self, job_id: str) -> t.Optional[dict]:
+        return await asyncio.to_thread(self._get, job_id)
+
+    async def active(self, dedup: str) -> t.Optional[dict]:
+        """Pending or running job of a deduplication key, if any.
+        """
+        return await asyncio.to_thread(self._active, dedup)
+
+    async def update(self, job_id: str, **fields):
+        await asyncio.to_thread(self._update, job_id, **fields)
+
+    async def beat(self):
+        await asyncio.to_thread(self._beat)
+
+    async def recover(self) -> int:
+        return await asyncio.to_thread(self._recover)
+
+    async def retire(self):
+        await asyncio.to_thread(self._retire)
+
+
+class Progress:
+    """Reports the progress of a running job, at most every `interval`
+    seconds unless the step changes.
+    """
+
+    def __init__(self, store: JobStore, job_id: str, interval: float = .5):
+        self.store = store
+        self.job_id = job_id
+        self.interval = interval
+        self.step = None
+        self.reported = 0.
+
+    async def __call__(self, fraction: float, step: t.Optional[str] = None):
+        now = time.monotonic()
+        step = step or self.step
+        if step == self.step and now - self.reported < self.interval:
+            return
+        self.step = step
+        self.reported = now
+        await self.store.update(
+            self.job_id, progress=min(1., fraction), step=step)
+
+
+class JobQueue:
+
+    def __init__(self, store: JobStore, workers: int = 4,
+                 max_pending: int = 1000, timeout: t.Optional[float] = None):
+        self.store = store
+        self.size = workers
+        self.timeout = timeout
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.workers = []
+
+    def start(self):
+        self.workers = [
+            asyncio.create_task(self.work()) for _ in range(self.size)
+        ]
+        self.workers.append(asyncio.create_task(self.watch()))
+
+    async def stop(self):
+        # `wait_for` swallows a cancellation racing with the end of its
+        # job, and the worker then waits for the next one: cancel again.
+        pending = self.workers
+        while pending:
+            for worker in pending:
+                worker.cancel()
+            _, pending = await asyncio.wait(pending, timeout=1.)
+        self.workers = []
+        await self.store.retire()
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.store.heartbeat)
+            try:
+                await self.store.beat()
+                recovered = await self.store.recover()
+            except Exception:
+                logger.exception('Could not check the jobs of other workers.')
+            else:
+                if recovered:
+                    logger.warning(
+                        '%d interrupted jobs were marked as failed.', recovered)
+
+    async def enqueue(self, kind: str, owner: str,
+                      run: t.Callable[[dict, Progress], t.Awaitable[t.Any]],
+                      dedup: t.Optional[str] = None,
+                      reuse: t.Sequence[str] = (PENDING, RUNNING, DONE)
+                      ) -> t.Tuple[dict, bool]:
+        """Records and schedules a job, unless its deduplication key
+        designates a reusable one. Raises `asyncio.QueueFull` when the
+        backlog is full.
+        """
+        if self.queue.full():
+            raise asyncio.QueueFull()
+        job, created = await self.store.create(kind, owner, dedup, reuse)
+        if created:
+            try:
+                self.queue.put_nowait((job, run))
+            except asyncio.QueueFull:
+                await self.store.update(
+                    job['id'], status=FAILED, error='Overloaded.', dedup=None)
+                raise
+        return job, created
+
+    async def work(self):
+        while True:
+            job, run = await self.queue.get()
+            try:
+                await self.store.update(job['id'], status=RUNNING)
+                try:
+                    result = await asyncio.wait_for(
+                        run(job, Progress(self.store, job['id'])),
+                        self.timeout
+                    )
+                except asyncio.TimeoutError:
+                    status = FAILED
+                    await self.store.update(
+                        job['id'], status=FAILED, error='Timed out.')
+                except JobError as exc:
+                    status = FAILED
+                    await self.store.update(
+                        job['id'], status=FAILED, error=str(exc))
+                except Exception:
+                    status = FAILED
+                    logger.exception('Job %s failed.', job['id'])
+                    await self.store.update(
+                        job['id'], status=FAILED, error='Internal error.')
+                else:
+                    status = DONE
+                    await self.store.update(
+                        job['id'], status=DONE, progress=1., result=result)
+                jobs_total.inc(job['kind'], status)
+            finally:
+                self.queue.task_done()
+
+
+def job_status(job: dict) -> dict:
+    return {
+        'request': job['id'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'step': job['step'],
+        'result': job['result'],
+        'error': job['error'],
+    }
+
+
+jobs = Blueprint('jobs')
+
+
+@jobs.listener("before_server_start")
+async def setup_jobs(app):
+    config = app.config.JOBS
+    store = JobStore(
+        Path(config['database']), heartbeat=config.get('heartbeat', 10))
+    recovered = await store.recover()
+    if recovered:
+        logger.warning('%d interrupted jobs were marked as failed.', recovered)
+    app.ctx.jobs = JobQueue(
+        store,
+        workers=config.get('workers', 4),
+        max_pending=config.get('max_pending', 1000),
+        timeout=config.get('timeout')
+    )
+    app.ctx.jobs.start()
+
+
+@jobs.listener("after_server_stop")
+async def stop_jobs(app):
+    await app.ctx.jobs.stop()
@@ -0,0 +1,96 @@
+"""
+JWT verification keys
+---------------------
+
+Public keys are parsed once into key objects. The default key verifies
+tokens without a `kid` header; every `<kid>.pub` file of the keys
+directory verifies the tokens carrying that `kid`.
+
+Files are polled for changes, so keys can be added, replaced or removed
+without restarting the workers. A removed or replaced key stays valid
+for a grace period, which lets tokens signed before a rotation expire
+naturally.
+"""
+
+import asyncio
+import logging
+import time
+import typing as t
+from pathlib import Path
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+
+logger = logging.getLogger(__name__)
+
+
+class KeyManager:
+
+    def __init__(self, default: Path, directory: t.Optional[Path] = None,
+                 grace: float = 3600):
+        self.default = default
+        self.directory = directory
+        self.grace = grace
+        self.keys: t.Dict[t.Optional[str], t.Any] = {}
+        self.retired: t.Dict[t.Optional[str], t.List[t.Tuple[float, t.Any]]] = {}
+        self.mtimes: t.Dict[Path, float] = {}
+
+    def files(self) -> t.Dict[t.Optional[str], Path]:
+        files = {None: self.default}
+        if self.directory is not None and self.directory.is_dir():
+            for path in self.directory.glob('*.pub'):
+                files[path.stem] = path
+        return files
+
+    def retire(self, kid: t.Optional[str]):
+        key = self.keys.pop(kid, None)
+        if key is not None:
+            self.retired.setdefault(kid, []).append(
+                (time.monotonic() + self.grace, key))
+
+    def load(self):
+        files = self.files()
+        for kid in set(self.keys) - set(files):
+            logger.info('JWT key %r was removed.', kid)
+            self.retire(kid)
+        self.mtimes = {
+            path: mtime for path, mtime in self.mtimes.items()
+            if path in files.values()
+        }
+
+        for kid, path in files.items():
+            try:
+                mtime = path.stat().st_mtime
+                if self.mtimes.get(path) == mtime:
+                    continue
+                key = load_pem_public_key(path.read_bytes())
+            except (OSError, ValueError) as exc:
+                if kid is None and None not in self.keys:
+                    raise
+                logger.error('Could not load JWT key %s: %s', path, exc)
+                continue
+            if kid in self.keys:
+                logger.info('JWT key %r was replaced.', kid)
+                self.retire(kid)
+            self.keys[kid] = key
+            self.mtimes[path] = mtime
+
+        now = time.monotonic()
+        self.retired = {
+            kid: alive for kid, keys in self.retired.items()
+            if (alive := [(deadline, key) for deadline, key in keys
+                          if deadline > now])
+        }
+
+    def candidates(self, kid: t.Optional[str]) -> t.List[t.Any]:
+        """Keys that may have signed a token with the given `kid`,
+        the current one first.
+        """
+        keys = [key for _, key in reversed(self.retired.get(kid, ()))]
+        if kid in self.keys:
+            keys.insert(0, self.keys[kid])
+        return keys
+
+    async def watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.load()
@@ -0,0 +1,209 @@
+"""
+Storage layouts
+---------------
+
+Where the objects of a user live. Handlers address objects by user id
+and name; the layout maps them to a bucket and a key:
+
+- `buckets`: one bucket per user, objects named as is (the original
+  layout);
+- `shared`: a few shared buckets (`<bucket>` or, with `shards`,
+  `<bucket>-<nnn>` picked by a hash of the user id), objects prefixed
+  with `users/<userid>/`. No per-user bucket has to be checked or
+  created.
+
+`python -m microfarm.migrate` copies per-user buckets into the shared
+layout.
+
+With `expire_uploads` days, the buckets a layout creates get lifecycle
+rules aborting the multipart uploads left incomplete and, at the root of
+per-user buckets, expiring the abandoned upload sessions.
+
+User ids are UUIDs in hexadecimal: other buckets of the `buckets` layout
+(blobs, shared buckets, other applications) are not users.
+"""
+
+import hashlib
+import re
+import typing as t
+
+
+USERID = re.compile(r'[0-9a-f]{32}')
+
+
+def is_userid(name: str) -> bool:
+    return USERID.fullmatch(name) is not None
+
+
+class Layout:
+
+    def __init__(self, storage, cache=None, expire_uploads: int = 0):
+        self.storage = storage
+        self.cache = cache
+        self.expire_uploads = expire_uploads
+
+    def location(self, userid: str) -> t.Tuple[str, str]:
+        """Bucket and key prefix of the objects of a user.
+        """
+        raise NotImplementedError()
+
+    def key(self, userid: str, name: str = '') -> t.Tuple[str, str]:
+        bucket, prefix = self.location(userid)
+        return bucket, f'{prefix}{name}'
+
+    async def exists(self, userid: str) -> bool:
+        raise NotImplementedError()
+
+    async def ensure(self, userid: str):
+        raise NotImplementedError()
+
+    async def users(self) -> t.List[str]:
+        raise NotImplementedError()
+
+    def lifecycle(self, bucket: str):
+        raise NotImplementedError()
+
+    async def configure(self, bucket: str):
+        if self.expire_uploads:
+            await self.storage.set_bucket_lifecycle(
+                bucket, self.lifecycle(bucket))
+
+
+class BucketLayout(Layout):
+
+    def location(self, userid: str) -> t.Tuple[str, str]:
+        return userid, ''
+
+    async def exists(self, userid: str) -> bool:
+        # Buckets are never deleted while serving: only hits are cached.
+        key = f'bucket:{userid}'
+        if self.cache is not None and await self.cache.get(key):
+            return True
+        exists = await self.storage.bucket_exists(userid)
+        if exists and self.cache is not None:
+            await self.cache.set(key, True)
+        return exists
+
+    async def ensure(self, userid: str):
+        if not await self.exists(userid):
+            await self.storage.make_bucket(userid)
+            await self.configure(userid)
+            if self.cache is not None:
+                await self.cache.set(f'bucket:{userid}', True)
+
+    async def users(self) -> t.List[str]:
+        return [
+            bucket.name for bucket in await self.storage.list_buckets()
+            if is_userid(bucket.name)
+        ]
+
+    def lifecycle(self, bucket: str):
+        from miniopy_async.commonconfig import ENABLED, Filter
+        from miniopy_async.lifecycleconfig import (
+            AbortIncompleteMultipartUpload, Expiration, LifecycleConfig, Rule)
+
+        return LifecycleConfig([
+            Rule(
+                ENABLED, rule_filter=Filter(prefix=''),
+                rule_id='abort-incomplete-uploads',
+                abort_incomplete_multipart_upload=
+                AbortIncompleteMultipartUpload(self.expire_uploads)
+            ),
+            Rule(
+                ENABLED, rule_filter=Filter(prefix='.uploads/'),
+                rule_id='expire-upload-sessions',
+                expiration=Expiration(days=self.expire_uploads)
+            ),
+        ])
+
+
+class SharedLayout(Layout):
+
+    def __init__(self, storage, bucket: str = 'microfarm', shards: int = 0,
+                 cache=None, expire_uploads: int = 0):
+        super().__init__(storage, cache, expire_uploads)
+        self.bucket = bucket
+        self.shards = shards
+        self.ready: t.Set[str] = set()
+
+    @property
+    def buckets(self) -> t.List[str]:
+        if not self.shards:
+            return [self.bucket]
+        return [f'{self.bucket}-{shard:03d}' for shard in range(self.shards)]
+
+    def location(self, userid: str) -> t.Tuple[str, str]:
+        bucket = self.bucket
+        if self.shards:
+            shard = int(hashlib.sha256(userid.encode()).hexdigest()[:8], 16)
+            bucket = f'{bucket}-{shard % self.shards:03d}'
+        return bucket, f'users/{userid}/'
+
+    async def exists(self, userid: str) -> bool:
+        # Users have no storage of their own to look for.
+        await self.ensure(userid)
+        return True
+
+    async def ensure(self, userid: str):
+        bucket, _ = self.location(userid)
+        await self.ensure_bucket(bucket)
+
+    async def ensure_bucket(self, bucket: str):
+        if bucket not in self.ready:
+            if not await self.storage.bucket_exists(bucket):
+                await self.storage.make_bucket(bucket)
+            # Few buckets: rules are (re)applied once per process.
+            await self.configure(bucket)
+            self.ready.add(bucket)
+
+    def owner(self, key: str) -> t.Optional[t.Tuple[str, str]]:
+        """User id and object name of a key of a shared bucket.
+        """
+        root, _, rest = key.partition('/')
+        userid, _, name = rest.partition('/')
+        if root != 'users' or not userid:
+            return None
+        return userid, name
+
+    def lifecycle(self, bucket: str):
+        from miniopy_async.commonconfig import ENABLED, Filter
+        from miniopy_async.lifecycleconfig import (
+            AbortIncompleteMultipartUpload, LifecycleConfig, Rule)
+
+        # Upload sessions are under per-user prefixes that no rule can
+        # match: the uploads janitor expires them.
+        return LifecycleConfig([
+            Rule(
+                ENABLED, rule_filter=Filter(prefix='users/'),
+                rule_id='abort-incomplete-uploads',
+                abort_incomplete_multipart_upload=
+                AbortIncompleteMultipartUpload(self.expire_uploads)
+            ),
+        ])
+
+    async def users(self) -> t.List[str]:
+        users = []
+        for bucket in self.buckets:
+            if not await self.storage.bucket_exists(bucket):
+                continue
+            for obj in await self.storage.list_objects(
+                    bucket, prefix='users/'):
+                if obj.is_dir:
+                    users.append(obj.object_name.split('/')[1])
+        return users
+
+
+def make_layout(storage, config: dict, cache=None) -> Layout:
+    layout = config.get('layout', 'buckets')
+    expire_uploads = config.get('expire_uploads', 0)
+    if layout == 'buckets':
+        return BucketLayout(storage, cache, expire_uploads)
+    if layout == 'shared':
+        return SharedLayout(
+            storage,
+            bucket=config.get('bucket', 'microfarm'),
+            shards=config.get('shards', 0),
+            cache=cache,
+            expire_uploads=expire_uploads
+        )
+    raise ValueError(f'Unknown storage layout {layout!r}.')
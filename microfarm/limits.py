@@ -0,0 +1,208 @@
+"""
+Admission control
+-----------------
+
+Token-bucket rate limits, per user (or client address for anonymous
+routes) and per user and route, plus concurrency caps for expensive
+routes. The caps adapt to the observed latency of the route: when its
+moving average exceeds the target, the cap shrinks multiplicatively and
+grows back additively once the backends recover.
+
+Routes are named `<blueprint>.<handler>`, e.g. `storage.sign_folder`.
+Limits are enforced per worker process.
+
+A concurrency slot is handed back by the response middleware or, when
+the handler is cancelled (client disconnect) and no response goes out,
+once the task serving the request is done.
+"""
+
+import asyncio
+import math
+import time
+import typing as t
+from collections import OrderedDict
+from sanic import Blueprint, HTTPResponse
+from .metrics import registry
+
+
+rejections = registry.counter(
+    'microfarm_admission_rejected_total',
+    'Requests rejected by admission control.',
+    labels=('route', 'reason')
+)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, amount: float = 1) -> float:
+        """Returns 0 if the tokens were granted, or the number of
+        seconds to wait before they would be.
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0
+        return (amount - self.tokens) / self.rate
+
+
+class AdaptiveLimit:
+
+    def __init__(self, limit: int, min_limit: int = 1,
+                 target_latency: t.Optional[float] = None,
+                 smoothing: float = .2, backoff: float = .9):
+        self.max_limit = limit
+        self.min_limit = min_limit
+        self.limit = float(limit)
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.backoff = backoff
+        self.inflight = 0
+        self.latency = None
+
+    def acquire(self) -> bool:
+        if self.inflight >= int(self.limit):
+            return False
+        self.inflight += 1
+        return True
+
+    def release(self, elapsed: float):
+        self.inflight -= 1
+        if self.target_latency is None:
+            return
+
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += self.smoothing * (elapsed - self.latency)
+
+        if self.latency > self.target_latency:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class Limiter:
+
+    def __init__(self, max_buckets: int = 100000):
+        self.enabled = False
+        self.user_rate = None
+        self.route_rates = {}
+        self.concurrency: t.Dict[str, AdaptiveLimit] = {}
+        self.buckets = OrderedDict()
+        self.max_buckets = max_buckets
+
+    def configure(self, config: dict):
+        self.enabled = config.get('enabled', True)
+        self.user_rate = config.get('user')
+        self.route_rates = config.get('routes', {})
+        adaptive = config.get('adaptive', {})
+        self.concurrency = {
+            route: AdaptiveLimit(limit, **adaptive)
+            for route, limit in config.get('concurrency', {}).items()
+        }
+
+    def bucket(self, key: tuple, rate: dict) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(
+                rate['rate'], rate.get('burst', rate['rate']))
+            if len(self.buckets) > self.max_buckets:
+                # Least recently used buckets are refilled anyway.
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def check(self, client: str, route: str) -> float:
+        wait = 0
+        if self.user_rate is not None:
+            wait = self.bucket((client,), self.user_rate).consume()
+        rate = self.route_rates.get(route)
+        if not wait and rate is not None:
+            wait = self.bucket((client, route), rate).consume()
+        return wait
+
+
+limiter = Limiter()
+limits = Blueprint('limits')
+
+registry.gauge(
+    'microfarm_admission_concurrency_limit',
+    'Current adaptive concurrency cap of expensive routes.',
+    labels=('route',),
+    collect=lambda: {
+        route: limit.limit for route, limit in limiter.concurrency.items()
+    }
+)
+registry.gauge(
+    'microfarm_admission_inflight',
+    'Admitted requests in flight on capped routes.',
+    labels=('route',),
+    collect=lambda: {
+        route: limit.inflight for route, limit in limiter.concurrency.items()
+    }
+)
+
+
+def route_name(request) -> str:
+    if request.route is None:
+        return ''
+    # Route names are prefixed by the application name.
+    return request.route.name.partition('.')[2]
+
+
+def too_many_requests(wait: float) -> HTTPResponse:
+    return HTTPResponse(
+        status=429, headers={'Retry-After': str(max(1, math.ceil(wait)))})
+
+
+async def admit(request) -> t.Optional[HTTPResponse]:
+    if not limiter.enabled:
+        return None
+
+    route = route_name(request)
+    user = getattr(request.ctx, 'user', None)
+    client = user.id if user is not None else request.remote_addr or request.ip
+    wait = limiter.check(client, route)
+    if wait:
+        rejections.inc(route, 'rate')
+        return too_many_requests(wait)
+
+    limit = limiter.concurrency.get(route)
+    if limit is not None:
+        if not limit.acquire():
+            rejections.inc(route, 'concurrency')
+            return too_many_requests(1)
+        task = asyncio.current_task()
+        callback = lambda _: release_slot(request)  # noqa: E731
+        request.ctx.admitted = (limit, time.perf_counter(), task, callback)
+        task.add_done_callback(callback)
+    return None
+
+
+def release_slot(request):
+    admitted = getattr(request.ctx, 'admitted', None)
+    if admitted is not None:
+        request.ctx.admitted = None
+        limit, started, task, callback = admitted
+        task.remove_done_callback(callback)
+        limit.release(time.perf_counter() - started)
+
+
+async def release(request, response):
+    release_slot(request)
+
+
+@limits.listener("before_server_start")
+async def setup_limits(app):
+    limiter.configure(app.config.LIMITS)
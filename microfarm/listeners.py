@@ -1,7 +1,6 @@
-import jwt
-from dataclasses import dataclass
 from pathlib import Path
-from sanic import Blueprint, HTTPResponse
+from sanic import Blueprint
+from .keys import KeyManager
 
 
 listeners = Blueprint("listeners")
@@ -9,7 +8,18 @@ listeners = Blueprint("listeners")
 
 @listeners.listener("before_server_start")
 async def setup_jwt_key(app):
-    jwt_public_key = Path('./identities/jwt.pub')
+    config = app.config.JWT
+    jwt_public_key = Path(config['public_key'])
     assert jwt_public_key.exists()
-    with jwt_public_key.open('rb') as fd:
-        app.config['jwt_public_key'] = fd.read()
+    directory = config.get('keys_directory')
+    app.ctx.jwt_keys = KeyManager(
+        jwt_public_key,
+        directory=Path(directory) if directory else None,
+        grace=config.get('retirement_grace', 3600)
+    )
+    app.ctx.jwt_keys.load()
+    if config.get('reload_interval'):
+        app.add_task(
+            app.ctx.jwt_keys.watch(config['reload_interval']),
+            name='jwt-keys-reload'
+        )
@@ -0,0 +1,28 @@
+"""
+Node locks
+----------
+
+Background tasks that need to run once per node (the uploads janitor,
+the bucket notifications listener with the shared cache) are started by
+every worker; the one holding a file lock does the work, and the others
+retry now and then, should it exit.
+"""
+
+import typing as t
+from pathlib import Path
+
+
+def node_lock(path: Path) -> t.Optional[t.IO]:
+    """Locks the file, unless another process of the node holds it.
+    The lock lasts as long as the returned file is open.
+    """
+    import fcntl
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handle = path.open('a')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        handle.close()
+        return None
+    return handle
@@ -0,0 +1,220 @@
+"""
+Metrics
+-------
+
+In-process instrumentation exposed in the Prometheus text format.
+Every metric belongs to the module-level `registry`; when the registry
+is disabled, observations are no-ops.
+"""
+
+import time
+import bisect
+import typing as t
+from contextlib import contextmanager
+from sanic import Blueprint
+from sanic.response import raw, empty
+
+
+DEFAULT_BUCKETS = (
+    .001, .005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 10.0
+)
+
+
+def format_labels(names: t.Sequence[str], values: t.Sequence[str]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+        )
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Metric:
+    kind: str
+
+    def __init__(self, registry, name: str, description: str,
+                 labels: t.Sequence[str] = ()):
+        self.registry = registry
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def samples(self) -> t.Iterator[t.Tuple[str, str, float]]:
+        for values, value in self.values.items():
+            yield self.name, format_labels(self.labels, values), value
+
+    def render(self) -> t.Iterator[str]:
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for name, labels, value in self.samples():
+            yield f'{name}{labels} {value}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        if self.registry.enabled:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args, collect: t.Optional[t.Callable] = None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.collect = collect
+
+    def set(self, *labels, value: float):
+        if self.registry.enabled:
+            self.values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        if self.registry.enabled:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self):
+        if self.collect is not None:
+            # Gauges computed at scrape time, such as pool or cache sizes.
+            for labels, value in self.collect().items():
+                if not isinstance(labels, tuple):
+                    labels = (labels,)
+                self.values[labels] = value
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: t.Sequence[float] = DEFAULT_BUCKETS,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels, value: float):
+        if not self.registry.enabled:
+            return
+        entry = self.values.get(labels)
+        if entry is None:
+            # [bucket counts..., +Inf count, sum]
+            entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        if not self.registry.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - start)
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for values, entry in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry[:-1]):
+                cumulative += count
+                yield (f'{self.name}_bucket',
+                       format_labels(names, values + (bound,)), cumulative)
+            labels = format_labels(self.labels, values)
+            yield f'{self.name}_sum', labels, entry[-1]
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Registry:
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics = {}
+
+    def register(self, cls, name: str, description: str, **kwargs):
+        if name in self.metrics:
+            return self.metrics[name]
+        metric = self.metrics[name] = cls(self, name, description, **kwargs)
+        return metric
+
+    def counter(self, name: str, description: str, **kwargs) -> Counter:
+        return self.register(Counter, name, description, **kwargs)
+
+    def gauge(self, name: str, description: str, **kwargs) -> Gauge:
+        return self.register(Gauge, name, description, **kwargs)
+
+    def histogram(self, name: str, description: str, **kwargs) -> Histogram:
+        return self.register(Histogram, name, description, **kwargs)
+
+    @contextmanager
+    def count_exceptions(self, counter: Counter, *labels):
+        try:
+            yield
+        except Exception as exc:
+            counter.inc(*labels, type(exc).__name__)
+            raise
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_latency = registry.histogram(
+    'microfarm_http_request_duration_seconds',
+    'Time spent handling HTTP requests.',
+    labels=('route', 'method', 'status')
+)
+http_inflight = registry.gauge(
+    'microfarm_http_requests_in_flight',
+    'HTTP requests currently being handled.',
+)
+
+
+metrics = Blueprint('metrics')
+
+
+@metrics.get("/metrics")
+async def expose_metrics(request):
+    if not registry.enabled:
+        return empty(status=404)
+    return raw(
+        registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
+async def request_started(request):
+    if registry.enabled:
+        request.ctx.started = time.perf_counter()
+        http_inflight.inc()
+
+
+async def request_finished(request, response):
+    started = getattr(request.ctx, 'started', None)
+    if started is None:
+        return
+    request.ctx.started = None
+    http_inflight.dec()
+    route = request.route.path if request.route else 'unmatched'
+    http_latency.observe(
+        route, request.method, response.status,
+        value=time.perf_counter() - started
+    )
+
+
+@metrics.listener("before_server_start")
+async def setup_metrics(app):
+    registry.enabled = app.config.METRICS.get('enabled', True)
@@ -1,6 +1,16 @@
+import hashlib
+import time
 import jwt
 import typing as t
 from sanic import HTTPResponse
+from .metrics import registry
+
+
+jwt_decode_latency = registry.histogram(
+    'microfarm_jwt_decode_duration_seconds',
+    'Time spent decoding and verifying JWT tokens.',
+    buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05)
+)
 
 
 class User(dict):
@@ -26,6 +36,21 @@ class User(dict):
         return self['exp']
 
 
+def decode(token: str, keys) -> dict:
+    kid = jwt.get_unverified_header(token).get('kid')
+    candidates = keys.candidates(kid)
+    if not candidates:
+        raise jwt.exceptions.InvalidTokenError(f'Unknown key: {kid}')
+
+    for key in candidates[:-1]:
+        try:
+            return jwt.decode(token, key, algorithms=["RS256"])
+        except jwt.exceptions.InvalidSignatureError:
+            # Signed with a key that was rotated out.
+            continue
+    return jwt.decode(token, candidates[-1], algorithms=["RS256"])
+
+
 async def jwt_auth(request) -> t.Optional[HTTPResponse]:
     auth = request.headers.get('Authorization')
     if auth is None:
@@ -35,13 +60,21 @@ async def jwt_auth(request) -> t.Optional[HTTPResponse]:
     if authtype not in ('Bearer', 'JWT'):
         return HTTPResponse(status=403)
 
-    try:
-        userdata = jwt.decode(
-            token,
-            request.app.config['jwt_public_key'],
-            algorithms=["RS256"]
-        )
-        request.ctx.user = User(userdata)
-    except jwt.exceptions.InvalidTokenError:
-        # generic error, it catches all invalidities
-        return HTTPResponse(status=403)
+    cache = request.app.ctx.cache
+    token_id = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    key = f"token:{token_id}"
+    userdata = await cache.get(key)
+    if userdata is None:
+        try:
+            with jwt_decode_latency.time():
+                userdata = decode(token, request.app.ctx.jwt_keys)
+        except jwt.exceptions.InvalidTokenError:
+            # generic error, it catches all invalidities
+            return HTTPResponse(status=403)
+        # A cached token never outlives its expiry, if it has one:
+        # otherwise it is kept for the TTL of the namespace.
+        exp = userdata.get('exp')
+        await cache.set(
+            key, userdata, ttl=None if exp is None else exp - time.time())
+    request.ctx.user = User(userdata)
+    request.ctx.token_id = token_id
@@ -0,0 +1,137 @@
+"""
+Layout migration
+----------------
+
+Copies the per-user buckets of the `buckets` layout into the `shared`
+layout configured in `STORAGE`, server side, a few objects at a time:
+
+  $> python -m microfarm.migrate [--concurrency 8] [--dry-run] [--remove]
+                                 [--bucket <userid> ...]
+
+Only the buckets named like user ids are migrated, or the `--bucket`
+ones; neither the shared buckets nor the blobs bucket ever are. Objects already copied with the same size are skipped, so an interrupted
+migration can simply be run again. Upload sessions are not migrated:
+they are to be completed, or left to expire, beforehand. With `--remove`,
+the buckets are emptied and deleted once copied, unless they still hold
+upload sessions.
+"""
+
+import argparse
+import asyncio
+import typing as t
+from .layout import SharedLayout, is_userid, make_layout
+from .storage import InstrumentedMinio, minio_client
+
+
+FIVE_GIB = 5 * 1024 ** 3
+
+
+async def source_buckets(storage, layout: SharedLayout, config: dict,
+                         names: t.Optional[t.Sequence[str]] = None
+                         ) -> t.List[str]:
+    excluded = {
+        *layout.buckets, config.get('blobs_bucket', 'microfarm-blobs')}
+    if not names:
+        names = [
+            bucket.name for bucket in await storage.list_buckets()
+            if is_userid(bucket.name)
+        ]
+    return [name for name in names if name not in excluded]
+
+
+async def copy(storage, source: str, name: str, target: t.Tuple[str, str],
+               size: int):
+    from miniopy_async.commonconfig import CopySource, REPLACE
+
+    if size > FIVE_GIB:
+        # Copied by parts: the metadata cannot be copied along.
+        stats = await storage.stat_object(source, name)
+        metadata = {
+            key: value for key, value in stats.metadata.items()
+            if key.lower() == 'content-type'
+            or key.lower().startswith('x-amz-meta-')
+        }
+        await storage.copy_object(
+            *target, CopySource(source, name),
+            metadata=metadata, metadata_directive=REPLACE
+        )
+    else:
+        await storage.copy_object(*target, CopySource(source, name))
+
+
+async def migrate_bucket(storage, layout: SharedLayout, userid: str,
+                         semaphore: asyncio.Semaphore,
+                         dry_run: bool = False,
+                         remove: bool = False) -> t.Tuple[int, int]:
+    """Returns the number of objects copied, and skipped.
+    """
+    bucket, prefix = layout.location(userid)
+    await layout.ensure(userid)
+    present = {
+        obj.object_name[len(prefix):]: obj.size
+        for obj in await storage.list_objects(
+            bucket, prefix=prefix, recursive=True)
+    }
+    listing = await storage.list_objects(userid, recursive=True)
+    objects = [
+        obj for obj in listing
+        if not obj.object_name.startswith('.uploads/')
+    ]
+    pending = [
+        obj for obj in objects
+        if present.get(obj.object_name) != obj.size
+    ]
+
+    async def migrate(obj):
+        async with semaphore:
+            await copy(
+                storage, userid, obj.object_name,
+                layout.key(userid, obj.object_name), obj.size
+            )
+
+    if not dry_run:
+        await asyncio.gather(*(migrate(obj) for obj in pending))
+        # Buckets with upload sessions left are kept.
+        if remove and len(objects) == len(listing):
+            for obj in objects:
+                await storage.remove_object(userid, obj.object_name)
+            await storage.remove_bucket(userid)
+    return len(pending), len(objects) - len(pending)
+
+
+async def migrate(minio: dict, config: dict, concurrency: int = 8,
+                  dry_run: bool = False, remove: bool = False,
+                  buckets: t.Optional[t.Sequence[str]] = None):
+    storage = InstrumentedMinio(lambda: minio_client(minio))
+    layout = make_layout(storage, config)
+    if not isinstance(layout, SharedLayout):
+        raise SystemExit('STORAGE must configure the shared layout.')
+
+    semaphore = asyncio.Semaphore(concurrency)
+    for userid in await source_buckets(storage, layout, config, buckets):
+        copied, skipped = await migrate_bucket(
+            storage, layout, userid, semaphore,
+            dry_run=dry_run, remove=remove
+        )
+        bucket, prefix = layout.location(userid)
+        action = 'to copy' if dry_run else 'copied'
+        print(f'{userid} -> {bucket}/{prefix}: '
+              f'{copied} {action}, {skipped} already copied')
+
+
+if __name__ == '__main__':
+    from microfarm import app
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--remove', action='store_true')
+    parser.add_argument('--bucket', action='append', dest='buckets')
+    args = parser.parse_args()
+    asyncio.run(migrate(
+        app.config.MINIO, app.config.STORAGE,
+        concurrency=args.concurrency,
+        dry_run=args.dry_run,
+        remove=args.remove,
+        buckets=args.buckets
+    ))
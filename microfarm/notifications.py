@@ -0,0 +1,170 @@
+"""
+Bucket notifications
+--------------------
+
+Each gateway process listens to the object events of the shared layout
+buckets (MinIO's ListenBucketNotification) and drops the cached data of
+the folders the objects belong to, whichever node changed them. Cached
+summaries and artifacts can then keep long time to lives across several
+gateway nodes.
+
+Only the shared layout is supported: listening to per-user buckets
+would take a connection per user. Events may be missed while the
+connection is down: the cache is cleared once it is back.
+
+With the shared cache backend, one worker per node listens: the one
+holding the `lock` file. Local caches need a listener in every worker.
+"""
+
+import asyncio
+import logging
+import orjson
+import typing as t
+from pathlib import Path
+from urllib.parse import unquote_plus
+from sanic import Blueprint
+from .layout import SharedLayout
+from .locks import node_lock
+from .metrics import registry
+from .storage import invalidate_folder
+
+
+logger = logging.getLogger(__name__)
+
+EVENTS = ('s3:ObjectCreated:*', 's3:ObjectRemoved:*')
+
+notifications_received = registry.counter(
+    'microfarm_bucket_notifications_total',
+    'Object events received from the storage, by outcome.',
+    labels=('outcome',)
+)
+
+
+def folder_of(name: str) -> t.Optional[str]:
+    """Folder an object of a user belongs to, if any.
+    """
+    head, _, rest = name.partition('/')
+    if head == '.artifacts':
+        head, _, rest = rest.partition('/')
+    elif head.startswith('.'):
+        # Uploads in progress and blobs belong to no folder yet.
+        return None
+    return head or None
+
+
+async def invalidate(cache, layout: SharedLayout, record: dict):
+    key = unquote_plus(record['s3']['object']['key'])
+    owner = layout.owner(key)
+    folder_id = owner and folder_of(owner[1])
+    if folder_id is not None and owner[1].startswith('.artifacts/') \
+       and record.get('eventName', '').startswith('s3:ObjectCreated:'):
+        # Artifacts are stored from the cached data, which they cannot
+        # have changed: only their removal matters.
+        folder_id = None
+    if folder_id is None:
+        notifications_received.inc('ignored')
+        return
+    await invalidate_folder(cache, owner[0], folder_id)
+    notifications_received.inc('invalidated')
+
+
+async def open_events(client, bucket: str, session):
+    """Opens the ListenBucketNotification stream of a bucket.
+
+    `Minio.listen_bucket_notification` closes its HTTP session before
+    the events are read, and stops at the first keep-alive: the request
+    is signed and sent with the client internals instead, here only.
+    """
+    region = await client._get_region(bucket, None)
+    return await client._url_open(
+        'GET', region, bucket_name=bucket,
+        query_params={'prefix': 'users/', 'events': EVENTS},
+        session=session
+    )
+
+
+async def listen(app, bucket: str, retry: float = 5.,
+                 idle_timeout: t.Optional[float] = 60.,
+                 resumed: bool = False):
+    """Invalidates the cache as the objects of a bucket change. Resumed
+    listeners, like reconnected ones, may have missed events.
+    """
+    import aiohttp
+
+    client = app.ctx.minio.client
+    layout = app.ctx.layout
+    first = not resumed
+    while True:
+        try:
+            timeout = aiohttp.ClientTimeout(
+                total=None, sock_read=idle_timeout)
+            await layout.ensure_bucket(bucket)
+            async with aiohttp.ClientSession(timeout=timeout) as sess:
+                resp = await open_events(client, bucket, sess)
+                if not first:
+                    logger.info('Listening to %s again.', bucket)
+                    await app.ctx.cache.clear()
+                buffer = b''
+                # Records are JSON lines, interleaved with blank
+                # keep-alives that may never end with a newline.
+                async for data in resp.content.iter_any():
+                    *lines, buffer = (buffer + data).split(b'\n')
+                    buffer = buffer.lstrip()
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        event = orjson.loads(line)
+                        for record in event.get('Records') or ():
+                            await invalidate(app.ctx.cache, layout, record)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning('Lost the notifications of %s: %s', bucket, exc)
+        first = False
+        await asyncio.sleep(retry)
+
+
+async def listen_once(app, lock: Path, retry: float = 5., **options):
+    """Listens to every bucket once the node lock is held.
+    """
+    handle = node_lock(lock)
+    resumed = handle is None
+    while handle is None:
+        await asyncio.sleep(retry)
+        handle = node_lock(lock)
+    try:
+        await asyncio.gather(*(
+            listen(app, bucket, retry=retry, resumed=resumed, **options)
+            for bucket in app.ctx.layout.buckets
+        ))
+    finally:
+        handle.close()
+
+
+notifications = Blueprint('notifications')
+
+
+@notifications.listener("before_server_start")
+async def setup_notifications(app):
+    config = app.config.NOTIFICATIONS
+    if not config.get('enabled'):
+        return
+    if not isinstance(app.ctx.layout, SharedLayout):
+        logger.warning(
+            'Bucket notifications require the shared storage layout.')
+        return
+    options = {
+        'retry': config.get('retry', 5.),
+        'idle_timeout': config.get('idle_timeout', 60.),
+    }
+    if app.config.CACHE.get('backend') == 'shared' and config.get('lock'):
+        app.add_task(
+            listen_once(app, Path(config['lock']), **options),
+            name='notifications'
+        )
+        return
+    for bucket in app.ctx.layout.buckets:
+        app.add_task(
+            listen(app, bucket, **options),
+            name=f'notifications-{bucket}'
+        )
@@ -0,0 +1,174 @@
+"""
+Token refresh
+-------------
+
+The JWT service issues the tokens of logins. Refreshed tokens are
+either asked from it too, or, with `REFRESH["local"]`, minted by the
+gateway with a delegated private key, loaded once at startup. Its public
+key must be deployed as `<kid>.pub` in the JWT keys directory of every
+gateway: the startup fails otherwise.
+
+Whichever mints them, refreshes of one token are coalesced: concurrent
+requests share a single refresh, and the same fresh token is returned
+for `reuse_window` seconds. Past that window, the token cannot be
+refreshed again before `min_interval` seconds (429).
+
+Issued tokens are recorded apart from the cache, whose eviction or
+clearing would lift the limit, for `min_interval` seconds and up to
+`max_entries` at a time: past that, refreshes are refused until the
+oldest record expires. Records are kept by each worker process, so the
+limit applies per worker.
+"""
+
+import asyncio
+import logging
+import time
+import jwt
+import typing as t
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from sanic import Blueprint
+from .metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+token_refreshes = registry.counter(
+    'microfarm_token_refreshes_total',
+    'Token refresh requests, by outcome.',
+    labels=('outcome',)
+)
+
+Minter = t.Callable[[dict], t.Awaitable[str]]
+
+
+def local_minter(private_key, kid: str, delta: int) -> Minter:
+
+    async def mint(userdata: dict) -> str:
+        payload = {
+            **userdata,
+            'exp': datetime.now(tz=timezone.utc) + timedelta(minutes=delta)
+        }
+        token_refreshes.inc('minted')
+        return jwt.encode(
+            payload, private_key, algorithm="RS256", headers={'kid': kid})
+
+    return mint
+
+
+def rpc_minter(service, delta: int) -> Minter:
+
+    async def mint(userdata: dict) -> str:
+        async with service() as jwt_service:
+            data = await jwt_service.get_token(userdata, delta=delta)
+        token_refreshes.inc('requested')
+        return data['body']
+
+    return mint
+
+
+class Refresher:
+
+    def __init__(self, mint: Minter, reuse_window: float = 10.,
+                 min_interval: float = 60., max_entries: int = 100000):
+        self.mint = mint
+        self.reuse_window = reuse_window
+        self.min_interval = max(min_interval, reuse_window)
+        self.max_entries = max_entries
+        self.pending: t.Dict[str, asyncio.Future] = {}
+        # Token hash -> (fresh token, time), in the order of issuance.
+        self.issued: OrderedDict = OrderedDict()
+
+    async def refresh(self, token_id: str,
+                      userdata: dict) -> t.Tuple[t.Optional[str], float]:
+        """Fresh token replacing the token of the given hash, or None and
+        the seconds to wait before it can be refreshed.
+        """
+        pending = self.pending.get(token_id)
+        if pending is not None:
+            token_refreshes.inc('shared')
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[token_id] = future
+        try:
+            result = await self._refresh(token_id, userdata)
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # Retrieved by the waiters, if any.
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.pending[token_id]
+        return result
+
+    def expire(self, now: float):
+        while self.issued:
+            _, at = next(iter(self.issued.values()))
+            if now - at < self.min_interval:
+                break
+            self.issued.popitem(last=False)
+
+    async def _refresh(self, token_id: str, userdata: dict):
+        now = time.time()
+        self.expire(now)
+        issued = self.issued.get(token_id)
+        if issued is not None:
+            token, at = issued
+            age = now - at
+            if age < self.reuse_window:
+                token_refreshes.inc('reused')
+                return token, 0.
+            token_refreshes.inc('limited')
+            return None, self.min_interval - age
+        if len(self.issued) >= self.max_entries:
+            # Forgetting a record would let its token refresh again.
+            token_refreshes.inc('overloaded')
+            _, oldest = next(iter(self.issued.values()))
+            return None, self.min_interval - (now - oldest)
+
+        userdata = {**userdata}
+        userdata.pop('exp', None)  # we remove the expiration date.
+        token = await self.mint(userdata)
+        self.issued[token_id] = (token, time.time())
+        return token, 0.
+
+
+def delegated_key(path: Path, kid: str, keys):
+    """Loads the delegated private key, once checked against the public
+    key that verifies its tokens.
+    """
+    from cryptography.hazmat.primitives.serialization import (
+        load_pem_private_key)
+
+    private_key = load_pem_private_key(path.read_bytes(), password=None)
+    numbers = private_key.public_key().public_numbers()
+    if not any(key.public_numbers() == numbers
+               for key in keys.candidates(kid)):
+        raise RuntimeError(
+            f'The JWT keys do not verify the refresh key {kid!r}.')
+    return private_key
+
+
+refresh = Blueprint('refresh')
+
+
+@refresh.listener("before_server_start")
+async def setup_refresh(app):
+    config = app.config.REFRESH
+    delta = config.get('delta', 20)
+    if config.get('local'):
+        kid = config.get('kid', 'refresh')
+        private_key = delegated_key(
+            Path(config['private_key']), kid, app.ctx.jwt_keys)
+        mint = local_minter(private_key, kid, delta)
+    else:
+        mint = rpc_minter(app.ctx.jwt, delta)
+    app.ctx.refresher = Refresher(
+        mint,
+        reuse_window=config.get('reuse_window', 10),
+        min_interval=config.get('min_interval', 60),
+        max_entries=config.get('max_entries', 100000)
+    )
@@ -3,7 +3,7 @@ from sanic.response import json, raw, empty
 from sanic_ext import openapi
 from sanic import Blueprint
 from sanic.exceptions import SanicException
-from .validation import validate_json
+from .validation import validate_json, lazy_schema
 
 
 routes = Blueprint("register")
@@ -32,7 +32,7 @@ class TokenRequest(pydantic.BaseModel):
 
 @routes.post("/register")
 @openapi.definition(
-    body={'application/json': Registration.schema()},
+    body={'application/json': lazy_schema(Registration)},
 )
 @validate_json(Registration)
 async def register(request, body: Registration):
@@ -76,7 +76,7 @@ async def register(request, body: Registration):
 
 @routes.post("/register/verify")
 @openapi.definition(
-    body={'application/json': AccountVerification.schema()},
+    body={'application/json': lazy_schema(AccountVerification)},
 )
 @validate_json(AccountVerification)
 async def verify(request, body: AccountVerification):
@@ -103,7 +103,7 @@ async def verify(request, body: AccountVerification):
 
 @routes.post("/register/token")
 @openapi.definition(
-    body={'application/json': TokenRequest.schema()},
+    body={'application/json': lazy_schema(TokenRequest)},
 )
 @validate_json(TokenRequest)
 async def request_verification_token(request, body: TokenRequest):
@@ -139,7 +139,7 @@ async def request_verification_token(request, body: TokenRequest):
 
 @routes.post("/login")
 @openapi.definition(
-    body={'application/json': Login.schema()},
+    body={'application/json': lazy_schema(Login)},
 )
 @validate_json(Login)
 async def login(request, body: Login):
@@ -20,10 +20,28 @@ from sanic import Blueprint
 from sanic.response import json
 from sanic.exceptions import SanicException
 from contextlib import asynccontextmanager
+from .metrics import registry
+from .tracing import tracer
 
 
 rpcservices = Blueprint('rpcservices')
 
+rpc_latency = registry.histogram(
+    'microfarm_rpc_call_duration_seconds',
+    'Time spent waiting on RPC service calls.',
+    labels=('service', 'method')
+)
+rpc_errors = registry.counter(
+    'microfarm_rpc_call_errors_total',
+    'RPC service calls that raised an error.',
+    labels=('service', 'method', 'error')
+)
+rpc_connections = registry.gauge(
+    'microfarm_rpc_connections_open',
+    'RPC client connections currently open.',
+    labels=('service',)
+)
+
 
 class RPCUnavailableError(pydantic.BaseModel):
     status: int
@@ -31,16 +49,43 @@ class RPCUnavailableError(pydantic.BaseModel):
     description: str
 
 
+class ServiceProxy:
+    """Wraps the aiozmq call namespace to instrument each method call.
+    """
+
+    def __init__(self, name: str, call):
+        self._name = name
+        self._call = call
+
+    def __getattr__(self, method: str):
+        call = getattr(self._call, method)
+
+        async def instrumented(*args, **kwargs):
+            with tracer.span(f'{self._name}.{method}', service=self._name), \
+                 rpc_latency.time(self._name, method), \
+                 registry.count_exceptions(rpc_errors, self._name, method):
+                context = tracer.context()
+                if context is not None:
+                    kwargs['trace_context'] = context
+                return await call(*args, **kwargs)
+
+        return instrumented
+
+
 def rpcservice(name: str, bind: str):
 
     @asynccontextmanager
     async def service():
         try:
-            client = await rpc.connect_rpc(connect=bind, timeout=2)
+            with rpc_latency.time(name, 'connect'), \
+                 registry.count_exceptions(rpc_errors, name, 'connect'):
+                client = await rpc.connect_rpc(connect=bind, timeout=2)
+            rpc_connections.inc(name)
             try:
-                yield client.call
+                yield ServiceProxy(name, client.call)
             finally:
                 client.close()
+                rpc_connections.dec(name)
         except asyncio.TimeoutError:
             # log
             raise SanicException(
@@ -51,8 +96,9 @@ def rpcservice(name: str, bind: str):
 
 @rpcservices.listener("before_server_start")
 async def setup_rpc(app):
-    app.ctx.courrier = rpcservice('courrier', 'tcp://127.0.0.1:5100')
-    app.ctx.jwt = rpcservice('jwt', 'tcp://127.0.0.1:5200')
-    app.ctx.accounts = rpcservice('accounts', 'tcp://127.0.0.1:5300')
-    app.ctx.pki = rpcservice('PKI', 'tcp://127.0.0.1:5400')
-    app.ctx.websockets = rpcservice('websockets', 'tcp://127.0.0.1:5500')
+    services = app.config.RPC
+    app.ctx.courrier = rpcservice('courrier', services['courrier'])
+    app.ctx.jwt = rpcservice('jwt', services['jwt'])
+    app.ctx.accounts = rpcservice('accounts', services['accounts'])
+    app.ctx.pki = rpcservice('PKI', services['pki'])
+    app.ctx.websockets = rpcservice('websockets', services['websockets'])
@@ -1,4 +1,5 @@
-from sanic.response import json
+from math import ceil
+from sanic.response import json, empty
 from sanic_ext import openapi
 from sanic import Blueprint
 from sanic.response import json
@@ -20,9 +21,8 @@ async def session_info(request):
     secured="token",
 )
 async def refresh(request):
-    async with request.app.ctx.jwt() as service:
-        userdata = {**request.ctx.user}
-        userdata.pop('exp')  # we remove the expiration date.
-        data = await service.get_token(request.ctx.user, delta=20)
-
-    return json(status=200, body=data['body'])
+    token, wait = await request.app.ctx.refresher.refresh(
+        request.ctx.token_id, request.ctx.user)
+    if token is None:
+        return empty(status=429, headers={'Retry-After': str(ceil(wait))})
+    return json(status=200, body=token)
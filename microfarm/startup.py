@@ -0,0 +1,54 @@
+"""
+Startup profile
+---------------
+
+Reports what importing the application costs, grouped by top-level
+package, using the interpreter's `-X importtime` instrumentation:
+
+  $> python -m microfarm.startup [--top 20] [--module microfarm]
+"""
+
+import argparse
+import subprocess
+import sys
+import typing as t
+
+
+def import_times(module: str) -> t.List[t.Tuple[str, int, int]]:
+    """Returns (module, self µs, cumulative µs) for every import.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times.append((name.strip(), int(own), int(cumulative)))
+    return times
+
+
+def report(module: str, top: int = 20):
+    times = import_times(module)
+    total = sum(own for _, own, _ in times)
+    packages = {}
+    for name, own, _ in times:
+        package = name.split('.', 1)[0]
+        packages[package] = packages.get(package, 0) + own
+
+    print(f'Importing {module}: {total / 1000:.1f} ms, '
+          f'{len(times)} modules\n')
+    print(f"{'package':<32}{'ms':>10}{'share':>8}")
+    for package, own in sorted(
+            packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f'{package:<32}{own / 1000:>10.1f}{own / total:>8.1%}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--module', default='microfarm')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+    report(args.module, args.top)
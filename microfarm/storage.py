@@ -1,33 +1,47 @@
 import io
-import toml
 import uuid
+import hashlib
 import pydantic
-import minio
-import pathlib
 import typing as t
-import dateutil.parser
 import asyncio
-import aiohttp
-from datetime import timedelta
-from base64 import b64encode
+from datetime import datetime, timedelta, timezone
+from base64 import b64encode, b64decode
 from urllib.parse import unquote
 from sanic.response import json, raw, empty
 from sanic_ext import openapi, cors
 from sanic import Blueprint
 from .validation import validate_json
-from cryptography.hazmat.primitives import hashes
-from miniopy_async import Minio, error
-from miniopy_async.commonconfig import Tags
+from .metrics import registry
+from .tracing import tracer
+from .blobs import BlobStore
+from .compression import EXTENSIONS
+from .formats import (
+    SUMMARY_FORMATS, dump_toml, http_date, http_date_string,
+    negotiate_format)
+from .layout import make_layout
+from .jobs import JobError, PENDING, RUNNING, job_status
 
 
 EOF = object()
+STAT_CONCURRENCY = 16
+LISTING_PAGE = 1000
+ARTIFACTS = ('manifest.toml', 'summary.toml')
 storage = Blueprint('storage')
 
+storage_latency = registry.histogram(
+    'microfarm_storage_operation_duration_seconds',
+    'Time spent on MinIO operations.',
+    labels=('operation',)
+)
+storage_errors = registry.counter(
+    'microfarm_storage_operation_errors_total',
+    'MinIO operations that raised an error.',
+    labels=('operation', 'error')
+)
+
 
 def sha256hash(bindata):
-    digest = hashes.Hash(hashes.SHA256())
-    digest.update(bindata)
-    return b64encode(digest.finalize())
+    return b64encode(hashlib.sha256(bindata).digest())
 
 
 class FolderCreation(pydantic.BaseModel):
@@ -54,9 +68,175 @@ class Streamer:
 
     def __init__(self, stream):
         self.stream = stream
+        self.size = 0
+        self.hasher = hashlib.sha256()
 
     async def read(self, size: int):
-        return await self.stream.read()
+        chunk = await self.stream.read()
+        if chunk:
+            self.size += len(chunk)
+            self.hasher.update(chunk)
+        return chunk
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+    async def drain(self) -> str:
+        """Consumes the rest of the stream, returning its SHA-256 hex
+        digest.
+        """
+        while await self.read(-1) is not None:
+            pass
+        return self.hexdigest()
+
+
+def checksum_digest(checksum: str) -> t.Optional[str]:
+    """Hex digest of a base64 SHA-256 checksum.
+    """
+    try:
+        digest = b64decode(checksum, validate=True)
+    except ValueError:
+        return None
+    if len(digest) != 32:
+        return None
+    return digest.hex()
+
+
+def folder_entry(folder_id: str, definition: t.Optional[str],
+                 filename: str) -> t.Tuple[str, str]:
+    """Object name and file name of a new folder entry.
+    """
+    if definition is None:
+        return f"{folder_id}/{uuid.uuid4().hex}", filename
+    if definition == 'body':
+        return f"{folder_id}/body", "body.html"
+    raise NotImplementedError('Unknown folder definition.')
+
+
+def entry_headers(folder_id: str, headers) -> t.Tuple[str, str]:
+    return folder_entry(
+        folder_id,
+        headers.get('x-folder-definition'),
+        unquote(headers.get('x-original-name', ''))
+    )
+
+
+async def link_entry(storage, layout, blobs, userid: str, objname: str,
+                     digest: str, checksum: str, filename: str,
+                     content_type: str, size: int):
+    """Creates a folder entry referencing a stored blob. Returns None if
+    the blob was deleted meanwhile.
+    """
+    if not await blobs.link(userid, digest, objname):
+        return None
+    return await storage.put_object(
+        *layout.key(userid, objname),
+        io.BytesIO(b''), 0,
+        content_type=content_type,
+        metadata={
+            "x-amz-meta-checksum": checksum,
+            "x-amz-meta-filename": filename,
+            "x-amz-meta-blob": digest,
+            "x-amz-meta-size": str(size)
+        }
+    )
+
+
+async def invalidate_folder(cache, userid: str, folder_id: str):
+    await cache.delete(
+        f'summary:{userid}:{folder_id}',
+        *(f'artifact:{userid}:{folder_id}:{name}.{encoding}'
+          for name in ARTIFACTS for encoding in EXTENSIONS)
+    )
+
+
+async def folder_changed(app, user, folder_id: str,
+                         kind: str = 'folder.updated'):
+    """Drops the cached data of a folder and tells the user.
+    """
+    await invalidate_folder(app.ctx.cache, user.id, folder_id)
+    app.ctx.events.publish(user.email, kind, folder_id)
+
+
+async def folder_state(storage, layout, userid: str,
+                       folder_id: str) -> t.Optional[bool]:
+    """Whether a folder is locked (or signed), None if it does not exist.
+    Locked folders are immutable: their files and summary are final.
+    """
+    from miniopy_async.error import S3Error
+
+    async def exists(name: str) -> bool:
+        try:
+            await storage.stat_object(*layout.key(userid, name))
+        except S3Error as exc:
+            if exc.code != 'NoSuchKey':
+                raise
+            return False
+        return True
+
+    marker, manifest = await asyncio.gather(
+        exists(f'{folder_id}/'), exists(f'{folder_id}/manifest'))
+    if not marker:
+        return None
+    return manifest
+
+
+def artifact_name(folder_id: str, name: str, encoding: str) -> str:
+    return f'.artifacts/{folder_id}/{name}.{EXTENSIONS[encoding]}'
+
+
+async def store_artifacts(app, userid: str, folder_id: str, name: str,
+                          data: bytes):
+    """Stores the compressed variants of an immutable payload.
+    """
+    compressor = app.ctx.compressor
+    if compressor is None or not app.config.COMPRESSION.get('artifacts'):
+        return
+    for encoding in compressor.encodings:
+        compressed = await compressor.compress(data, encoding)
+        await app.ctx.minio.put_object(
+            *app.ctx.layout.key(
+                userid, artifact_name(folder_id, name, encoding)),
+            io.BytesIO(compressed), len(compressed),
+            # Not stored as a Content-Encoding: clients would decode it.
+            content_type='application/octet-stream'
+        )
+
+
+async def folder_artifact(app, userid: str, folder_id: str, name: str,
+                          encoding: t.Optional[str]) -> t.Optional[bytes]:
+    """Stored compressed variant of a payload, if any.
+    """
+    import aiohttp
+    from miniopy_async.error import S3Error
+
+    if encoding is None or not app.config.COMPRESSION.get('artifacts'):
+        return None
+    key = f'artifact:{userid}:{folder_id}:{name}.{encoding}'
+    data = await app.ctx.cache.get(key)
+    if data is None:
+        async with aiohttp.ClientSession() as sess:
+            try:
+                resp = await app.ctx.minio.get_object(
+                    *app.ctx.layout.key(
+                        userid, artifact_name(folder_id, name, encoding)),
+                    session=sess)
+            except S3Error as exc:
+                if exc.code != 'NoSuchKey':
+                    raise
+                data = b''
+            else:
+                data = await resp.read()
+        # Absent artifacts are cached too, until the folder changes.
+        await app.ctx.cache.set(key, data)
+    return data or None
+
+
+def encoded(data: bytes, content_type: str, encoding: str):
+    return raw(data, content_type=content_type, headers={
+        'Content-Encoding': encoding,
+        'Vary': 'Accept-Encoding'
+    })
 
 
 @storage.put("/folders/upload/<folder_id:str>", stream=True)
@@ -67,121 +247,350 @@ class Streamer:
 async def upload_to_folder(request, folder_id: str):
     userid = request.ctx.user.id
     storage = request.app.ctx.minio
-    exists = await storage.bucket_exists(userid)
-    if not exists:
-        print(f"Bucket {userid} does not exist.")
-        await storage.make_bucket(userid)
-
+    layout = request.app.ctx.layout
+    blobs = request.app.ctx.blobs
+    await layout.ensure(userid)
 
     checksum = request.headers.get('x-checksum-sha256')
     if checksum is None:
         return raw(status=422, body="SHA256 checkum is missing.")
 
-    objname = f'{folder_id}/'
-    stats = await storage.stat_object(userid, objname)
+    state = await folder_state(storage, layout, userid, folder_id)
+    if state is None:
+        return empty(status=404)
+    if state:
+        return raw(status=409, body="The folder is locked.")
+    objname, filename = entry_headers(folder_id, request.headers)
+    content_type = request.headers['content-type']
 
-    defines = request.headers.get('x-folder-definition')
-    if defines is None:
-        objname = f"{folder_id}/{uuid.uuid4().hex}"
-        filename = unquote(request.headers['x-original-name'])
+    if blobs is None:
+        put_info = await storage.put_object(
+            *layout.key(userid, objname),
+            Streamer(request.stream), -1, part_size=5242880,
+            content_type=content_type,
+            metadata={
+                "x-amz-checksum-sha256": checksum,
+                "x-amz-meta-checksum": checksum,
+                "x-amz-meta-filename": filename,
+            }
+        )
     else:
-        if defines == 'body':
-            objname = f"{folder_id}/body"
-            filename = "body.html"
+        digest = checksum_digest(checksum)
+        if digest is None:
+            return raw(status=422, body="SHA256 checkum is invalid.")
+        stream = Streamer(request.stream)
+        if await blobs.stat(userid, digest) is not None:
+            # Already stored: the body only proves the client holds it.
+            verified = await stream.drain() == digest
         else:
-            raise NotImplementedError('Unknown folder definition.')
+            verified = await blobs.store(
+                userid, digest, checksum, stream, content_type)
+        if not verified:
+            return raw(status=422, body="SHA256 checkum mismatch.")
+        put_info = await link_entry(
+            storage, layout, blobs, userid, objname, digest, checksum,
+            filename, content_type, stream.size
+        )
+        if put_info is None:
+            return raw(status=409, body="The file was deleted meanwhile.")
 
-    put_info = await storage.put_object(
-        userid, objname,
-        Streamer(request.stream), -1, part_size=5242880,
-        content_type=request.headers['content-type'],
-        metadata={
-            "x-amz-checksum-sha256": checksum,
-            "x-amz-meta-filename": filename,
-        }
+    await folder_changed(request.app, request.ctx.user, folder_id)
+    return json(status=200, body={
+        'etag': put_info.etag,
+        'userid': userid,
+        'fileid': objname
+    })
+
+
+@storage.get("/folders/blobs/<digest:str>")
+@openapi.definition(
+    secured="token",
+)
+async def get_blob(request, digest: str):
+    """Tells whether a file can be linked instead of uploaded.
+    """
+    blobs = request.app.ctx.blobs
+    if blobs is None:
+        return empty(status=404)
+    stats = await blobs.known(request.ctx.user.id, digest.lower())
+    if stats is None:
+        return empty(status=404)
+    return json(status=200, body={'size': stats.size})
+
+
+@storage.put("/folders/link/<folder_id:str>")
+@openapi.definition(
+    secured="token",
+)
+@cors(allow_headers=['Authorization', 'Content-Type', 'X-Original-Name', 'X-Folder-Definition', 'X-Checksum-SHA256'])
+async def link_to_folder(request, folder_id: str):
+    """Adds an already stored file to a folder, without its body.
+    """
+    userid = request.ctx.user.id
+    storage = request.app.ctx.minio
+    layout = request.app.ctx.layout
+    blobs = request.app.ctx.blobs
+    if blobs is None:
+        return empty(status=404)
+
+    checksum = request.headers.get('x-checksum-sha256')
+    if checksum is None:
+        return raw(status=422, body="SHA256 checkum is missing.")
+    digest = checksum_digest(checksum)
+    if digest is None:
+        return raw(status=422, body="SHA256 checkum is invalid.")
+
+    stats = await blobs.known(userid, digest)
+    if stats is None:
+        return empty(status=404)
+
+    state = await folder_state(storage, layout, userid, folder_id)
+    if state is None:
+        return empty(status=404)
+    if state:
+        return raw(status=409, body="The folder is locked.")
+    objname, filename = entry_headers(folder_id, request.headers)
+    put_info = await link_entry(
+        storage, layout, blobs, userid, objname, digest, checksum,
+        filename, request.headers['content-type'], stats.size
     )
+    if put_info is None:
+        return empty(status=404)
+    await folder_changed(request.app, request.ctx.user, folder_id)
     return json(status=200, body={
         'etag': put_info.etag,
-        'userid': put_info.bucket_name,
-        'fileid': put_info.object_name
+        'userid': userid,
+        'fileid': objname
     })
 
 
+class Entry(t.NamedTuple):
+    name: str
+    size: int
+    modified: datetime
+    metadata: t.Dict[str, str]  # Lower-cased header names.
+
+    @property
+    def http_modified(self) -> str:
+        return http_date_string(self.modified)
+
+    @property
+    def created(self) -> datetime:
+        """Creation date recorded in the metadata (folder markers), or
+        the date of the object, copied or not.
+        """
+        created = self.metadata.get('x-amz-meta-created')
+        if created is None:
+            return self.modified
+        return http_date(created)
+
+    @property
+    def content_size(self) -> int:
+        return int(self.metadata.get('x-amz-meta-size', self.size))
+
+    def location(self, layout, userid: str,
+                 blobs=None) -> t.Tuple[str, str]:
+        """Bucket and key of the content of the entry.
+        """
+        digest = self.metadata.get('x-amz-meta-blob')
+        if digest is not None and blobs is not None:
+            return blobs.blob(userid, digest)
+        return layout.key(userid, self.name)
+
+
+async def stat_entry(storage, layout, userid: str, name: str) -> Entry:
+    stats = await storage.stat_object(
+        *layout.key(userid, name),
+        request_headers={"x-amz-checksum-mode": "ENABLED"})
+    metadata = {key.lower(): value for key, value in stats.metadata.items()}
+    if 'x-amz-meta-checksum' not in metadata \
+       and 'x-amz-checksum-sha256' in metadata:
+        metadata['x-amz-meta-checksum'] = metadata['x-amz-checksum-sha256']
+    return Entry(
+        name, stats.size,
+        http_date(metadata['last-modified']), metadata)
+
+
+async def list_entries(
+        storage, layout, userid: str, prefix: str = '',
+        recursive: bool = False, select: t.Callable[[str], bool] = None,
+        progress: t.Optional[t.Callable[[float], t.Awaitable]] = None
+) -> t.List[Entry]:
+    """Lists objects along with their metadata, in pages.
+
+    The MinIO listing extension returns the user metadata with each
+    object. Objects listed without it (other backends, or objects stored
+    before their checksum was kept as metadata) are stat-ed, at most
+    `STAT_CONCURRENCY` at a time.
+    """
+    bucket, root = layout.location(userid)
+    objects = await storage.list_objects(
+        bucket, prefix=root + prefix, recursive=recursive,
+        include_user_meta=True)
+    entries = []
+    for obj in objects:
+        if obj.last_modified is None:
+            # Common prefix: folder markers are listed as objects.
+            continue
+        name = obj.object_name[len(root):]
+        if select is not None and not select(name):
+            continue
+        metadata = {
+            key.lower(): value for key, value in (obj.metadata or {}).items()
+        }
+        entries.append(Entry(name, obj.size, obj.last_modified, metadata))
+
+    incomplete = [
+        index for index, entry in enumerate(entries)
+        if 'content-type' not in entry.metadata or (
+            'x-amz-meta-filename' in entry.metadata
+            and 'x-amz-meta-checksum' not in entry.metadata)
+    ]
+    if incomplete:
+        semaphore = asyncio.Semaphore(STAT_CONCURRENCY)
+        done = 0
+
+        async def stat(index: int):
+            nonlocal done
+            async with semaphore:
+                entries[index] = await stat_entry(
+                    storage, layout, userid, entries[index].name)
+            done += 1
+            if progress is not None:
+                await progress(done / len(incomplete))
+
+        await asyncio.gather(*(stat(index) for index in incomplete))
+    return entries
+
+
+def is_marker(name: str) -> bool:
+    """Folder markers are the top-level objects named `<folder_id>/`,
+    hidden prefixes aside.
+    """
+    return name.find('/') == len(name) - 1 and not name.startswith('.')
+
+
+async def list_markers(storage, layout, userid: str) -> t.List[str]:
+    """Names of the folder markers, `<folder_id>/`: the common prefixes
+    of a delimited listing of the user's storage, but the hidden ones.
+    """
+    bucket, root = layout.location(userid)
+    objects = await storage.list_objects(bucket, prefix=root)
+    names = (obj.object_name[len(root):] for obj in objects if obj.is_dir)
+    return [name for name in names if not name.startswith('.')]
+
+
+async def stat_markers(storage, layout, userid: str,
+                       names: t.Sequence[str]) -> t.List[Entry]:
+    """Stats folder markers, at most `STAT_CONCURRENCY` at a time.
+    Prefixes left without a marker (a folder being deleted) are skipped.
+    """
+    from miniopy_async.error import S3Error
+
+    semaphore = asyncio.Semaphore(STAT_CONCURRENCY)
+
+    async def stat(name: str) -> t.Optional[Entry]:
+        async with semaphore:
+            try:
+                return await stat_entry(storage, layout, userid, name)
+            except S3Error as exc:
+                if exc.code != 'NoSuchKey':
+                    raise
+                return None
+
+    markers = await asyncio.gather(*(stat(name) for name in names))
+    return [marker for marker in markers if marker is not None]
+
+
 async def folder_fummary(
-        storage, userid: str, folder_name: str, with_download: bool = False):
+        storage, layout, userid: str, folder_name: str,
+        with_download: bool = False,
+        progress: t.Optional[t.Callable[[float], t.Awaitable]] = None,
+        blobs=None):
     objname = f'{folder_name}/'
-    stats = await storage.stat_object(userid, objname)
-    children = await storage.list_objects(
-        userid, prefix=objname, start_after=objname
-    )
+    entries = await list_entries(
+        storage, layout, userid, prefix=objname, progress=progress)
+    if not entries or entries[0].name != objname:
+        # The folder marker always comes first.
+        raise FileNotFoundError(objname)
+
+    marker, children = entries[0], entries[1:]
     summary = {
         'userid': userid,
         'id': folder_name,
-        'name': stats.metadata['x-amz-meta-title'],
-        'modified': dateutil.parser.parse(
-            stats.metadata['Last-Modified']
-        ),
-        'created': dateutil.parser.parse(
-            stats.metadata['Date']
-        )
+        'name': marker.metadata['x-amz-meta-title'],
+        'modified': marker.modified,
+        'created': marker.created
     }
     contents = {}
-    if children:
-        for child in children:
-            stats = await storage.stat_object(
-                userid, child.object_name, request_headers={
-                "x-amz-checksum-mode": "ENABLED"
-            })
-            contents[child.object_name] = {
-                'checksum': stats.metadata['x-amz-checksum-sha256'],
-                'name': stats.metadata['x-amz-meta-filename'],
-                'content_type': stats.metadata['Content-Type'],
-                'size': stats.size,
-                'modified': stats.metadata['Last-Modified'],
-                'created': stats.metadata['Date']
-            }
-            if with_download:
-                contents[stats.object_name]['link'] = await storage.presigned_get_object(
-                    userid, stats.object_name,
-                    expires=timedelta(minutes=20)
-                )
+    for child in children:
+        modified = child.http_modified
+        contents[child.name] = {
+            'checksum': child.metadata['x-amz-meta-checksum'],
+            'name': child.metadata['x-amz-meta-filename'],
+            'content_type': child.metadata['content-type'],
+            'size': child.content_size,
+            'modified': modified,
+            'created': modified
+        }
+        if with_download:
+            contents[child.name]['link'] = await storage.presigned_get_object(
+                *child.location(layout, userid, blobs),
+                expires=timedelta(minutes=20)
+            )
     summary['files'] = contents
     summary['locked'] = objname + 'manifest' in contents
     summary['signed'] = objname + 'signature' in contents
     return summary
 
 
-@storage.get("/folders/lock/<folder_id:str>")
-@openapi.definition(
-    secured="token",
-)
-@cors(allow_headers=['Authorization', 'Content-Type'])
-async def lock_folder(request, folder_id: str):
-    userid = request.ctx.user.id
-    storage = request.app.ctx.minio
-    exists = await storage.bucket_exists(userid)
-    if not exists:
-        return empty(status=404)
-
-    summary = await folder_fummary(storage, userid, folder_id)
+async def lock(storage, layout, userid: str, folder_id: str, progress):
+    await progress(0., 'summary')
+    summary = await folder_fummary(
+        storage, layout, userid, folder_id,
+        progress=lambda done: progress(done * .9))
     manifest_id = f'{folder_id}/manifest'
     if manifest_id in summary['files']:
-        # Already locked.
-        return empty(status=400)
+        raise JobError('Already locked.')
 
-    manifest = toml.dumps(summary).encode('utf-8')
+    await progress(.9, 'manifest')
+    manifest = dump_toml(summary)
     checksum = sha256hash(manifest).decode('utf-8')
 
     put_info = await storage.put_object(
-        userid, manifest_id,
+        *layout.key(userid, manifest_id),
         io.BytesIO(manifest), len(manifest),
         content_type="application/toml",
         metadata={
             "x-amz-checksum-sha256": checksum,
+            "x-amz-meta-checksum": checksum,
             "x-amz-meta-filename": "manifest.toml"
         }
     )
-    return empty(status=200)
+    return manifest
+
+
+@storage.get("/folders/lock/<folder_id:str>")
+@openapi.definition(
+    secured="token",
+)
+@cors(allow_headers=['Authorization', 'Content-Type'])
+async def lock_folder(request, folder_id: str):
+    user = request.ctx.user
+    app = request.app
+    storage = app.ctx.minio
+    layout = app.ctx.layout
+    exists = await layout.exists(user.id)
+    if not exists:
+        return empty(status=404)
+
+    async def run(job: dict, progress):
+        manifest = await lock(storage, layout, user.id, folder_id, progress)
+        await store_artifacts(
+            app, user.id, folder_id, 'manifest.toml', manifest)
+        await folder_changed(app, user, folder_id, 'folder.locked')
+
+    return await folder_job(request, 'folder.lock', folder_id, run)
 
 
 @storage.post("/folders/new")
@@ -192,88 +601,198 @@ async def lock_folder(request, folder_id: str):
 async def new_folder(request, body: FolderCreation):
     userid = request.ctx.user.id
     storage = request.app.ctx.minio
-
-    exists = await storage.bucket_exists(userid)
-    if not exists:
-        print(f"Bucket {userid} does not exist.")
-        await storage.make_bucket(userid)
+    layout = request.app.ctx.layout
+    await layout.ensure(userid)
 
     folderid = uuid.uuid4().hex
     result = await storage.put_object(
-        userid, f'{folderid}/', io.BytesIO(b""), 0,
+        *layout.key(userid, f'{folderid}/'), io.BytesIO(b""), 0,
         content_type="application/x-folder",
         metadata={
-            'title': body.name
+            'title': body.name,
+            'created': http_date_string(datetime.now(tz=timezone.utc))
         }
     )
     return raw(status=200, body=folderid)
 
 
-@storage.post("/folders/sign/<folder_id:str>")
-@openapi.definition(
-    secured="token",
-)
-@validate_json(FolderSignature)
-async def sign_folder(request, folder_id: str, body: FolderCreation):
-    userid = request.ctx.user.id
-    storage = request.app.ctx.minio
-
-    exists = await storage.bucket_exists(userid)
-    if not exists:
-        print(f"Bucket {userid} does not exist.")
-        await storage.make_bucket(userid)
-
-    manifest_id = f'{folder_id}/manifest'
-    async with aiohttp.ClientSession() as sess:
-        resp = await storage.get_object(userid, manifest_id, session=sess)
-        manifest = await resp.read()
-
-    async with request.app.ctx.pki() as service:
-        signature = await service.sign(
-            request.ctx.user.id,
-            manifest,
-            body.certificate,
-            body.secret
-        )
+async def sign(storage, layout, pki, userid: str, folder_id: str,
+               body: FolderSignature, progress,
+               reference: t.Optional[dict] = None):
+    """With a `reference` configuration, manifests of `threshold` bytes
+    or more are passed to the PKI service as a presigned URL along with
+    their checksum: the service fetches them from the storage itself,
+    instead of the gateway reading and serializing them in the call.
+    """
+    import aiohttp
+    from miniopy_async.error import S3Error
+
+    await progress(0., 'manifest')
+    bucket, manifest_key = layout.key(userid, f'{folder_id}/manifest')
+    try:
+        if reference is not None:
+            stats = await storage.stat_object(bucket, manifest_key)
+            by_reference = stats.size >= reference.get('threshold', 0)
+        else:
+            by_reference = False
+        if not by_reference:
+            async with aiohttp.ClientSession() as sess:
+                resp = await storage.get_object(
+                    bucket, manifest_key, session=sess)
+                manifest = await resp.read()
+    except S3Error as exc:
+        if exc.code != 'NoSuchKey':
+            raise
+        raise JobError('The folder is not locked.')
+
+    await progress(.2, 'signature')
+    async with pki() as service:
+        if by_reference:
+            url = await storage.presigned_get_object(
+                bucket, manifest_key,
+                expires=timedelta(seconds=reference.get('url_expiry', 300))
+            )
+            signature = await service.sign_reference(
+                userid,
+                url,
+                stats.metadata.get('x-amz-meta-checksum'),
+                body.certificate,
+                body.secret
+            )
+        else:
+            signature = await service.sign(
+                userid,
+                manifest,
+                body.certificate,
+                body.secret
+            )
 
     if signature['code'] == 400:
-        return empty(status=400)
+        raise JobError('The folder could not be signed.')
 
     if signature['code'] == 200:
+        await progress(.9, 'upload')
         p7s = signature['body']
         checksum = sha256hash(p7s).decode('utf-8')
         put_info = await storage.put_object(
-            userid, f'{folder_id}/signature',
+            *layout.key(userid, f'{folder_id}/signature'),
             io.BytesIO(p7s), len(p7s),
             content_type="application/pkcs7-signature",
             metadata={
                 "x-amz-checksum-sha256": checksum,
+                "x-amz-meta-checksum": checksum,
                 "x-amz-meta-filename": "signature.p7s"
             }
         )
-        return empty(status=200)
+        return
 
     raise NotImplementedError('Unknown response code.')
 
 
+@storage.post("/folders/sign/<folder_id:str>")
+@openapi.definition(
+    secured="token",
+)
+@validate_json(FolderSignature)
+async def sign_folder(request, folder_id: str, body: FolderSignature):
+    user = request.ctx.user
+    app = request.app
+    storage = app.ctx.minio
+    layout = app.ctx.layout
+    await layout.ensure(user.id)
+    config = app.config.SIGNING
+    reference = config if config.get('by_reference') else None
+
+    async def run(job: dict, progress):
+        await sign(
+            storage, layout, app.ctx.pki, user.id, folder_id, body, progress,
+            reference=reference)
+        # Signed folders no longer change: their summary is final.
+        summary = await folder_fummary(storage, layout, user.id, folder_id)
+        await store_artifacts(
+            app, user.id, folder_id, 'summary.toml', dump_toml(summary))
+        await folder_changed(app, user, folder_id, 'folder.signed')
+
+    return await folder_job(request, 'folder.sign', folder_id, run)
+
+
+def folder_job_key(userid: str, folder_id: str) -> str:
+    return f'folder:{userid}:{folder_id}'
+
+
+async def enqueue_folder_job(request, kind: str, folder_id: str,
+                             run) -> t.Optional[dict]:
+    """Records a job on a folder. Jobs on one folder are exclusive:
+    concurrent requests of one kind share a job, and None is returned
+    while a job of another kind is pending or running.
+    Raises `asyncio.QueueFull` when the backlog is full.
+    """
+    userid = request.ctx.user.id
+    job, _ = await request.app.ctx.jobs.enqueue(
+        kind, userid, run,
+        dedup=folder_job_key(userid, folder_id),
+        reuse=(PENDING, RUNNING)
+    )
+    if job['kind'] != kind:
+        return None
+    return job
+
+
+async def folder_job(request, kind: str, folder_id: str, run):
+    try:
+        job = await enqueue_folder_job(request, kind, folder_id, run)
+    except asyncio.QueueFull:
+        return empty(status=503)
+    if job is None:
+        return empty(status=409)
+
+    return json(
+        status=202,
+        body={'request': job['id']},
+        headers={'Location': f"/folders/jobs/{job['id']}"}
+    )
+
+
+@storage.get("/folders/jobs/<job_id:uuid>")
+@openapi.definition(
+    secured="token",
+)
+async def folder_job_status(request, job_id: uuid.UUID):
+    job = await request.app.ctx.jobs.store.get(str(job_id))
+    if job is None or not job['kind'].startswith('folder.') \
+       or job['owner'] != request.ctx.user.id:
+        return empty(status=404)
+    return json(body=job_status(job))
+
+
 @storage.get("/folders/view/<folder_id:str>")
 @openapi.definition(
     secured="token",
 )
 async def get_folder(request, folder_id: str):
+    import aiohttp
+
     userid = request.ctx.user.id
     storage = request.app.ctx.minio
+    layout = request.app.ctx.layout
 
-    exists = await storage.bucket_exists(userid)
+    exists = await layout.exists(userid)
     if not exists:
         return empty(status=404)
 
-    summary = await folder_fummary(storage, userid, folder_id, with_download=True)
+    blobs = request.app.ctx.blobs
+    summary = await folder_fummary(
+        storage, layout, userid, folder_id, with_download=True, blobs=blobs)
     body_id = f'{folder_id}/body'
     text_content = b''
     if body_id in summary['files']:
         async with aiohttp.ClientSession() as sess:
-            resp = await storage.get_object(userid, body_id, session=sess)
+            resp = await storage.get_object(
+                *layout.key(userid, body_id), session=sess)
+            digest = resp.headers.get('x-amz-meta-blob')
+            if digest is not None and blobs is not None:
+                resp = await storage.get_object(
+                    *blobs.blob(userid, digest), session=sess)
             text_content = await resp.read()
 
     summary['body'] = text_content.decode('utf-8')
@@ -287,13 +806,72 @@ async def get_folder(request, folder_id: str):
 async def get_folder_summary(request, folder_id: str):
     userid = request.ctx.user.id
     storage = request.app.ctx.minio
+    layout = request.app.ctx.layout
+
+    exists = await layout.exists(userid)
+    if not exists:
+        return empty(status=404)
+
+    media_type = negotiate_format(
+        request.headers.get('accept'), tuple(SUMMARY_FORMATS))
+    if media_type is None:
+        return empty(status=406)
+    headers = {'Vary': 'Accept'}
+
+    app = request.app
+    if media_type == 'application/toml':
+        encoding = app.ctx.compressor and app.ctx.compressor.negotiate(
+            request.headers.get('accept-encoding'))
+        artifact = await folder_artifact(
+            app, userid, folder_id, 'summary.toml', encoding)
+        if artifact is not None:
+            response = encoded(artifact, media_type, encoding)
+            response.headers.add('Vary', 'Accept')
+            return response
+
+    key = f'summary:{userid}:{folder_id}'
+    summary = await app.ctx.cache.get(key)
+    if summary is None:
+        summary = await folder_fummary(storage, layout, userid, folder_id)
+        await app.ctx.cache.set(key, summary)
+    return raw(
+        status=200, body=SUMMARY_FORMATS[media_type](summary),
+        content_type=media_type, headers=headers)
+
+
+@storage.get("/folders/view/<folder_id:str>/manifest")
+@openapi.definition(
+    secured="token",
+)
+async def get_folder_manifest(request, folder_id: str):
+    import aiohttp
+    from miniopy_async.error import S3Error
 
-    exists = await storage.bucket_exists(userid)
+    userid = request.ctx.user.id
+    app = request.app
+    layout = app.ctx.layout
+
+    exists = await layout.exists(userid)
     if not exists:
         return empty(status=404)
 
-    summary = await folder_fummary(storage, userid, folder_id)
-    return raw(status=200, body=toml.dumps(summary))
+    encoding = app.ctx.compressor and app.ctx.compressor.negotiate(
+        request.headers.get('accept-encoding'))
+    artifact = await folder_artifact(
+        app, userid, folder_id, 'manifest.toml', encoding)
+    if artifact is not None:
+        return encoded(artifact, 'application/toml', encoding)
+
+    async with aiohttp.ClientSession() as sess:
+        try:
+            resp = await app.ctx.minio.get_object(
+                *layout.key(userid, f'{folder_id}/manifest'), session=sess)
+        except S3Error as exc:
+            if exc.code != 'NoSuchKey':
+                raise
+            return empty(status=404)
+        manifest = await resp.read()
+    return raw(status=200, body=manifest, content_type='application/toml')
 
 
 @storage.post("/folders")
@@ -304,37 +882,34 @@ async def get_folder_summary(request, folder_id: str):
 async def list_folders(request, body: FoldersListing):
     userid = request.ctx.user.id
     storage = request.app.ctx.minio
+    layout = request.app.ctx.layout
 
-    exists = await storage.bucket_exists(userid)
+    exists = await layout.exists(userid)
     folders = []
     if exists:
-        objects = await storage.list_objects(userid)
-        folders = []
-        for obj in objects:
-            if obj.is_dir:
-                path = pathlib.PosixPath(obj.object_name)
-                stats = await storage.stat_object(
-                    userid, obj.object_name, request_headers={
-                        "x-amz-checksum-mode": "ENABLED"
-                    }
-                )
-                folders.append({
-                    'id': path.name,
-                    'name': stats.metadata['x-amz-meta-title'],
-                    'modified': dateutil.parser.parse(
-                        stats.metadata['Last-Modified']
-                    ),
-                    'created': dateutil.parser.parse(
-                        stats.metadata['Date']
-                    ),
-                })
-
-        if body.offset and body.limit:
-            folders = folders[body.offset: body.offset+body.limit]
-        elif body.offset:
-            folders = folders[body.offset:]
-        elif body.limit:
-            folders[:body.limit]
+        if body.offset or body.limit:
+            # A page: the delimited listing only names the folders, and
+            # the markers of the page are stat-ed, one request each.
+            names = await list_markers(storage, layout, userid)
+            if body.offset and body.limit:
+                names = names[body.offset: body.offset+body.limit]
+            elif body.offset:
+                names = names[body.offset:]
+            elif body.limit:
+                names = names[:body.limit]
+            markers = await stat_markers(storage, layout, userid, names)
+        else:
+            # Every folder: one recursive listing carries the metadata of
+            # the markers, at the cost of walking the files too.
+            markers = await list_entries(
+                storage, layout, userid, recursive=True, select=is_marker)
+
+        folders = [{
+            'id': marker.name[:-1],
+            'name': marker.metadata['x-amz-meta-title'],
+            'modified': marker.modified,
+            'created': marker.created,
+        } for marker in markers]
 
     return json(body={
         "metadata": {
@@ -346,6 +921,72 @@ async def list_folders(request, body: FoldersListing):
     })
 
 
+class InstrumentedMinio:
+    """Times and traces every MinIO client operation.
+    The client itself is only built on first use.
+    """
+
+    def __init__(self, factory: t.Callable[[], t.Any]):
+        self._factory = factory
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, operation: str):
+        method = getattr(self.client, operation)
+        if not callable(method):
+            return method
+
+        async def instrumented(*args, **kwargs):
+            with tracer.span(f'minio.{operation}'), \
+                 storage_latency.time(operation), \
+                 registry.count_exceptions(storage_errors, operation):
+                result = method(*args, **kwargs)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                return result
+
+        return instrumented
+
+    async def list_objects(self, bucket_name: str, prefix=None,
+                           recursive: bool = False, start_after=None,
+                           **kwargs):
+        """miniopy-async only returns the first page of a listing: the
+        next ones are requested after the last key of each full page.
+        """
+        listing = self.__getattr__('list_objects')
+        objects = []
+        while True:
+            page = await listing(
+                bucket_name, prefix=prefix, recursive=recursive,
+                start_after=start_after, **kwargs)
+            objects.extend(page)
+            if len(page) < LISTING_PAGE:
+                return objects
+            start_after = page[-1].object_name
+            if page[-1].is_dir:
+                # Skips the keys rolled up in the common prefix.
+                start_after += '\U0010ffff'
+
+
+def minio_client(config: dict):
+    from miniopy_async import Minio
+    return Minio(**config)
+
+
 @storage.listener("before_server_start")
 async def setup_storage(app):
-    app.ctx.minio = Minio(**app.config.MINIO)
+    app.ctx.minio = InstrumentedMinio(
+        lambda: minio_client(app.config.MINIO))
+    config = app.config.STORAGE
+    app.ctx.layout = make_layout(app.ctx.minio, config, app.ctx.cache)
+    app.ctx.blobs = None
+    if config.get('dedup'):
+        app.ctx.blobs = BlobStore(
+            app.ctx.minio, app.ctx.layout, config['dedup'],
+            bucket=config.get('blobs_bucket', 'microfarm-blobs')
+        )
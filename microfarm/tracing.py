@@ -0,0 +1,226 @@
+"""
+Tracing
+-------
+
+Request-scoped span trees. The root span is opened by a request
+middleware; RPC calls and MinIO operations open child spans through
+`tracer.span`. Finished spans of sampled traces are batched and posted
+as JSON to a collector:
+
+  {"service": "microfarm", "spans": [{"trace_id": ..., "span_id": ...,
+   "parent_id": ..., "name": ..., "start": <epoch ns>,
+   "duration": <ns>, "status": "ok" | "error", "attributes": {...}}]}
+
+Incoming W3C `traceparent` headers are honoured.
+"""
+
+import asyncio
+import random
+import secrets
+import time
+import typing as t
+import orjson
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sanic import Blueprint
+from .metrics import registry
+
+
+current_span: ContextVar[t.Optional['Span']] = ContextVar(
+    'current_span', default=None)
+
+dropped_spans = registry.counter(
+    'microfarm_tracing_dropped_spans_total',
+    'Finished spans dropped because the export queue was full.',
+)
+
+
+class Span:
+    __slots__ = (
+        'trace_id', 'span_id', 'parent_id', 'name', 'attributes',
+        'start', 'duration', 'status', 'token'
+    )
+
+    def __init__(self, name: str, trace_id: str,
+                 parent_id: t.Optional[str] = None, **attributes):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time_ns()
+        self.duration = None
+        self.status = 'ok'
+        self.token = None
+
+    def finish(self):
+        self.duration = time.time_ns() - self.start
+
+    def export(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'status': self.status,
+            'attributes': self.attributes
+        }
+
+
+class CollectorExporter:
+
+    def __init__(self, endpoint: str, service: str = 'microfarm',
+                 interval: float = 5., batch_size: int = 512,
+                 max_queue: int = 10000):
+        self.endpoint = endpoint
+        self.service = service
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.queue = []
+        self.session = None
+
+    def add(self, span: Span):
+        if len(self.queue) >= self.max_queue:
+            dropped_spans.inc()
+            return
+        self.queue.append(span.export())
+
+    async def flush(self):
+        import aiohttp
+
+        while self.queue:
+            batch = self.queue[:self.batch_size]
+            del self.queue[:self.batch_size]
+            try:
+                async with self.session.post(
+                        self.endpoint,
+                        data=orjson.dumps({
+                            'service': self.service, 'spans': batch
+                        }),
+                        headers={'Content-Type': 'application/json'}):
+                    pass
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # The collector is unreachable: the batch is lost.
+                dropped_spans.inc(amount=len(batch))
+
+    async def run(self):
+        import aiohttp
+
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.interval))
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+        finally:
+            await self.flush()
+            await self.session.close()
+
+
+class Tracer:
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.
+        self.propagate = False
+        self.exporter: t.Optional[CollectorExporter] = None
+
+    def start_trace(self, name: str, traceparent: t.Optional[str] = None,
+                    **attributes) -> t.Optional[Span]:
+        if not self.enabled:
+            return None
+
+        trace_id = parent_id = None
+        if traceparent:
+            try:
+                _, trace_id, parent_id, flags = traceparent.split('-')
+                sampled = int(flags, 16) & 1
+            except ValueError:
+                trace_id = parent_id = None
+            else:
+                if not sampled:
+                    return None
+
+        if trace_id is None and random.random() >= self.sample_rate:
+            return None
+
+        span = Span(
+            name, trace_id or secrets.token_hex(16), parent_id, **attributes)
+        span.token = current_span.set(span)
+        return span
+
+    def end_trace(self, span: Span, **attributes):
+        span.attributes.update(attributes)
+        span.finish()
+        current_span.reset(span.token)
+        self.exporter.add(span)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        parent = current_span.get()
+        if parent is None:
+            yield None
+            return
+
+        span = Span(name, parent.trace_id, parent.span_id, **attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except Exception as exc:
+            span.status = 'error'
+            span.attributes['error'] = type(exc).__name__
+            raise
+        finally:
+            current_span.reset(token)
+            span.finish()
+            self.exporter.add(span)
+
+    def context(self) -> t.Optional[dict]:
+        """Trace context handed over to the backend services.
+        """
+        span = current_span.get()
+        if span is None or not self.propagate:
+            return None
+        return {'trace_id': span.trace_id, 'span_id': span.span_id}
+
+
+tracer = Tracer()
+tracing = Blueprint('tracing')
+
+
+async def trace_request(request):
+    span = tracer.start_trace(
+        f'{request.method} {request.path}',
+        traceparent=request.headers.get('traceparent'),
+        method=request.method,
+        route=request.route.path if request.route else None
+    )
+    request.ctx.span = span
+
+
+async def end_request_trace(request, response):
+    span = getattr(request.ctx, 'span', None)
+    if span is None:
+        return
+    request.ctx.span = None
+    if response.status >= 500:
+        span.status = 'error'
+    tracer.end_trace(span, status_code=response.status)
+    response.headers['X-Trace-Id'] = span.trace_id
+
+
+@tracing.listener("before_server_start")
+async def setup_tracing(app):
+    config = app.config.TRACING
+    tracer.enabled = config.get('enabled', False)
+    tracer.sample_rate = config.get('sample_rate', 1.)
+    tracer.propagate = config.get('propagate', False)
+    if tracer.enabled:
+        tracer.exporter = CollectorExporter(
+            config['endpoint'],
+            interval=config.get('interval', 5.)
+        )
+        app.add_task(tracer.exporter.run(), name='tracing-exporter')
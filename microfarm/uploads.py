@@ -0,0 +1,443 @@
+"""
+Resumable uploads
+-----------------
+
+Large files are uploaded in fixed-size chunks, each of which can be
+retried on its own:
+
+  POST   /folders/uploads                    opens a session
+  PUT    /folders/uploads/<id>/<offset>      sends one chunk
+  GET    /folders/uploads/<id>               tells what was received
+  POST   /folders/uploads/<id>/complete      assembles the file (job)
+  DELETE /folders/uploads/<id>               gives up
+
+Chunks are the parts of a MinIO multipart upload, assembled into a
+staging object once all of them arrived. The file is verified against
+its announced checksum before it becomes a folder entry; the session
+ends if it does not match. Sessions are stored as JSON objects
+`.uploads/<id>` in the user's storage, and every received part as an
+empty `.uploads/<id>.parts/<number>.<etag>` object; sessions older than
+`ttl` seconds are aborted by a janitor task, run by one worker of each
+node: the one holding the `janitor_lock` file.
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import math
+import time
+import typing as t
+import uuid
+from pathlib import Path
+import orjson
+import pydantic
+from sanic import Blueprint
+from sanic.response import json, raw, empty
+from sanic_ext import openapi, cors
+from .jobs import JobError, PENDING, RUNNING, DONE
+from .locks import node_lock
+from .storage import (
+    checksum_digest, folder_changed, folder_entry, folder_state, link_entry,
+    sha256hash)
+from .validation import validate_json
+
+
+logger = logging.getLogger(__name__)
+
+MAX_PARTS = 10000
+MIN_CHUNK_SIZE = 5 * 1024 * 1024
+
+uploads = Blueprint('uploads')
+
+
+class UploadCreation(pydantic.BaseModel):
+    folder: str
+    filename: str
+    size: pydantic.conint(gt=0)
+    checksum: str
+    content_type: str = 'application/octet-stream'
+    definition: t.Optional[t.Literal['body']] = None
+
+
+def chunk_size(size: int, preferred: int) -> int:
+    """Chunk size for a file, keeping within the multipart limits.
+    """
+    needed = math.ceil(size / MAX_PARTS)
+    return max(preferred, MIN_CHUNK_SIZE, needed)
+
+
+def session_key(upload_id: str) -> str:
+    return f'.uploads/{upload_id}'
+
+
+def parts_prefix(upload_id: str) -> str:
+    return f'{session_key(upload_id)}.parts/'
+
+
+async def load_session(storage, layout, userid: str, upload_id: str,
+                       expired: bool = False) -> t.Optional[dict]:
+    import aiohttp
+    from miniopy_async.error import S3Error
+
+    async with aiohttp.ClientSession() as sess:
+        try:
+            resp = await storage.get_object(
+                *layout.key(userid, session_key(upload_id)), session=sess)
+        except S3Error as exc:
+            if exc.code not in ('NoSuchKey', 'NoSuchBucket'):
+                raise
+            return None
+        session = orjson.loads(await resp.read())
+    if not expired and session['expires'] <= time.time():
+        return None
+    return session
+
+
+async def received_parts(storage, session: dict) -> t.Dict[int, str]:
+    """ETags of the received parts, by part number.
+    """
+    prefix = session['parts']
+    objects = await storage.list_objects(session['bucket'], prefix=prefix)
+    parts = {}
+    for obj in objects:
+        number, etag = obj.object_name[len(prefix):].split('.')
+        parts[int(number)] = etag
+    return parts
+
+
+def expected_length(session: dict, number: int) -> int:
+    offset = (number - 1) * session['chunk_size']
+    return min(session['chunk_size'], session['size'] - offset)
+
+
+async def discard(storage, session: dict):
+    from miniopy_async.error import S3Error
+
+    bucket = session['bucket']
+    try:
+        await storage._abort_multipart_upload(
+            bucket, session['staging'], session['multipart'])
+    except S3Error as exc:
+        if exc.code != 'NoSuchUpload':
+            raise
+    await remove_parts(storage, session)
+    await storage.remove_object(bucket, session['staging'])
+    await storage.remove_object(bucket, session['key'])
+
+
+async def remove_parts(storage, session: dict):
+    prefix = session['parts']
+    for obj in await storage.list_objects(session['bucket'], prefix=prefix):
+        await storage.remove_object(session['bucket'], obj.object_name)
+
+
+@uploads.post("/folders/uploads")
+@openapi.definition(
+    secured="token",
+)
+@validate_json(UploadCreation)
+async def create_upload(request, body: UploadCreation):
+    userid = request.ctx.user.id
+    app = request.app
+    storage = app.ctx.minio
+    layout = app.ctx.layout
+    config = app.config.UPLOADS
+
+    if checksum_digest(body.checksum) is None:
+        return raw(status=422, body="SHA256 checkum is invalid.")
+    if body.size > config['max_size']:
+        return empty(status=413)
+    if not await layout.exists(userid):
+        return empty(status=404)
+    state = await folder_state(storage, layout, userid, body.folder)
+    if state is None:
+        return empty(status=404)
+    if state:
+        return raw(status=409, body="The folder is locked.")
+
+    upload_id = uuid.uuid4().hex
+    objname, filename = folder_entry(
+        body.folder, body.definition, body.filename)
+    bucket, key = layout.key(userid, session_key(upload_id))
+    staging = f'{key}.data'
+    multipart = await storage._create_multipart_upload(
+        bucket, staging, {'Content-Type': body.content_type})
+    now = time.time()
+    session = {
+        'id': upload_id,
+        'user': userid,
+        'bucket': bucket,
+        'key': key,
+        'parts': layout.key(userid, parts_prefix(upload_id))[1],
+        'folder': body.folder,
+        'object': objname,
+        'filename': filename,
+        'content_type': body.content_type,
+        'size': body.size,
+        'checksum': body.checksum,
+        'chunk_size': chunk_size(body.size, config['chunk_size']),
+        'staging': staging,
+        'multipart': multipart,
+        'expires': now + config['ttl'],
+    }
+    data = orjson.dumps(session)
+    await storage.put_object(
+        bucket, key, io.BytesIO(data), len(data),
+        content_type='application/json'
+    )
+    return json(status=201, body={
+        'upload': upload_id,
+        'chunk_size': session['chunk_size'],
+        'expires': session['expires'],
+    })
+
+
+@uploads.get("/folders/uploads/<upload_id:str>")
+@openapi.definition(
+    secured="token",
+)
+async def upload_status(request, upload_id: str):
+    storage = request.app.ctx.minio
+    session = await load_session(
+        storage, request.app.ctx.layout, request.ctx.user.id, upload_id)
+    if session is None:
+        return empty(status=404)
+
+    parts = await received_parts(storage, session)
+    offset = 0
+    number = 1
+    while number in parts:
+        offset += expected_length(session, number)
+        number += 1
+    return json(body={
+        'upload': upload_id,
+        'size': session['size'],
+        'chunk_size': session['chunk_size'],
+        # Bytes received without a gap: where a client resumes.
+        'offset': offset,
+        'received': sorted(
+            (number - 1) * session['chunk_size'] for number in parts),
+        'expires': session['expires'],
+    })
+
+
+@uploads.put("/folders/uploads/<upload_id:str>/<offset:int>")
+@openapi.definition(
+    secured="token",
+)
+@cors(allow_headers=['Authorization', 'Content-Type', 'X-Checksum-SHA256'])
+async def upload_chunk(request, upload_id: str, offset: int):
+    storage = request.app.ctx.minio
+    session = await load_session(
+        storage, request.app.ctx.layout, request.ctx.user.id, upload_id)
+    if session is None:
+        return empty(status=404)
+
+    if offset % session['chunk_size'] or not 0 <= offset < session['size']:
+        return raw(status=416, body="Offset is not a chunk boundary.")
+    number = offset // session['chunk_size'] + 1
+    chunk = request.body
+    if len(chunk) != expected_length(session, number):
+        return raw(status=422, body="Unexpected chunk length.")
+
+    checksum = request.headers.get('x-checksum-sha256')
+    if checksum is None:
+        return raw(status=422, body="SHA256 checkum is missing.")
+    if sha256hash(chunk).decode('utf-8') != checksum:
+        return raw(status=422, body="SHA256 checkum mismatch.")
+
+    etag = await storage._upload_part(
+        session['bucket'], session['staging'], chunk, {},
+        session['multipart'], number
+    )
+    # A retransmitted chunk replaces the part, and its marker.
+    for previous in await storage.list_objects(
+            session['bucket'],
+            prefix=f"{session['parts']}{number:05d}."):
+        await storage.remove_object(session['bucket'], previous.object_name)
+    await storage.put_object(
+        session['bucket'], f"{session['parts']}{number:05d}.{etag}",
+        io.BytesIO(b''), 0
+    )
+    return empty(status=204)
+
+
+async def assemble(storage, layout, blobs, session: dict, progress) -> dict:
+    import aiohttp
+    from miniopy_async.commonconfig import CopySource, REPLACE
+    from miniopy_async.datatypes import Part
+
+    userid = session['user']
+    bucket, staging = session['bucket'], session['staging']
+    parts = await received_parts(storage, session)
+    count = math.ceil(session['size'] / session['chunk_size'])
+    missing = [
+        (number - 1) * session['chunk_size']
+        for number in range(1, count + 1) if number not in parts
+    ]
+    if missing:
+        raise JobError(f'Chunks are missing at offsets {missing[:10]}.')
+    if await folder_state(storage, layout, userid, session['folder']):
+        raise JobError('The folder is locked.')
+
+    await progress(0., 'assemble')
+    await storage._complete_multipart_upload(
+        bucket, staging, session['multipart'],
+        [Part(number, parts[number]) for number in range(1, count + 1)]
+    )
+    await remove_parts(storage, session)
+
+    await progress(.1, 'verify')
+    hasher = hashlib.sha256()
+    done = 0
+    async with aiohttp.ClientSession() as sess:
+        resp = await storage.get_object(bucket, staging, session=sess)
+        async for data in resp.content.iter_chunked(1024 * 1024):
+            hasher.update(data)
+            done += len(data)
+            await progress(.1 + .8 * done / session['size'])
+    digest = checksum_digest(session['checksum'])
+    if hasher.hexdigest() != digest:
+        # The parts are gone: the session cannot be resumed.
+        await storage.remove_object(bucket, staging)
+        await storage.remove_object(bucket, session['key'])
+        raise JobError('SHA256 checkum mismatch.')
+
+    await progress(.9, 'store')
+    if blobs is not None:
+        await blobs.adopt(userid, digest, bucket, staging)
+        put_info = await link_entry(
+            storage, layout, blobs, userid, session['object'], digest,
+            session['checksum'], session['filename'],
+            session['content_type'], session['size']
+        )
+        if put_info is None:
+            raise JobError('The file was deleted meanwhile.')
+    else:
+        put_info = await storage.copy_object(
+            *layout.key(userid, session['object']),
+            CopySource(bucket, staging),
+            metadata={
+                "Content-Type": session['content_type'],
+                "x-amz-meta-checksum": session['checksum'],
+                "x-amz-meta-filename": session['filename'],
+            },
+            metadata_directive=REPLACE
+        )
+        await storage.remove_object(bucket, staging)
+
+    await storage.remove_object(bucket, session['key'])
+    return {
+        'etag': put_info.etag,
+        'userid': userid,
+        'fileid': session['object']
+    }
+
+
+@uploads.post("/folders/uploads/<upload_id:str>/complete")
+@openapi.definition(
+    secured="token",
+)
+async def complete_upload(request, upload_id: str):
+    user = request.ctx.user
+    app = request.app
+    storage = app.ctx.minio
+    layout = app.ctx.layout
+    session = await load_session(storage, layout, user.id, upload_id)
+    if session is None:
+        return empty(status=404)
+
+    async def run(job: dict, progress):
+        result = await assemble(
+            storage, layout, app.ctx.blobs, session, progress)
+        await folder_changed(app, user, session['folder'])
+        return result
+
+    try:
+        job, _ = await app.ctx.jobs.enqueue(
+            'folder.upload', user.id, run,
+            dedup=f'upload:{upload_id}',
+            reuse=(PENDING, RUNNING, DONE)
+        )
+    except asyncio.QueueFull:
+        return empty(status=503)
+
+    return json(
+        status=202,
+        body={'request': job['id']},
+        headers={'Location': f"/folders/jobs/{job['id']}"}
+    )
+
+
+@uploads.delete("/folders/uploads/<upload_id:str>")
+@openapi.definition(
+    secured="token",
+)
+async def abort_upload(request, upload_id: str):
+    storage = request.app.ctx.minio
+    session = await load_session(
+        storage, request.app.ctx.layout, request.ctx.user.id, upload_id)
+    if session is None:
+        return empty(status=404)
+    await discard(storage, session)
+    return empty(status=204)
+
+
+async def sweep(storage, layout) -> int:
+    """Aborts the expired upload sessions of every user.
+    """
+    now = time.time()
+    swept = 0
+    for userid in await layout.users():
+        bucket, prefix = layout.key(userid, '.uploads/')
+        objects = await storage.list_objects(bucket, prefix=prefix)
+        for obj in objects:
+            if obj.is_dir or obj.object_name.endswith('.data'):
+                continue
+            upload_id = obj.object_name[len(prefix):]
+            session = await load_session(
+                storage, layout, userid, upload_id, expired=True)
+            if session is None or session['expires'] > now:
+                continue
+            await discard(storage, session)
+            swept += 1
+    return swept
+
+
+async def janitor(storage, layout, interval: float,
+                  lock: t.Optional[Path] = None):
+    handle = None
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            if lock is not None and handle is None:
+                # Workers retry, should the one sweeping exit.
+                handle = node_lock(lock)
+                if handle is None:
+                    continue
+            try:
+                swept = await sweep(storage, layout)
+            except Exception:
+                logger.exception('Could not sweep the upload sessions.')
+            else:
+                if swept:
+                    logger.info(
+                        '%d expired upload sessions were aborted.', swept)
+    finally:
+        if handle is not None:
+            handle.close()
+
+
+@uploads.listener("before_server_start")
+async def setup_uploads(app):
+    config = app.config.UPLOADS
+    if config.get('janitor_interval'):
+        lock = config.get('janitor_lock')
+        app.add_task(
+            janitor(
+                app.ctx.minio, app.ctx.layout, config['janitor_interval'],
+                lock=None if lock is None else Path(lock)
+            ),
+            name='uploads-janitor'
+        )
@@ -33,6 +33,51 @@ validation_errors_definition = {
 }
 
 
+class LazySchema(dict):
+    """JSON schema of a pydantic model, generated on first read.
+
+    Sanic Extensions only inspects membership and `values()` when the
+    route is decorated and iterates the items when the documentation is
+    served, so the schema is not built at import time.
+    """
+
+    def __init__(self, model: t.Type[pydantic.BaseModel]):
+        super().__init__()
+        self.model = model
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.update(self.model.schema())
+            self.loaded = True
+        return self
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self.load(), key)
+
+    def __iter__(self):
+        return dict.__iter__(self.load())
+
+    def __len__(self):
+        return dict.__len__(self.load())
+
+    def get(self, key, default=None):
+        return dict.get(self.load(), key, default)
+
+    def keys(self):
+        return dict.keys(self.load())
+
+    def items(self):
+        return dict.items(self.load())
+
+    def copy(self):
+        return dict(self.load())
+
+
+def lazy_schema(model: t.Type[pydantic.BaseModel]) -> LazySchema:
+    return LazySchema(model)
+
+
 def validate_json(model: pydantic.BaseModel):
 
     @wrapt.decorator
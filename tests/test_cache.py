@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from microfarm.cache import LRU, MISSING, CacheServer, LocalCache, SharedCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.)
+    monkeypatch.setattr(
+        'microfarm.cache.time',
+        SimpleNamespace(time=lambda: clock.now, monotonic=lambda: clock.now)
+    )
+    return clock
+
+
+def test_lru_expiry(clock):
+    lru = LRU()
+    lru.set('a', 1, expires=1010.)
+    assert lru.get('a') == (1, 1010.)
+    clock.now = 1010.
+    assert lru.get('a') == (MISSING, 0)
+    assert len(lru) == 0
+
+
+def test_lru_bounds():
+    lru = LRU(max_entries=2, max_bytes=10)
+    lru.set('a', 1, float('inf'), size=4)
+    lru.set('b', 2, float('inf'), size=4)
+    lru.get('a')  # Used last: `b` goes first.
+    lru.set('c', 3, float('inf'), size=4)
+    assert list(lru.entries) == ['a', 'c']
+    lru.set('d', 4, float('inf'), size=8)
+    assert list(lru.entries) == ['d'] and lru.size == 8
+    lru.pop('d')
+    assert lru.size == 0
+
+
+def test_local_ttls(clock):
+    cache = LocalCache(ttls={'token': 60, 'summary': 0}, default_ttl=10)
+
+    async def main():
+        await cache.set('token:a', 'a')
+        await cache.set('token:b', 'b', ttl=5)  # Shorter than the namespace.
+        await cache.set('token:c', 'c', ttl=600)  # Capped by the namespace.
+        await cache.set('bucket:d', 'd')  # The default.
+        await cache.set('summary:e', 'e')  # Not cached.
+        await cache.set('token:f', 'f', ttl=-1)  # Already expired.
+        assert len(cache.lru) == 4
+        clock.now += 5
+        assert await cache.get('token:b') is None
+        assert await cache.get('bucket:d') == 'd'
+        clock.now += 5
+        assert await cache.get('bucket:d') is None
+        assert await cache.get('token:c') == 'c'
+        clock.now += 50
+        assert await cache.get('token:a') is None
+        assert await cache.get('token:c', MISSING) is MISSING
+
+    asyncio.run(main())
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = CacheServer(tmp_path / 'cache.sock')
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_invalidated_while_fetched(server):
+
+    async def main():
+        reader = SharedCache(server.path)
+        writer = SharedCache(server.path)
+        await writer.set('summary:folder', 'old')
+        fetch = reader.request
+
+        async def request(op, key, *args):
+            reply = await fetch(op, key, *args)
+            # Changed by another worker before the lookup resumes.
+            await writer.set(key, 'new')
+            await asyncio.sleep(.05)
+            return reply
+
+        reader.request = request
+        assert await reader.get('summary:folder') == 'old'
+        assert reader.near.get('summary:folder')[0] is MISSING
+        assert not reader.fetching
+
+        reader.request = fetch
+        assert await reader.get('summary:folder') == 'new'
+        assert reader.near.get('summary:folder')[0] == 'new'
+        await reader.close()
+        await writer.close()
+
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+import asyncio
+import gzip
+import pytest
+from microfarm.compression import Compressor, accepted, compressible
+
+
+@pytest.fixture
+def compressor():
+    compressor = Compressor()
+    # Whatever codecs are installed: negotiation only looks at names.
+    compressor.encodings = ['zstd', 'br', 'gzip']
+    yield compressor
+    compressor.close()
+
+
+def test_accepted():
+    assert accepted(None) == {}
+    assert accepted('gzip, br;q=0.5, *;q=0, zstd;q=x') == {
+        'gzip': 1., 'br': .5, '*': 0., 'zstd': 0.}
+    assert accepted('GZip ; q=0.8') == {'gzip': .8}
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('', None),
+    ('identity', None),
+    ('gzip', 'gzip'),
+    ('gzip, br, zstd', 'zstd'),  # Server preference on ties.
+    ('gzip, br;q=0.9', 'gzip'),
+    ('br;q=0.5, gzip;q=0.4', 'br'),
+    ('*', 'zstd'),
+    ('*, zstd;q=0', 'br'),
+    ('gzip;q=0', None),
+    ('*;q=0', None),
+    ('deflate', None),
+])
+def test_negotiate(compressor, header, expected):
+    assert compressor.negotiate(header) == expected
+
+
+def test_negotiate_available_only(compressor):
+    compressor.encodings = ['gzip']
+    assert compressor.negotiate('zstd, br') is None
+    assert compressor.negotiate('zstd, gzip;q=0.1') == 'gzip'
+
+
+def test_compress(compressor):
+    data = b'{"files": {}}' * 100
+    compressed = asyncio.run(compressor.compress(data, 'gzip'))
+    assert gzip.decompress(compressed) == data
+    # Reproducible: no timestamp.
+    assert asyncio.run(compressor.compress(data, 'gzip')) == compressed
+
+
+@pytest.mark.parametrize('content_type, expected', [
+    ('application/json', True),
+    ('application/toml; charset=utf-8', True),
+    ('text/plain', True),
+    ('application/pkcs7-signature', False),
+    ('image/png', False),
+    (None, False),
+])
+def test_compressible(content_type, expected):
+    assert compressible(content_type) == expected
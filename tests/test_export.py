@@ -0,0 +1,40 @@
+from datetime import datetime, timezone
+import pytest
+from microfarm.export import member_names
+from microfarm.storage import Entry
+
+
+def entry(name: str, filename=None) -> Entry:
+    metadata = {} if filename is None else {'x-amz-meta-filename': filename}
+    return Entry(name, 1, datetime.now(tz=timezone.utc), metadata)
+
+
+@pytest.mark.parametrize('filename, expected', [
+    ('report.pdf', 'report.pdf'),
+    ('docs/report.pdf', 'report.pdf'),
+    ('/etc/passwd', 'passwd'),
+    ('C:\\Users\\me\\report.pdf', 'report.pdf'),
+    ('../../report.pdf', 'report.pdf'),
+    ('..', 'file'),
+    ('.', 'file'),
+    ('docs/', 'docs'),
+    ('', 'id'),  # The object name, without a file name.
+    (None, 'id'),
+])
+def test_member_name(filename, expected):
+    assert member_names([entry('folder/id', filename)]) == [expected]
+
+
+def test_unique_member_names():
+    entries = [
+        entry('folder/1', 'report.pdf'),
+        entry('folder/2', 'old/report.pdf'),
+        entry('folder/3', 'report (2).pdf'),
+        entry('folder/4', 'report.pdf'),
+        entry('folder/5', 'notes'),
+        entry('folder/6', 'notes'),
+    ]
+    assert member_names(entries) == [
+        'report.pdf', 'report (2).pdf', 'report (2) (2).pdf',
+        'report (3).pdf', 'notes', 'notes (2)',
+    ]
@@ -0,0 +1,77 @@
+from datetime import datetime, timezone
+import pytest
+from microfarm.formats import (
+    SUMMARY_FORMATS, format_http_date, negotiate_format, parse_http_date)
+
+
+FORMATS = list(SUMMARY_FORMATS)
+DATE = datetime(1994, 11, 6, 8, 49, 37, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, 'application/toml'),
+    ('', 'application/toml'),
+    ('application/json', 'application/json'),
+    ('application/json;q=0.5, application/msgpack', 'application/msgpack'),
+    ('application/json; q=0.9, application/toml; q=0.8', 'application/json'),
+    # Aliases of MessagePack.
+    ('application/x-msgpack', 'application/msgpack'),
+    ('application/vnd.msgpack', 'application/msgpack'),
+    # Wildcards: the default comes first.
+    ('*/*', 'application/toml'),
+    ('application/*', 'application/toml'),
+    ('application/*;q=0.1, application/json', 'application/json'),
+    ('*/*;q=0.1, application/msgpack', 'application/msgpack'),
+    # `application/*` is more specific than `*/*`.
+    ('*/*, application/*;q=0, application/json;q=0.1', 'application/json'),
+    # Nothing acceptable: the default.
+    ('text/html', 'application/toml'),
+    ('text/*', 'application/toml'),
+    ('application/octet-stream', 'application/toml'),
+    ('application/json;q=0', 'application/toml'),
+    ('application/json;q=invalid', 'application/toml'),
+])
+def test_negotiate_format(header, expected):
+    assert negotiate_format(header, FORMATS) == expected
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('application/toml;q=0', None),
+    ('application/toml;q=0, application/json', 'application/json'),
+    ('*/*;q=0', None),
+    ('application/*;q=0, text/html', None),
+    ('*/*;q=0, application/toml', 'application/toml'),
+])
+def test_negotiate_refused_default(header, expected):
+    assert negotiate_format(header, FORMATS) == expected
+
+
+@pytest.mark.parametrize('value', [
+    'Sun, 06 Nov 1994 08:49:37 GMT',  # IMF-fixdate
+    'Sunday, 06-Nov-94 08:49:37 GMT',  # RFC 850
+    'Sun Nov  6 08:49:37 1994',  # asctime
+    'Sun, 06 Nov 1994 09:49:37 +0100',  # with an offset
+])
+def test_parse_http_date(value):
+    parsed = parse_http_date(value)
+    assert parsed == DATE
+    assert parsed.tzinfo is not None
+
+
+def test_parse_http_date_fallback():
+    # Right length and suffix, but not a fixdate.
+    assert parse_http_date('Sun,  6 Nov 1994 08:49:37  GMT') == DATE
+
+
+@pytest.mark.parametrize('value', [
+    '', 'yesterday', 'Sun, 06 Foo 1994 08:49:37 GMT'])
+def test_parse_invalid_http_date(value):
+    with pytest.raises(ValueError):
+        parse_http_date(value)
+
+
+def test_format_http_date():
+    assert format_http_date(DATE) == 'Sun, 06 Nov 1994 08:49:37 GMT'
+    assert format_http_date(DATE.replace(tzinfo=None)) == \
+        'Sun, 06 Nov 1994 08:49:37 GMT'
+    assert parse_http_date(format_http_date(DATE)) == DATE
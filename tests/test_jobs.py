@@ -0,0 +1,102 @@
+import asyncio
+import time
+import pytest
+from microfarm.jobs import (
+    DONE, FAILED, PENDING, RUNNING, JobError, JobQueue, JobStore)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / 'jobs.sqlite'
+
+
+def test_dedup(path):
+    store = JobStore(path)
+    job, created = store._create('folder.lock', 'user', 'key', (PENDING,))
+    assert created
+    same, created = store._create('folder.lock', 'user', 'key', (PENDING,))
+    assert not created and same['id'] == job['id']
+
+    # A finished job hands its key over.
+    store._update(job['id'], status=DONE)
+    other, created = store._create('folder.lock', 'user', 'key', (PENDING,))
+    assert created and other['id'] != job['id']
+    assert store._get(job['id'])['dedup'] is None
+
+    unkeyed, created = store._create('folder.lock', 'user', None, ())
+    assert created and unkeyed['dedup'] is None
+
+
+def test_active(path):
+    store = JobStore(path)
+    assert store._active('key') is None
+    job, _ = store._create('folder.lock', 'user', 'key', ())
+    assert store._active('key')['id'] == job['id']
+    store._update(job['id'], status=RUNNING)
+    assert store._active('key')['id'] == job['id']
+    store._update(job['id'], status=DONE)
+    assert store._active('key') is None
+
+
+def test_recover_silent_worker(path):
+    previous = JobStore(path, heartbeat=.01)
+    job, _ = previous._create('folder.lock', 'user', 'key', ())
+    previous._update(job['id'], status=RUNNING)
+
+    # Same process id and host, e.g. a restarted container.
+    store = JobStore(path, heartbeat=.01)
+    assert store._recover() == 0  # Still beating recently.
+    time.sleep(.05)
+    store._beat()
+    assert store._recover() == 1
+    recovered = store._get(job['id'])
+    assert recovered['status'] == FAILED
+    assert recovered['dedup'] is None
+    _, created = store._create('folder.lock', 'user', 'key', (RUNNING,))
+    assert created
+
+
+def test_recover_keeps_live_workers(path):
+    store = JobStore(path)
+    other = JobStore(path)
+    job, _ = other._create('folder.lock', 'user', 'key', ())
+    assert store._recover() == 0
+    assert store._get(job['id'])['status'] == PENDING
+
+    other._retire()
+    assert store._get(job['id'])['status'] == FAILED
+
+
+def run_jobs(store, *runs, timeout=None):
+
+    async def main():
+        queue = JobQueue(store, workers=2, timeout=timeout)
+        queue.start()
+        jobs = []
+        for run in runs:
+            job, _ = await queue.enqueue('folder.lock', 'user', run)
+            jobs.append(job['id'])
+        await queue.queue.join()
+        await queue.stop()
+        return [store._get(job_id) for job_id in jobs]
+
+    return asyncio.run(main())
+
+
+def test_queue(path):
+
+    async def done(job, progress):
+        await progress(.5, 'half')
+        return {'ok': True}
+
+    async def refused(job, progress):
+        raise JobError('Nope.')
+
+    async def slow(job, progress):
+        await asyncio.sleep(10)
+
+    first, second, third = run_jobs(
+        JobStore(path), done, refused, slow, timeout=.1)
+    assert (first['status'], first['result']) == (DONE, {'ok': True})
+    assert (second['status'], second['error']) == (FAILED, 'Nope.')
+    assert (third['status'], third['error']) == (FAILED, 'Timed out.')
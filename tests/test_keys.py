@@ -0,0 +1,106 @@
+import os
+from types import SimpleNamespace
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from microfarm.keys import KeyManager
+
+
+def public_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.public_key()
+
+
+def write(path, key, mtime: float):
+    path.write_bytes(key.public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo))
+    os.utime(path, (mtime, mtime))
+
+
+def numbers(keys):
+    return [key.public_numbers() for key in keys]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.)
+    monkeypatch.setattr(
+        'microfarm.keys.time', SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def directory(tmp_path):
+    directory = tmp_path / 'keys'
+    directory.mkdir()
+    return directory
+
+
+def test_load(tmp_path, directory, clock):
+    default, first = public_key(), public_key()
+    write(tmp_path / 'default.pub', default, 1)
+    write(directory / 'first.pub', first, 1)
+    (directory / 'notes.txt').write_text('Not a key.')
+    manager = KeyManager(tmp_path / 'default.pub', directory)
+    manager.load()
+    assert set(manager.keys) == {None, 'first'}
+    assert numbers(manager.candidates(None)) == numbers([default])
+    assert numbers(manager.candidates('first')) == numbers([first])
+    assert manager.candidates('other') == []
+
+
+def test_rotation(tmp_path, directory, clock):
+    write(tmp_path / 'default.pub', public_key(), 1)
+    old, new = public_key(), public_key()
+    write(directory / 'kid.pub', old, 1)
+    manager = KeyManager(tmp_path / 'default.pub', directory, grace=60)
+    manager.load()
+
+    write(directory / 'kid.pub', new, 2)
+    manager.load()
+    assert numbers(manager.candidates('kid')) == numbers([new, old])
+
+    # Unchanged files are not parsed again.
+    (directory / 'kid.pub').write_text('Broken.')
+    os.utime(directory / 'kid.pub', (2, 2))
+    manager.load()
+    assert numbers(manager.candidates('kid')) == numbers([new, old])
+
+    clock.now += 60
+    manager.load()
+    assert numbers(manager.candidates('kid')) == numbers([new])
+
+
+def test_removal(tmp_path, directory, clock):
+    write(tmp_path / 'default.pub', public_key(), 1)
+    key = public_key()
+    write(directory / 'kid.pub', key, 1)
+    manager = KeyManager(tmp_path / 'default.pub', directory, grace=60)
+    manager.load()
+
+    (directory / 'kid.pub').unlink()
+    manager.load()
+    assert 'kid' not in manager.keys
+    assert numbers(manager.candidates('kid')) == numbers([key])
+    clock.now += 30
+    manager.load()
+    assert numbers(manager.candidates('kid')) == numbers([key])
+    clock.now += 30
+    manager.load()
+    assert manager.candidates('kid') == []
+
+
+def test_invalid_keys(tmp_path, directory, clock):
+    (tmp_path / 'default.pub').write_text('Broken.')
+    manager = KeyManager(tmp_path / 'default.pub', directory)
+    with pytest.raises(ValueError):
+        manager.load()
+
+    default = public_key()
+    write(tmp_path / 'default.pub', default, 1)
+    manager.load()
+    # A broken replacement keeps the loaded key.
+    (tmp_path / 'default.pub').write_text('Broken.')
+    manager.load()
+    assert numbers(manager.candidates(None)) == numbers([default])
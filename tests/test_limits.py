@@ -0,0 +1,73 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from microfarm.limits import AdaptiveLimit, admit, limiter, release
+
+
+ROUTE = 'storage.export_folder'
+
+
+def make_request():
+    return SimpleNamespace(
+        route=SimpleNamespace(name=f'microfarm.{ROUTE}'),
+        ctx=SimpleNamespace(user=SimpleNamespace(id='user')),
+        remote_addr='127.0.0.1',
+        ip='127.0.0.1',
+    )
+
+
+@pytest.fixture
+def limit():
+    limiter.configure({'concurrency': {ROUTE: 2}})
+    yield limiter.concurrency[ROUTE]
+    limiter.configure({'enabled': False})
+
+
+def test_adaptive_limit():
+    limit = AdaptiveLimit(2, target_latency=.1, backoff=.5)
+    assert limit.acquire() and limit.acquire()
+    assert not limit.acquire()
+    limit.release(1.)
+    assert limit.inflight == 1
+    assert limit.limit == 1.
+    assert not limit.acquire()
+    limit.release(.01)
+    assert limit.inflight == 0
+
+
+def test_slot_released_with_response(limit):
+
+    async def handle():
+        request = make_request()
+        assert await admit(request) is None
+        assert limit.inflight == 1
+        await release(request, None)
+        await release(request, None)  # Idempotent.
+
+    async def main():
+        for _ in range(5):
+            await asyncio.create_task(handle())
+
+    asyncio.run(main())
+    assert limit.inflight == 0
+
+
+def test_slot_released_on_cancellation(limit):
+
+    async def handle():
+        request = make_request()
+        assert await admit(request) is None
+        await asyncio.sleep(10)  # The client goes away meanwhile.
+        await release(request, None)
+
+    async def main():
+        tasks = [asyncio.create_task(handle()) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert limit.inflight == 2
+        assert (await admit(make_request())).status == 429
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(main())
+    assert limit.inflight == 0
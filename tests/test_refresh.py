@@ -0,0 +1,96 @@
+import asyncio
+import sys
+from types import SimpleNamespace
+import pytest
+from microfarm.refresh import Refresher
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.)
+    # `microfarm.refresh` is also the blueprint, as exported.
+    monkeypatch.setattr(
+        sys.modules[Refresher.__module__], 'time',
+        SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def minter():
+    minted = []
+
+    async def mint(userdata: dict) -> str:
+        await asyncio.sleep(0)
+        minted.append(userdata)
+        return f'token-{len(minted)}'
+
+    return mint, minted
+
+
+def test_reuse_window(clock):
+    mint, minted = minter()
+    refresher = Refresher(mint, reuse_window=10, min_interval=60)
+
+    async def main():
+        assert await refresher.refresh('a', {'id': 'user', 'exp': 1}) == \
+            ('token-1', 0.)
+        assert minted == [{'id': 'user'}]
+        clock.now += 9
+        assert await refresher.refresh('a', {'id': 'user'}) == \
+            ('token-1', 0.)
+        clock.now += 1
+        assert await refresher.refresh('a', {'id': 'user'}) == (None, 50.)
+        # Another token of the same user.
+        assert await refresher.refresh('b', {'id': 'user'}) == \
+            ('token-2', 0.)
+        clock.now += 50
+        assert await refresher.refresh('a', {'id': 'user'}) == \
+            ('token-3', 0.)
+
+    asyncio.run(main())
+
+
+def test_concurrent_refreshes(clock):
+    mint, minted = minter()
+    refresher = Refresher(mint)
+
+    async def main():
+        return await asyncio.gather(*(
+            refresher.refresh('a', {'id': 'user'}) for _ in range(5)))
+
+    assert asyncio.run(main()) == [('token-1', 0.)] * 5
+    assert len(minted) == 1 and not refresher.pending
+
+
+def test_max_entries(clock):
+    mint, minted = minter()
+    refresher = Refresher(
+        mint, reuse_window=10, min_interval=60, max_entries=2)
+
+    async def main():
+        await refresher.refresh('a', {'id': 'a'})
+        clock.now += 20
+        await refresher.refresh('b', {'id': 'b'})
+        # Full: refused until the oldest record expires.
+        assert await refresher.refresh('c', {'id': 'c'}) == (None, 40.)
+        clock.now += 40
+        assert await refresher.refresh('c', {'id': 'c'}) == ('token-3', 0.)
+        assert list(refresher.issued) == ['b', 'c']
+
+    asyncio.run(main())
+
+
+def test_failed_mint(clock):
+
+    async def mint(userdata: dict) -> str:
+        raise ConnectionError()
+
+    refresher = Refresher(mint)
+
+    async def main():
+        results = await asyncio.gather(*(
+            refresher.refresh('a', {'id': 'user'}) for _ in range(2)),
+            return_exceptions=True)
+        assert all(isinstance(result, ConnectionError) for result in results)
+        assert not refresher.pending and not refresher.issued
+
+    asyncio.run(main())